@@ -0,0 +1 @@
+eval(function(p,a,c,k,e,d){e=function(c){return(c<a?'':e(parseInt(c/a)))+((c=c%a)>35?String.fromCharCode(c+29):c.toString(36))};if(!''.replace(/^/,String)){while(c--){d[e(c)]=k[c]||e(c)}k=[function(e){return d[e]}];e=function(){return'\\w+'};c=1};while(c--){if(k[c]){p=p.replace(new RegExp('\\b'+e(c)+'\\b','g'),k[c])}}return p}('$(8).9(a(){$(\'.b\').0(7);$(\'.c\').0(3);$(\'.d\').0(7);$(\'.e\').0(1);$(\'.f\').0(1);$(\'.g\').0(4);$(\'.h\').0(3);$(\'.i\').0(2);$(\'.j\').0(2);$(\'.k\').0(4);$(\'.l\').0(3);$(\'.m\').0(5);$(\'.n\').0(6);$(\'.o\').0(5);$(\'.p\').0(3);$(\'.q\').0(2);$(\'.r\').0(1);$(\'.s\').0(5);$(\'.t\').0(4);$(\'.u\').0(2);$(\'.v\').0(1);$(\'.w\').0(1);$(\'.x\').0(1);$(\'.y\').0(6);$(\'.z\').0(2);$(\'.A\').0(2);$(\'.B\').0(1);$(\'.C\').0(4);$(\'.D\').0(6);});',62,40,'html|80|8080|3128|8118|1080|8888|53281|document|ready|function|r1644|r456e|r48f3|r4bfb|r5015|r5055|r6257|r6732|r6c6e|r6c84|r6e1a|r6fb0|r7430|r78da|r8b7c|r9370|ra35b|ra470|rae4b|rb900|rc183|rc3ee|rc891|rd941|rd949|rdc63|red94|rf002|rfc2e'.split('|'),0,{}))
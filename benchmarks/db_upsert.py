@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from flask import Flask
+
+from proxytools.pool_models import (ProxyPool, init_database, update_proxies,
+                                    update_proxy)
+
+# Proxy updates written per second by the DB updater, one at a time as it
+# used to versus batched upserts, for new and for existing proxies. Needs a
+# MySQL database, preferably a scratch one: the pool table is created if
+# needed and the benchmark's proxies are deleted afterwards. Run from the
+# repository root:
+#   python -m benchmarks.db_upsert --db-name pgproxy_bench --db-user pgproxy
+#       --db-pass secret -n 5000
+
+# The benchmark's proxies, in TEST-NET-1.
+url_prefix = 'http://192.0.2.'
+
+
+# The updates of a validation run: the verdict of each proxy, then its new
+# status, with a latency for the working ones.
+def get_updates(count):
+    updates = []
+    for i in xrange(count):
+        url = '{}{}:{}'.format(url_prefix, i % 256, 1024 + i // 256)
+        working = i % 2 == 0
+        updates.append({
+            'url': url,
+            'last_checked': datetime.now(),
+            'last_check_stage': 'status',
+            'last_check_result': 0 if working else 3})
+        update = {
+            'url': url,
+            'working': working,
+            'banned': False,
+            'failed': not working,
+            'last_modified': datetime.now(),
+            '_latency': (0.05, 0.4) if working else None}
+        if working:
+            update['banned_retry_count'] = 0
+            update['failed_retry_count'] = 0
+        updates.append(update)
+    return updates
+
+
+def write_one_by_one(args, updates, db):
+    for data in updates:
+        update_proxy(args, data, db)
+
+
+def write_batched(args, updates, db):
+    for x in xrange(0, len(updates), args.db_batch_size):
+        update_proxies(args, updates[x:x+args.db_batch_size], db)
+
+
+def delete_proxies():
+    ProxyPool.delete().where(ProxyPool.url.startswith(url_prefix)).execute()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--proxies', default=5000, type=int)
+    parser.add_argument('--db-name', required=True)
+    parser.add_argument('--db-user', default='')
+    parser.add_argument('--db-pass', default='')
+    parser.add_argument('--db-host', default='localhost')
+    parser.add_argument('--db-port', default=3306, type=int)
+    parser.add_argument('--db-batch-size', default=200, type=int)
+    args = parser.parse_args()
+    args.db_max_connections = 5
+    args.log_db_updates = False
+
+    logging.basicConfig(level=logging.WARNING)
+
+    db = init_database(args, Flask(__name__))
+    updates = get_updates(args.proxies)
+
+    try:
+        for name, write in (('One by one', write_one_by_one),
+                            ('Batched', write_batched)):
+            delete_proxies()
+            for stage in ('new', 'existing'):
+                start = time.time()
+                write(args, updates, db)
+                elapsed = time.time() - start
+                print('{:<11} {:<9} {} updates in {:.2f}s, '
+                      '{:.0f} rows/s.'.format(
+                          name + ':', stage, len(updates), elapsed,
+                          len(updates) / elapsed))
+    finally:
+        delete_proxies()
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import time
+
+from proxytools.geoip import GeoIPIndex
+
+# Load time and lookup speed of the offline GeoIP index, on a generated
+# range file of realistic size (a DB1 country file has ~200k IPv4 ranges)
+# or on a real one. Run from the repository root:
+#   python -m benchmarks.geoip_lookup -n 1000000 [-f IP2LOCATION-LITE-DB1.CSV]
+
+countries = [('cn', 'china'), ('us', 'united states'), ('de', 'germany'),
+             ('br', 'brazil'), ('ru', 'russia'), ('id', 'indonesia'),
+             ('in', 'india'), ('fr', 'france')]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+# Write ranges covering the IPv4 space in the IP2Location DB1 format.
+def write_range_file(filename, num_ranges):
+    bounds = sorted(random.sample(xrange(1, 2 ** 32 - 1), num_ranges - 1))
+    bounds = [0] + bounds + [2 ** 32]
+    with open(filename, 'w') as f:
+        for i in xrange(num_ranges):
+            code, name = random.choice(countries)
+            f.write('"{}","{}","{}","{}"\n'.format(
+                bounds[i], bounds[i + 1] - 1, code.upper(), name.title()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--lookups', default=1000000, type=int)
+    parser.add_argument('-r', '--ranges', default=200000, type=int)
+    parser.add_argument('-f', '--file',
+                        help='Range file to use instead of a generated one.')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    temp_dir = None
+    filename = options.file
+    if not filename:
+        temp_dir = tempfile.mkdtemp()
+        filename = os.path.join(temp_dir, 'ranges.csv')
+        write_range_file(filename, options.ranges)
+
+    try:
+        start = time.time()
+        index = GeoIPIndex.load(filename)
+        load_time = time.time() - start
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    size = sum(a.itemsize * len(a)
+               for a in (index.starts, index.ends, index.country_ids))
+    print('Loaded {} ranges in {:.2f}s, {:.1f} MB of arrays.'.format(
+        len(index), load_time, size / 1048576.0))
+
+    ips = [int_to_ip(random.randint(0, 2 ** 32 - 1))
+           for i in xrange(options.lookups)]
+    proxies = ['socks5://{}:1080'.format(ip) for ip in ips[:100000]]
+
+    start = time.time()
+    for ip in ips:
+        index.lookup(ip)
+    elapsed = time.time() - start
+    print('{} IP lookups in {:.2f}s, {:.2f}us per lookup.'.format(
+        len(ips), elapsed, elapsed * 1000000 / len(ips)))
+
+    start = time.time()
+    for proxy in proxies:
+        index.get_country(proxy)
+    elapsed = time.time() - start
+    print('{} proxy URL lookups in {:.2f}s, {:.2f}us per lookup.'.format(
+        len(proxies), elapsed, elapsed * 1000000 / len(proxies)))
+
+
+if __name__ == '__main__':
+    main()
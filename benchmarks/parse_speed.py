@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import os
+import time
+
+from proxytools import proxy_scraper
+from proxytools.proxy_scraper import (extract, extract_premproxy,
+                                      extract_premproxy_soup,
+                                      get_premproxy_proxies,
+                                      parse_post_links,
+                                      parse_premproxy_free_pages,
+                                      parse_proxyserverlist24,
+                                      parse_sockslist,
+                                      parse_socksproxylist24,
+                                      parse_vipsocks24)
+
+# Parse time of the scraper's page parsers, with the fast extraction path
+# versus BeautifulSoup only, over the pages in benchmarks/corpus. The pages
+# are synthetic, modelled on the markup of each source. Run from the
+# repository root:
+#   python -m benchmarks.parse_speed -n 20
+
+corpus_path = os.path.join(os.path.dirname(__file__), 'corpus')
+
+
+def read_page(name):
+    with open(os.path.join(corpus_path, name)) as f:
+        return f.read()
+
+
+# The port map comes from a script we don't download here, give every CSS
+# class a port.
+def parse_premproxy_rows(html):
+    scripts, rows = extract(html, extract_premproxy, extract_premproxy_soup)
+    ports = dict((input['value'].split('|')[1], '8080')
+                 for country, input in rows if input)
+    return get_premproxy_proxies(rows, ports, [])
+
+
+def parse_premproxy_pages(html):
+    return parse_premproxy_free_pages('https://premproxy.com',
+                                      'https://premproxy.com/list/', html)
+
+
+parsers = [
+    ('sockslist.html', 'parse_sockslist', parse_sockslist),
+    ('socksproxylist24_index.html', 'parse_post_links', parse_post_links),
+    ('socksproxylist24_post.html', 'parse_socksproxylist24',
+     parse_socksproxylist24),
+    ('vipsocks24_index.html', 'parse_post_links', parse_post_links),
+    ('vipsocks24_post.html', 'parse_vipsocks24', parse_vipsocks24),
+    ('proxyserverlist24_index.html', 'parse_post_links', parse_post_links),
+    ('proxyserverlist24_post.html', 'parse_proxyserverlist24',
+     parse_proxyserverlist24),
+    ('premproxy_list.html', 'parse_premproxy_free_pages',
+     parse_premproxy_pages),
+    ('premproxy_list.html', 'parse_premproxy_free (rows)',
+     parse_premproxy_rows)
+]
+
+
+def time_parser(parse, html, iterations, fast):
+    proxy_scraper.fast_extraction = fast
+    start = time.time()
+    for i in xrange(iterations):
+        result = parse(html)
+    return (time.time() - start) / iterations, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', default=20, type=int)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    total_soup = 0
+    total_fast = 0
+    print('{:<30} {:<30} {:>6} {:>9} {:>9} {:>8}'.format(
+        'Page', 'Parser', 'Found', 'Soup', 'Fast', 'Speedup'))
+    for name, parser_name, parse in parsers:
+        html = read_page(name)
+        soup_time, soup_result = time_parser(parse, html, options.iterations,
+                                             False)
+        fast_time, fast_result = time_parser(parse, html, options.iterations,
+                                             True)
+        if fast_result != soup_result:
+            print('{}: results differ between the fast path and '
+                  'BeautifulSoup!'.format(name))
+
+        total_soup += soup_time
+        total_fast += fast_time
+        print('{:<30} {:<30} {:>6} {:>7.2f}ms {:>7.2f}ms {:>7.1f}x'.format(
+            name, parser_name, len(fast_result), soup_time * 1000,
+            fast_time * 1000, soup_time / fast_time))
+
+    print('{:<30} {:<30} {:>6} {:>7.2f}ms {:>7.2f}ms {:>7.1f}x'.format(
+        'Total', '', '', total_soup * 1000, total_fast * 1000,
+        total_soup / total_fast))
+
+
+if __name__ == '__main__':
+    main()
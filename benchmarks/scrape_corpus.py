@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import time
+
+from proxytools import proxy_scraper
+from proxytools.proxy_scraper import (ScriptCache,
+                                      get_session,
+                                      parse_premproxy_free,
+                                      parse_premproxy_free_pages,
+                                      parse_proxyserverlist24,
+                                      parse_proxyserverlist24_links,
+                                      parse_sockslist,
+                                      parse_socksproxylist24,
+                                      parse_socksproxylist24_links,
+                                      parse_vipsocks24,
+                                      parse_vipsocks24_links,
+                                      script_cache_ttl)
+from proxytools.scrape_sources import SourceRegistry
+
+from .stand_in import read_corpus_file, start_corpus_server, use_corpus_server
+
+# Throughput of each of the scraper's parsers over the corpus pages, in
+# pages and proxies per second, and the wall time of scraping every source
+# from the corpus server, all offline. Files the pages link to, like the
+# zipped vipsocks24 list and the premproxy port script, are downloaded from
+# the corpus server too. Run from the repository root:
+#   python -m benchmarks.scrape_corpus -n 20 -d 0.05
+
+premproxy_base_url = 'https://premproxy.com'
+
+
+def reset_script_cache():
+    proxy_scraper.script_cache = ScriptCache(script_cache_ttl)
+
+
+def parse_premproxy_pages(html):
+    return parse_premproxy_free_pages(premproxy_base_url,
+                                      premproxy_base_url + '/list/', html)
+
+
+# Downloads and unpacks the port script for every page.
+def parse_premproxy_cold(html):
+    reset_script_cache()
+    return parse_premproxy_free(premproxy_base_url, [], html)
+
+
+def parse_premproxy_warm(html):
+    return parse_premproxy_free(premproxy_base_url, [], html)
+
+
+parsers = [
+    ('sockslist.html', 'parse_sockslist', parse_sockslist),
+    ('socksproxylist24_index.html', 'parse_socksproxylist24_links',
+     parse_socksproxylist24_links),
+    ('socksproxylist24_post.html', 'parse_socksproxylist24',
+     parse_socksproxylist24),
+    ('vipsocks24_index.html', 'parse_vipsocks24_links',
+     parse_vipsocks24_links),
+    ('vipsocks24_post.html', 'parse_vipsocks24', parse_vipsocks24),
+    ('vipsocks24_zip_post.html', 'parse_vipsocks24 (zip)', parse_vipsocks24),
+    ('proxyserverlist24_index.html', 'parse_proxyserverlist24_links',
+     parse_proxyserverlist24_links),
+    ('proxyserverlist24_post.html', 'parse_proxyserverlist24',
+     parse_proxyserverlist24),
+    ('premproxy_list.html', 'parse_premproxy_free_pages',
+     parse_premproxy_pages),
+    ('premproxy_list.html', 'parse_premproxy_free (cold)',
+     parse_premproxy_cold),
+    ('premproxy_list.html', 'parse_premproxy_free (cached)',
+     parse_premproxy_warm)
+]
+
+
+def time_parser(parse, html, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        result = parse(html)
+    return time.time() - start, result
+
+
+# Scrape every source once, returns the wall time, the pages scraped and
+# the unique proxies found.
+def time_scrape():
+    reset_script_cache()
+    sources = SourceRegistry()
+    pages = 0
+    proxies = set()
+
+    start = time.time()
+    for url, scraped in sources.iter_scrape('all', []):
+        pages += 1
+        proxies.update(scraped)
+    return time.time() - start, pages, len(proxies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--iterations', default=20, type=int)
+    parser.add_argument('-d', '--delay', default=0.05, type=float,
+                        help='Server response time in seconds.')
+    parser.add_argument('-cd', '--connect-delay', default=0.05, type=float,
+                        help='Connection setup time in seconds.')
+    parser.add_argument('--soup', action='store_true',
+                        help='Parse every page with BeautifulSoup.')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    proxy_scraper.fast_extraction = not options.soup
+
+    # Parsers that download files shouldn't be slowed down by the server.
+    server = start_corpus_server()
+    use_corpus_server(server)
+
+    print('{:<30} {:<30} {:>7} {:>10} {:>12}'.format(
+        'Page', 'Parser', 'Proxies', 'Pages/s', 'Proxies/s'))
+    for name, parser_name, parse in parsers:
+        html = read_corpus_file(name)
+        elapsed, result = time_parser(parse, html, options.iterations)
+        print('{:<30} {:<30} {:>7} {:>10.1f} {:>12.0f}'.format(
+            name, parser_name, len(result), options.iterations / elapsed,
+            options.iterations * len(result) / elapsed))
+    server.shutdown()
+
+    server = start_corpus_server(options.delay, options.connect_delay)
+    use_corpus_server(server)
+    elapsed, pages, proxies = time_scrape()
+    print('Scraped {} pages ({} requests) and {} unique proxies from all '
+          'sources in {:.3f}s.'.format(pages, server.requests, proxies,
+                                       elapsed))
+
+    get_session().close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import time
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.packages.urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+
+from proxytools.proxy_scraper import (download_webpage, get_session,
+                                      scrape_workers)
+
+from .stand_in import start_page_server
+
+# Connections opened and time taken to download pages from the same host
+# with a new session per page, as the scraper used to, versus the shared
+# scraper session. Run from the repository root:
+#   python -m benchmarks.scrape_session -p 200 -d 0.01 -cd 0.05
+
+
+def download_new_session(url):
+    s = requests.Session()
+    retries = Retry(total=3,
+                    backoff_factor=0.5,
+                    status_forcelist=[500, 502, 503, 504])
+    s.mount('http://', HTTPAdapter(max_retries=retries))
+    r = s.get(url, timeout=5)
+    s.close()
+    if r.status_code == 200:
+        return r.content
+    return None
+
+
+def run(server, download, urls, workers):
+    server.connections = 0
+    start = time.time()
+    if workers > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            list(executor.map(download, urls))
+    else:
+        for url in urls:
+            download(url)
+    return time.time() - start, server.connections
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--pages', default=200, type=int)
+    parser.add_argument('-d', '--delay', default=0.01, type=float,
+                        help='Server response time in seconds.')
+    parser.add_argument('-cd', '--connect-delay', default=0.05, type=float,
+                        help='Connection setup time in seconds.')
+    parser.add_argument('-s', '--page-size', default=20000, type=int)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    server = start_page_server(options.delay, options.connect_delay,
+                               options.page_size)
+    url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    urls = [url + 'post/{}'.format(i) for i in range(options.pages)]
+
+    for workers in (1, scrape_workers):
+        for name, download in (('New session per page', download_new_session),
+                               ('Shared session', download_webpage)):
+            elapsed, connections = run(server, download, urls, workers)
+            print('{:<21} {:>2} threads: {:.3f}s, {:.1f}ms per page, '
+                  '{} connections.'.format(
+                      name + ':', workers, elapsed,
+                      elapsed * 1000 / options.pages, connections))
+
+    get_session().close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import re
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import BaseRequestHandler, ThreadingTCPServer
+from urllib import quote, unquote
+
+from requests.adapters import HTTPAdapter
+
+from proxytools import proxy_tester
+from proxytools.proxy_scraper import get_session, scrape_workers
+
+# Local stand-ins for proxies and the hosts they're tested against, so
+# benchmarks measure our own overhead instead of the network.
+
+azenv_body = ('REMOTE_ADDR = 203.0.113.1\n'
+              'HTTP_X_UNITY_VERSION = 2017.1.2f1\n'
+              'HTTP_USER_AGENT = pokemongo/0 CFNetwork/893.14.2 '
+              'Darwin/17.3.0\n')
+
+
+class ProxyHandler(BaseRequestHandler):
+
+    # Answers any plain HTTP request, proxied or not, with an AZenv page.
+    def handle(self):
+        data = ''
+        while '\r\n\r\n' not in data:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return
+            data += chunk
+
+        time.sleep(self.server.delay)
+        self.request.sendall(
+            'HTTP/1.1 200 OK\r\nContent-Length: {}\r\n'
+            'Connection: close\r\n\r\n{}'.format(len(azenv_body),
+                                                 azenv_body))
+
+
+class StandInServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+# Start a server acting both as HTTP proxy and as the host behind it, and
+# return its port. Responses are sent after delay seconds.
+def start_server(delay=0.0):
+    server = StandInServer(('127.0.0.1', 0), ProxyHandler)
+    server.delay = delay
+    thread = threading.Thread(target=server.serve_forever,
+                              name='stand-in-server')
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write, or kept-alive connections stall on
+    # delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    # Drop idle kept-alive connections.
+    timeout = 5
+
+    # Count the connections opened by clients, which take connect_delay
+    # seconds to set up like a TCP and TLS handshake with a remote site.
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+        time.sleep(self.server.connect_delay)
+
+    # Answers any path with a page of the configured size, keeping the
+    # connection open.
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', len(self.server.page))
+        self.end_headers()
+        self.wfile.write(self.server.page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Start a web server standing in for the proxy list sites, and return it.
+# The number of connections made to it is kept in server.connections.
+def start_page_server(delay=0.0, connect_delay=0.0, page_size=20000):
+    server = StandInServer(('127.0.0.1', 0), PageHandler)
+    server.delay = delay
+    server.connect_delay = connect_delay
+    server.page = 'x' * page_size
+    server.connections = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever,
+                              name='stand-in-pages')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+corpus_path = os.path.join(os.path.dirname(__file__), 'corpus')
+
+# The pages of benchmarks/corpus served for the URLs of each proxy list
+# source: (URL pattern, file, content type). The first vipsocks24 post only
+# links to a zipped list.
+corpus_routes = [
+    (r'https://sockslist\.net/list/proxy-socks-5-list(/\d+)?(#.*)?$',
+     'sockslist.html', 'text/html'),
+    (r'http://(www\.)?socksproxylist24\.top/?$',
+     'socksproxylist24_index.html', 'text/html'),
+    (r'http://(www\.)?socksproxylist24\.top/\d{4}/\d{2}/',
+     'socksproxylist24_post.html', 'text/html'),
+    (r'http://vipsocks24\.net/?$', 'vipsocks24_index.html', 'text/html'),
+    (r'http://vipsocks24\.net/\d{4}/\d{2}/.*-0\.html$',
+     'vipsocks24_zip_post.html', 'text/html'),
+    (r'http://vipsocks24\.net/\d{4}/\d{2}/', 'vipsocks24_post.html',
+     'text/html'),
+    (r'http://vipsocks24\.net/download/.*\.zip$', 'vipsocks24_list.zip',
+     'application/zip'),
+    (r'http://proxyserverlist24\.top/?$', 'proxyserverlist24_index.html',
+     'text/html'),
+    (r'http://proxyserverlist24\.top/\d{4}/\d{2}/',
+     'proxyserverlist24_post.html', 'text/html'),
+    (r'https://premproxy\.com/list/(\d{2}\.htm)?$', 'premproxy_list.html',
+     'text/html'),
+    (r'https://premproxy\.com/js-socks/.*\.js$', 'premproxy_ports.js',
+     'application/javascript')
+]
+
+
+def read_corpus_file(name):
+    with open(os.path.join(corpus_path, name), 'rb') as f:
+        return f.read()
+
+
+class CorpusHandler(PageHandler):
+
+    # Answers with the corpus file routed for the URL in the path, as sent
+    # by CorpusAdapter.
+    def do_GET(self):
+        url = unquote(self.path[1:])
+        status = 404
+        content = 'Not found: {}'.format(url)
+        content_type = 'text/plain'
+        for pattern, page, page_type in self.server.routes:
+            if pattern.match(url):
+                status, content, content_type = 200, page, page_type
+                break
+
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.delay)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# Start a web server answering for all the proxy list sites with the pages
+# of the corpus, and return it. The number of requests served is kept in
+# server.requests.
+def start_corpus_server(delay=0.0, connect_delay=0.0):
+    server = StandInServer(('127.0.0.1', 0), CorpusHandler)
+    server.delay = delay
+    server.connect_delay = connect_delay
+    server.routes = [(re.compile(pattern), read_corpus_file(name),
+                      content_type)
+                     for pattern, name, content_type in corpus_routes]
+    server.connections = 0
+    server.requests = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever,
+                              name='stand-in-corpus')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# Sends every request to the corpus server instead, with the original URL
+# in the path.
+class CorpusAdapter(HTTPAdapter):
+
+    def __init__(self, port, **kwargs):
+        self.server_url = 'http://127.0.0.1:{}/'.format(port)
+        super(CorpusAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = self.server_url + quote(request.url, safe='')
+        return super(CorpusAdapter, self).send(request, **kwargs)
+
+
+# Route the scraper's requests, to any site, to the corpus server.
+def use_corpus_server(server):
+    adapter = CorpusAdapter(server.server_address[1],
+                            pool_connections=scrape_workers,
+                            pool_maxsize=scrape_workers)
+    session = get_session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+# Point the PTC/Niantic tests at the stand-in server.
+def use_stand_in_hosts(port):
+    url = 'http://127.0.0.1:{}/'.format(port)
+    proxy_tester.proxy_test_login_url = url + 'login'
+    proxy_tester.proxy_test_niantic_url = url + 'niantic'
+    proxy_tester.proxy_test_ptc_url = url + 'ptc'
+    return url
+
+
+# Tester arguments, as parsed by check_utils/pool_utils.
+def get_tester_args(judge_url, **kwargs):
+    args = argparse.Namespace(
+        engine='futures',
+        max_concurrency=50,
+        adaptive_concurrency=False,
+        retries=0,
+        backoff_factor=0.25,
+        timeout=5,
+        proxy_judge=judge_url,
+        local_ip='127.0.0.1',
+        no_anonymous=False,
+        extra_request=False,
+        verbose=False)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
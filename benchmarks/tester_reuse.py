@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import threading
+import time
+
+from proxytools.proxy_tester import ProxyTester, check_proxies
+
+from .stand_in import get_tester_args, start_server, use_stand_in_hosts
+
+# Per-batch overhead of proxy testing with a new tester (sessions, thread
+# pools, event loop) for every batch, versus one tester reused by all of
+# them. Run from the repository root:
+#   python -m benchmarks.tester_reuse -e futures -b 50 -bs 10
+
+
+def run_batches(args, batches, tester=None):
+    start = time.time()
+    for batch in batches:
+        check_proxies(args, batch, False, tester)
+    return time.time() - start
+
+
+# Threads still running once the stand-in server is done answering.
+def count_threads():
+    time.sleep(1)
+    return threading.active_count()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--engine', default='futures',
+                        choices=('futures', 'eventloop'))
+    parser.add_argument('-b', '--batches', default=50, type=int)
+    parser.add_argument('-bs', '--batch-size', default=10, type=int)
+    parser.add_argument('-mc', '--max-concurrency', default=50, type=int)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    port = start_server()
+    url = use_stand_in_hosts(port)
+    args = get_tester_args(url, engine=options.engine,
+                           max_concurrency=options.max_concurrency)
+
+    proxy = 'http://127.0.0.1:{}'.format(port)
+    batches = [[proxy] * options.batch_size] * options.batches
+
+    threads = count_threads()
+    elapsed = run_batches(args, batches)
+    print('New tester per batch:  {:.3f}s, {:.1f}ms per batch, '
+          '{} threads left behind.'.format(
+              elapsed, elapsed * 1000 / options.batches,
+              count_threads() - threads))
+
+    threads = count_threads()
+    with ProxyTester(args) as tester:
+        elapsed = run_batches(args, batches, tester)
+    print('Reused tester:         {:.3f}s, {:.1f}ms per batch, '
+          '{} threads left behind.'.format(
+              elapsed, elapsed * 1000 / options.batches,
+              count_threads() - threads))
+
+
+if __name__ == '__main__':
+    main()
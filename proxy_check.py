@@ -2,18 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
 import logging
+from multiprocessing import Event, Process, Queue
+from Queue import Empty
+from threading import current_thread
 
-from proxytools.proxy_tester import check_proxies, get_local_ip
+from proxytools.proxy_tester import (ProxyTester,
+                                     check_result_ok,
+                                     iter_check_proxies,
+                                     get_local_ip,
+                                     prescreen_proxies)
+from proxytools.geoip import filter_countries
+from proxytools.page_cache import PageCache
+from proxytools.post_index import PostIndex
+from proxytools.scrape_sources import (SourceRegistry,
+                                       iter_scraped_proxies)
 from proxytools.shared_utils import get_country_from_ip, load_proxies
-from proxytools.proxy_scraper import (scrape_sockslist_net,
-                                      scrape_vipsocks24_net,
-                                      scrape_proxyserverlist24_top,
-                                      scrape_socksproxylist24_top,
-                                      scrape_premproxy_free)
+from proxytools.verdict_cache import FileVerdictCache, get_ttls
 from proxytools import check_utils
 from proxytools import shared_utils
 
+# Messages sent by the shard processes.
+shard_working = 'working'
+shard_verdict = 'verdict'
+shard_batch_done = 'batch_done'
+shard_idle = 'idle'
+shard_done = 'done'
+
 logging.getLogger("requests").setLevel(logging.CRITICAL)
 logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 logging.basicConfig(
@@ -23,33 +39,72 @@ log = logging.getLogger('pgproxy')
 
 
 def work_cycle(args):
-    proxies = set()
+    sources = None
+    page_cache = None
+    post_index = None
     if args.proxy_file:
         log.info('Loading proxies from file: %s', args.proxy_file)
         proxylist = load_proxies(args.proxy_file, args.mode)
 
         if len(proxylist) > 0:
-            proxies.update(proxylist)
+            batches = [list(set(proxylist))]
         else:
             log.error('Proxy file was configured but no proxies were loaded.')
             sys.exit(1)
     else:
         if args.mode == 'http':
             log.info('Scraping HTTP proxies...')
-            proxies.update(scrape_proxyserverlist24_top())
-            proxies.update(scrape_premproxy_free(args.ignore_country))
         else:
             log.info('Scraping SOCKS5 proxies...')
-            proxies.update(scrape_sockslist_net(args.ignore_country))
-            proxies.update(scrape_vipsocks24_net())
-            proxies.update(scrape_socksproxylist24_top())
+        sources = SourceRegistry()
+
+        if args.page_cache_file:
+            page_cache = PageCache(args.page_cache_file)
+
+        if args.post_index_file:
+            post_index = PostIndex(args.post_index_file,
+                                   args.post_freshness * 60)
 
-    proxies = list(proxies)
+        # Proxies are tested while the other pages are still scraped.
+        batches = iter_scraped_proxies(sources, args.mode,
+                                       args.ignore_country, page_cache,
+                                       post_index)
 
-    if args.no_test:
-        output(args, proxies)
-        return
+    working_proxies = []
+    try:
+        if args.no_test:
+            proxies = []
+            for batch in batches:
+                proxies.extend(batch)
+
+            proxies = filter_countries(args, proxies)
+            if args.prescreen:
+                proxies = prescreen_proxies(args, proxies)
+            output(args, proxies)
+        else:
+            check_batches(args, batches, working_proxies, sources)
+    finally:
+        if sources:
+            # Stop scraping once the limit is reached.
+            batches.close()
+            if page_cache:
+                page_cache.log_stats()
+                page_cache.save()
+            if post_index:
+                post_index.log_stats()
+                post_index.save()
 
+    # Report what each source contributed.
+    if sources:
+        for proxy in working_proxies:
+            sources.record_working(proxy)
+        sources.end_cycle()
+
+
+# Check the proxies of each batch as it comes, until the limit of working
+# proxies is reached. The working proxies are added to working_proxies. The
+# batches are reported as tested to the scrape sources if set.
+def check_batches(args, batches, working_proxies, sources=None):
     args.local_ip = None
     if not args.no_anonymous:
         local_ip = get_local_ip(args.proxy_judge)
@@ -61,47 +116,221 @@ def work_cycle(args):
         log.info('Local IP address: %s', local_ip)
         args.local_ip = local_ip
 
-    log.info('Found a total of %d proxies. Starting tests...', len(proxies))
+    cache = None
+    if args.cache_file:
+        cache = FileVerdictCache(args.cache_file, get_ttls(args))
+
+    # Sessions and event loop, or the shard processes, are reused by the
+    # batches tested here.
+    tester = None
+    shards = None
+    if args.processes <= 1:
+        tester = ProxyTester(args, cache)
+    else:
+        shards = ShardPool(args, cache)
+
+    try:
+        for batch in batches:
+            proxies = filter_countries(args, batch)
+            if args.prescreen:
+                proxies = prescreen_proxies(args, proxies)
+
+            if proxies:
+                log.info('Found %d new proxies. Starting tests...',
+                         len(proxies))
+                if tester:
+                    check(args, proxies, tester, working_proxies)
+                else:
+                    shards.check(proxies, working_proxies)
+
+            # Batches the tests didn't get to aren't counted.
+            if sources:
+                sources.record_tested(batch)
+
+            if len(working_proxies) >= args.limit:
+                log.info('Stopping tests, limit reached: %d >= %d',
+                         len(working_proxies), args.limit)
+                break
+    finally:
+        if tester:
+            tester.close()
+        if shards:
+            shards.close()
+        if cache:
+            cache.log_stats()
+            cache.save()
+
+    output(args, working_proxies)
+
+
+# Check proxies in this process, writing the output after every batch.
+def check(args, proxies, tester, working_proxies):
+    for proxy in iter_working_proxies(args, proxies, tester):
+        if proxy is None:
+            # Output all the working proxies until the limit is reached.
+            output(args, working_proxies)
+            continue
+
+        working_proxies.append(proxy)
+        if len(working_proxies) >= args.limit:
+            break
+
+
+# Check proxies in batches and yield the working ones from countries we
+# don't ignore, with None at the end of each batch.
+def iter_working_proxies(args, proxies, tester):
+    chunks = [proxies]
     if args.batch_size > 0:
         chunks = [proxies[x:x+args.batch_size]
                   for x in xrange(0, len(proxies), args.batch_size)]
-        working_proxies = []
-        for chunk in chunks:
-            working, banned, failed = check_proxies(args, chunk, False)
 
-            for proxy in working:
+    for chunk in chunks:
+        results = iter_check_proxies(args, chunk, False, tester)
+        try:
+            for proxy, error, result, timings in results:
+                if result != check_result_ok:
+                    continue
 
-                # Now that the IP is validated, let's check the country.
-                country = get_country_from_ip(args.geoip_url, proxy)
+                # Now that the IP is validated, let's check the country,
+                # unless the pre-filter already did.
+                country = None
+                if not args.geoip_file:
+                    country = get_country_from_ip(args.geoip_url, proxy)
                 if country in args.ignore_country:
                     log.info('Skipping proxy from country: {} for {}'
                              .format(proxy, country))
                     continue
 
-                # If still here, add the proxy.
-                working_proxies.append(proxy)
+                yield proxy
+        finally:
+            # Stop the tests still running for this chunk.
+            results.close()
 
-            # Output all the working proxies until the limit is reached.
-            output(args, working_proxies)
-            if len(working_proxies) >= args.limit:
+        yield None
+
+
+# Runs in a shard process: check the proxies sent on its work queue and
+# send back the working ones, until it gets None or is told to stop. The
+# tester is reused by every batch. New results in the verdict cache are sent
+# back as well, it's only saved by the main process.
+def check_shard(args, index, work, queue, stop, cache):
+    current_thread().name = 'shard-{}'.format(index)
+    if cache:
+        cache.listeners.append(
+            lambda proxy, entry: queue.put((shard_verdict, (proxy, entry))))
+
+    tester = ProxyTester(args, cache)
+    try:
+        while not stop.is_set():
+            proxies = work.get()
+            if proxies is None:
                 break
-    else:
-        working_proxies = []
-        working, banned, failed = check_proxies(args, chunk, False)
-        for proxy in working:
-
-            # Now that the IP is validated, let's check the country.
-            country = get_country_from_ip(args.geoip_url, proxy)
-            if country in args.ignore_country:
-                log.info('Skipping proxy from country: {} for {}'
-                         .format(proxy, country))
-                continue
-
-            # If still here, add the proxy.
-            working_proxies.append(proxy)
-
-        # Output all the working proxies.
-        output(args, working_proxies)
+
+            working = iter_working_proxies(args, proxies, tester)
+            try:
+                for proxy in working:
+                    if stop.is_set():
+                        break
+                    if proxy is None:
+                        queue.put((shard_batch_done, None))
+                    else:
+                        queue.put((shard_working, proxy))
+            except Exception as e:
+                log.exception('Exception checking proxies: %s', repr(e))
+            finally:
+                working.close()
+                queue.put((shard_idle, None))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tester.close()
+        stats = None
+        if cache:
+            stats = (cache.hits, cache.misses)
+        queue.put((shard_done, stats))
+
+
+# Shard processes, each running its own tests, started once and kept
+# running across batches. The proxies of a batch are split across them.
+# Call close() when done.
+class ShardPool(object):
+
+    def __init__(self, args, cache):
+        self.args = args
+        self.cache = cache
+        self.queue = Queue()
+        self.stop = Event()
+        self.work = []
+        self.shards = []
+        # Shards still running, and those still testing the current batch.
+        self.running = 0
+        self.busy = 0
+
+        log.info('Checking proxies in %d processes.', args.processes)
+        for index in range(args.processes):
+            work = Queue()
+            shard = Process(target=check_shard, name='shard-{}'.format(index),
+                            args=(args, index, work, self.queue, self.stop,
+                                  cache))
+            shard.daemon = True
+            shard.start()
+            self.work.append(work)
+            self.shards.append(shard)
+        self.running = len(self.shards)
+
+    # Check a batch of proxies. The working proxies are added to
+    # working_proxies, up to the limit across all shards.
+    def check(self, proxies, working_proxies):
+        for index, work in enumerate(self.work):
+            shard_proxies = proxies[index::len(self.work)]
+            if shard_proxies:
+                work.put(shard_proxies)
+                self.busy += 1
+
+        while self.busy and len(working_proxies) < self.args.limit:
+            try:
+                self._receive(working_proxies, 1)
+            except Empty:
+                if not all(shard.is_alive() for shard in self.shards):
+                    log.error('A shard process exited, stopping tests.')
+                    break
+
+    def _receive(self, working_proxies, timeout):
+        message, data = self.queue.get(timeout=timeout)
+        if message == shard_done:
+            self.running -= 1
+            if data:
+                self.cache.hits += data[0]
+                self.cache.misses += data[1]
+        elif message == shard_idle:
+            self.busy -= 1
+        elif message == shard_verdict:
+            self.cache.store(*data)
+        elif message == shard_batch_done:
+            output(self.args, working_proxies)
+        elif len(working_proxies) < self.args.limit:
+            working_proxies.append(data)
+
+    def close(self):
+        if self.running:
+            log.info('Stopping tests in %d processes.', self.running)
+        self.stop.set()
+        for work in self.work:
+            work.put(None)
+
+        # Shards only see the stop flag between results, give them a moment
+        # to wrap up. Keep reading so none blocks on a full queue.
+        deadline = time.time() + 5
+        while self.running and time.time() < deadline:
+            try:
+                self._receive([], max(0, deadline - time.time()))
+            except Empty:
+                break
+
+        for shard in self.shards:
+            if shard.is_alive():
+                shard.terminate()
+            shard.join()
 
 
 def output(args, proxies):
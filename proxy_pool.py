@@ -5,19 +5,30 @@ import sys
 import json
 import time
 import logging
-from Queue import Queue
 from threading import Thread
 from datetime import datetime
 
 from flask import Flask, request, jsonify
 
 from proxytools import pool_utils
-from proxytools.proxy_tester import check_proxies, get_local_ip
-from proxytools.shared_utils import (get_country_from_ip,
-                                     load_proxies,
-                                     parse_bool)
+from proxytools.proxy_tester import (ProxyTester,
+                                     check_result_ok,
+                                     check_result_banned,
+                                     iter_check_proxies,
+                                     get_latency,
+                                     get_local_ip,
+                                     prescreen_proxies)
+from proxytools.geoip import CountryCache, filter_countries
+from proxytools.page_cache import PageCache
+from proxytools.post_index import PostIndex
+from proxytools.scrape_sources import (SourceRegistry,
+                                       iter_scraped_proxies)
+from proxytools.shared_utils import load_proxies, parse_bool
+from proxytools.update_queue import CoalescingQueue
+from proxytools.verdict_cache import get_ttls
 from proxytools.pool_models import (init_database,
                                     db_updater,
+                                    PoolVerdictCache,
                                     add_proxy_direct,
                                     working_proxy_count,
                                     get_all_proxies,
@@ -25,11 +36,6 @@ from proxytools.pool_models import (init_database,
                                     get_filtered_proxies,
                                     purge_invalid_proxies,
                                     flaskDb)
-from proxytools.proxy_scraper import (scrape_sockslist_net,
-                                      scrape_vipsocks24_net,
-                                      scrape_proxyserverlist24_top,
-                                      scrape_socksproxylist24_top,
-                                      scrape_premproxy_free)
 
 
 # Reduce noise from logs
@@ -52,6 +58,10 @@ stats_conditions = [
     ("Invalid", "invalid = 1")
 ]
 
+# Working proxies are imported in groups of this size, their countries are
+# looked up concurrently.
+geoip_batch_size = 10
+
 # ---------------------------------------------------------------------------
 
 app = Flask(__name__)
@@ -74,7 +84,15 @@ def get_status():
             10px; border: 1px solid #ddd; }
         table { border-collapse: collapse }
         td { text-align:center }</style>"""
-    lines += "DB Queue Size: {} <br><br>".format(db_updates_queue.qsize())
+    lines += "DB Queue Size: {}, coalesced updates: {} of {} <br><br>".format(
+        db_updates_queue.qsize(), db_updates_queue.coalesced,
+        db_updates_queue.updates)
+
+    if country_cache:
+        hit_rate = country_cache.hit_rate()
+        lines += "GeoIP Cache: {} entries, hit rate: {} <br><br>".format(
+            len(country_cache),
+            'n/a' if hit_rate is None else '{:.1f}%'.format(hit_rate))
 
     lines += "<table>"
 
@@ -111,6 +129,28 @@ def get_status():
     lines += "<td>{}</td>".format(total_count)
     lines += "</tr>"
     lines += "</table>"
+    lines += "<br>"
+
+    # What each source yielded in its last run.
+    lines += "<table>"
+    lines += ("<th>Source</th><th>Type</th><th>Runs</th><th>Pages</th>"
+              "<th>Scraped</th><th>New</th><th>Tested</th><th>Working</th>"
+              "<th>Scrape Time</th><th>Total New</th><th>Total Working</th>"
+              "<th>Yield</th><th>Every</th>")
+    for source in scrape_sources.sources:
+        lines += "<tr>"
+        lines += "<td>{}</td><td>{}</td><td>{}</td>".format(
+            source.name, source.protocol, source.runs)
+        lines += "<td>{}</td><td>{}</td><td>{}</td><td>{}</td>".format(
+            source.pages, source.scraped, source.new, source.tested)
+        lines += "<td>{}</td>".format(source.working)
+        lines += "<td>{:.1f}s</td><td>{}</td><td>{}</td>".format(
+            source.scrape_time, source.total_new, source.total_working)
+        lines += "<td>{}</td><td>{} cycles</td>".format(
+            'n/a' if source.yield_score is None
+            else '{:.1f}'.format(source.yield_score), source.interval)
+        lines += "</tr>"
+    lines += "</table>"
 
     return lines
 
@@ -149,10 +189,16 @@ def get_proxy_batch():
     failed = parse_bool(request.args.get('failed'))
     invalid = parse_bool(request.args.get('invalid'))
 
+    # Fastest proxies first, optionally only up to max_latency seconds.
+    sort = request.args.get('sort')
+    max_latency = request.args.get('max_latency', type=float)
+    limit = request.args.get('limit', type=int)
+
     if not banned and not failed and not invalid:
         working = True
 
-    proxies = get_filtered_proxies(working, banned, failed, invalid)
+    proxies = get_filtered_proxies(working, banned, failed, invalid,
+                                   sort, max_latency, limit)
 
     if format == 'txt':
         page = ''
@@ -274,8 +320,22 @@ def import_proxies():
 def check_and_import_proxies(proxies, import_all_types,
                              capture_failed_anon, ignore_limit):
 
-    log.info('Found a total of %d proxies. Starting tests...', len(proxies))
+    set_local_ip()
 
+    limit = None if ignore_limit else args.limit
+    test_and_import_proxies(proxies, import_all_types, capture_failed_anon,
+                            limit)
+
+    if verdict_cache:
+        verdict_cache.log_stats()
+    if country_cache:
+        country_cache.save()
+
+    # Now log a status of everything in DB.
+    log_proxy_status()
+
+
+def set_local_ip():
     args.local_ip = None
     if not args.no_anonymous:
         local_ip = get_local_ip(args.proxy_judge)
@@ -288,88 +348,126 @@ def check_and_import_proxies(proxies, import_all_types,
             'Using local IP address to test for anonymous: %s', local_ip)
         args.local_ip = local_ip
 
+
+# Test proxies and import the working ones, until limit working proxies were
+# imported if set. Returns how many were imported.
+def test_and_import_proxies(proxies, import_all_types, capture_failed_anon,
+                            limit):
+
+    # Scraped proxies count as tested for their source once they're done
+    # with, so its yield isn't skewed when the tests stop at the limit.
+    kept = filter_countries(args, proxies)
+    scrape_sources.record_tested(set(proxies).difference(kept))
+    proxies = kept
+
+    log.info('Found a total of %d proxies. Starting tests...', len(proxies))
+
+    if args.prescreen:
+        passed = prescreen_proxies(args, proxies)
+        failed = set(proxies).difference(passed)
+        scrape_sources.record_tested(failed)
+
+        # Proxies we can't even connect to are failed.
+        if import_all_types:
+            for proxy in failed:
+                update_proxy_status(proxy, False, False, True)
+
+        proxies = passed
+
+    chunks = [proxies]
     if args.batch_size > 0:
         chunks = [proxies[x:x+args.batch_size]
                   for x in xrange(0, len(proxies), args.batch_size)]
 
-        batch_count = 0
-        working_count = 0
-        num_chunks = len(chunks)
-
         log.info('Using {} chunks of {}'
-                 .format(num_chunks, args.batch_size))
+                 .format(len(chunks), args.batch_size))
+
+    batch_count = 0
+    working_count = 0
+    num_chunks = len(chunks)
 
-        for chunk in chunks:
+    for chunk in chunks:
 
-            batch_count += 1
+        batch_count += 1
+        if args.batch_size > 0:
             log.info('Starting batch {} of {}. Working: {}'
                      .format(batch_count, num_chunks, working_count))
 
-            working_proxies, banned_proxies, failed_proxies = check_proxies(
-                args, chunk, capture_failed_anon)
+        # Results are streamed as each proxy finishes, so DB updates and
+        # geo lookups overlap with the tests still running.
+        results = iter_check_proxies(args, chunk, capture_failed_anon,
+                                     proxy_tester)
+        working = []
 
-            for proxy in working_proxies:
+        for proxy, error, result, timings in results:
 
-                # Now that the IP is validated, let's check the country.
-                country = get_country_from_ip(args.geoip_url, proxy)
-                if country in args.ignore_country:
-                    log.info('Skipping proxy from country: {} for {}'
-                             .format(proxy, country))
-                    continue
+            scrape_sources.record_tested([proxy])
+            if result == check_result_ok:
 
-                # If still ok, update it now (creates if new)
-                update_proxy_status(proxy, True, False, False)
+                working.append((proxy, get_latency(timings)))
+                if len(working) >= geoip_batch_size:
+                    working_count += import_working_proxies(working)
+                    working = []
 
                 # If we've reached the limit of working proxies, break out.
-                working_count += 1
-                if not ignore_limit and working_count >= args.limit:
+                if limit and working_count + len(working) >= limit:
                     break
 
             # If requested, import all other result types.
-            if import_all_types:
-                for proxy in banned_proxies:
+            elif import_all_types:
+                if result == check_result_banned:
                     update_proxy_status(proxy, False, True, False)
-
-                for proxy in failed_proxies:
+                else:
                     update_proxy_status(proxy, False, False, True)
 
-            # Second check for limit to break out of chunk loop.
-            if not ignore_limit and working_count >= args.limit:
-                log.info(
-                    'Stopping tests, Limit reached: {} >= {}'
-                    .format(working_count, args.limit))
-                break
+        # Stop the tests still running for this chunk.
+        results.close()
+        working_count += import_working_proxies(working)
 
-    else:
-        working_proxies, banned_proxies, failed_proxies = check_proxies(
-            args, proxies, capture_failed_anon)
+        # Second check for limit to break out of chunk loop.
+        if limit and working_count >= limit:
+            log.info(
+                'Stopping tests, Limit reached: {} >= {}'
+                .format(working_count, limit))
+            break
 
-        for proxy in working_proxies:
+    return working_count
 
-            # Now that the IP is validated, let's check the country.
-            country = get_country_from_ip(args.geoip_url, proxy)
-            if country in args.ignore_country:
-                log.info('Skipping proxy from country: {} for {}'
-                         .format(proxy, country))
-                continue
 
-            # If still here, add the proxy.
-            update_proxy_status(proxy, True, False, False)
+# Import working proxies from countries we don't ignore, and return how many
+# were imported.
+def import_working_proxies(working):
+    if not working:
+        return 0
 
-        if import_all_types:
-            for proxy in banned_proxies:
-                update_proxy_status(proxy, False, True, False)
-            for proxy in failed_proxies:
-                update_proxy_status(proxy, False, False, True)
+    # Now that the IPs are validated, let's check the countries, unless the
+    # pre-filter already did.
+    countries = {}
+    if country_cache:
+        countries = country_cache.get_countries(
+            [proxy for proxy, latency in working])
 
-    # Now log a status of everything in DB.
-    log_proxy_status()
+    count = 0
+    for proxy, latency in working:
+        country = countries.get(proxy)
+        if country in args.ignore_country:
+            log.info('Skipping proxy from country: {} for {}'
+                     .format(proxy, country))
+            continue
+
+        # If still ok, update it now (creates if new)
+        update_proxy_status(proxy, True, False, False, latency)
+        scrape_sources.record_working(proxy)
+        count += 1
+
+    return count
 
 
 def log_proxy_status():
 
     # Wait until the DB is finished updating.
     wait_db_updates()
+    db_updates_queue.log_stats()
 
     # Now pull out the status for everything.
     total_count = 0
@@ -391,10 +489,10 @@ def log_proxy_status():
     log.info(lines.format(total_count))
 
 
-def update_proxy_status(url, working, banned, failed):
+def update_proxy_status(url, working, banned, failed, latency=None):
 
     if args.proxy_file:
-        add_proxy_direct(url, working, banned, failed)
+        add_proxy_direct(url, working, banned, failed, latency)
         log.info(
             "add_proxy_direct for {}. working: {}, failed: {}, banned: {}"
             .format(url, working, failed, banned))
@@ -406,11 +504,18 @@ def update_proxy_status(url, working, banned, failed):
         proxy['failed'] = failed
         proxy['last_modified'] = datetime.now()
 
+        # Smoothed with the stored latency by the DB updater.
+        proxy['_latency'] = latency
+
         # Reset their retry counts back to 0 if currently working.
         if working:
             proxy['banned_retry_count'] = 0
             proxy['failed_retry_count'] = 0
 
+        # New proxies don't get the check result written on its own.
+        if verdict_cache:
+            proxy.update(verdict_cache.get_update(url))
+
         db_updates_queue.put(proxy)
         if args.log_proxy_updates:
             log.info(
@@ -547,19 +652,6 @@ def validate_all_proxies():
 # Scraping Methods
 # ---------------------------------------------------------------------------
 
-def scrape_http(proxies):
-    log.info('Scraping HTTP proxies...')
-    proxies.update(scrape_proxyserverlist24_top())
-    proxies.update(scrape_premproxy_free(args.ignore_country))
-
-
-def scrape_socks(proxies):
-    log.info('Scraping SOCKS5 proxies...')
-    proxies.update(scrape_sockslist_net(args.ignore_country))
-    proxies.update(scrape_vipsocks24_net())
-    proxies.update(scrape_socksproxylist24_top())
-
-
 def scrape_proxies():
 
     # Check to see if we have at least the minimum proxies wanted.
@@ -578,20 +670,43 @@ def scrape_proxies():
 
     log.info('Scraping for new proxies...')
 
-    proxies = set()
-
-    if args.mode == 'http':
-        scrape_http(proxies)
-    elif args.mode == 'socks':
-        scrape_socks(proxies)
-    else:
-        scrape_http(proxies)
-        scrape_socks(proxies)
-
-    proxies = list(proxies)
+    # All the due sources are scraped at the same time.
+    if args.mode in ('all', 'http'):
+        log.info('Scraping HTTP proxies...')
+    if args.mode in ('all', 'socks'):
+        log.info('Scraping SOCKS5 proxies...')
+
+    set_local_ip()
+
+    # Validate the proxies as they're scraped, until the limit is reached.
+    batches = iter_scraped_proxies(scrape_sources, args.mode,
+                                   args.ignore_country, page_cache, post_index)
+    imported = 0
+    try:
+        for proxies in batches:
+            imported += test_and_import_proxies(proxies, False, False,
+                                                args.limit - imported)
+            if imported >= args.limit:
+                log.info('Stopping scraping, limit reached: %d >= %d',
+                         imported, args.limit)
+                break
+    finally:
+        batches.close()
+        if page_cache:
+            page_cache.log_stats()
+            page_cache.save()
+        if post_index:
+            post_index.log_stats()
+            post_index.save()
+        scrape_sources.end_cycle()
+
+    if verdict_cache:
+        verdict_cache.log_stats()
+    if country_cache:
+        country_cache.save()
 
-    # Validate all the obtained proxies.
-    check_and_import_proxies(proxies, False, False, False)
+    # Now log a status of everything in DB.
+    log_proxy_status()
 
 
 # ---------------------------------------------------------------------------
@@ -685,8 +800,37 @@ args = pool_utils.get_args()
 # Initialize the database.
 db = init_database(args, app)
 
-# DB Updates queue.
-db_updates_queue = Queue()
+# DB Updates queue, merging the updates of each proxy until written.
+db_updates_queue = CoalescingQueue()
+
+# Recent proxy results, so proxies aren't tested again too soon.
+verdict_cache = PoolVerdictCache(get_ttls(args), db_updates_queue)
+if not verdict_cache.enabled():
+    verdict_cache = None
+
+# Countries of working proxies found with the GeoIP web service, unless
+# countries are looked up in a local file.
+country_cache = None
+if not args.geoip_file:
+    country_cache = CountryCache(args.geoip_url, args.geoip_cache_size,
+                                 args.geoip_cache_ttl * 60,
+                                 args.geoip_cache_file)
+
+# Scraped webpages, so unchanged ones aren't parsed again.
+page_cache = None
+if args.page_cache_file:
+    page_cache = PageCache(args.page_cache_file)
+
+# Posts harvested from each proxy list blog, so only new ones are scraped.
+post_index = None
+if args.post_index_file:
+    post_index = PostIndex(args.post_index_file, args.post_freshness * 60)
+
+# Proxy sources, scheduled by how many working proxies they yield.
+scrape_sources = SourceRegistry()
+
+# Request sessions and event loop, reused by every proxy test.
+proxy_tester = ProxyTester(args, verdict_cache)
 
 # Set the logging level.
 log.setLevel(logging.INFO)
@@ -695,4 +839,9 @@ if args.verbose:
     log.debug('Running in verbose mode (-v).')
 
 # Start up everything.
-initialize()
+try:
+    initialize()
+finally:
+    proxy_tester.close()
+    if country_cache:
+        country_cache.save()
@@ -0,0 +1,407 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import errno
+import logging
+import os
+import socket
+import ssl
+import struct
+import time
+import zlib
+from base64 import b64encode
+from urlparse import urlsplit
+
+from .event_loop import Return, WaitRead, WaitWrite, WaitTimeout
+
+log = logging.getLogger('pgproxy')
+
+# Minimal non-blocking HTTP client used by the event loop proxy tester.
+# Supports HTTP (plain and CONNECT tunnel), SOCKS4(a) and SOCKS5(h) proxies.
+
+
+# Request exceptions, mirroring the classes raised by requests so results
+# can be classified the same way.
+class RequestError(Exception):
+    pass
+
+
+class ConnectTimeout(RequestError):
+    pass
+
+
+class ProxyConnectionError(RequestError):
+    pass
+
+
+class ReadTimeout(RequestError):
+    pass
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Timings holds the seconds it took to connect (through the proxy, including
+# the proxy handshake) and to get the full response.
+class Response(object):
+
+    def __init__(self, status_code, headers, content='', timings=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.timings = timings or {}
+
+
+_in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+_dns_cache = {}
+_ssl_context = None
+
+
+def get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+# Resolve a host name once and keep it, we only talk to a handful of hosts.
+# Blocking, but IP addresses (i.e. nearly every proxy) skip the lookup.
+def resolve(host, port):
+    try:
+        socket.inet_aton(host)
+        return socket.AF_INET, (host, port)
+    except socket.error:
+        pass
+
+    if host not in _dns_cache:
+        info = socket.getaddrinfo(host, None, socket.AF_INET,
+                                  socket.SOCK_STREAM)
+        _dns_cache[host] = info[0][4][0]
+
+    return socket.AF_INET, (_dns_cache[host], port)
+
+
+def split_url(url):
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    port = parts.port
+    if port is None:
+        port = 443 if scheme == 'https' else 80
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return scheme, parts.hostname, port, path
+
+
+def split_proxy(proxy):
+    parts = urlsplit(proxy)
+    return (parts.scheme.lower(), parts.hostname, parts.port,
+            parts.username, parts.password)
+
+
+def recv(sock, size, timeout):
+    while True:
+        try:
+            raise Return(sock.recv(size))
+        except ssl.SSLWantReadError:
+            yield WaitRead(sock, timeout)
+        except ssl.SSLWantWriteError:
+            yield WaitWrite(sock, timeout)
+        except socket.error as e:
+            if e.errno not in _would_block:
+                raise
+            yield WaitRead(sock, timeout)
+
+
+def recv_exactly(sock, size, timeout):
+    data = ''
+    while len(data) < size:
+        chunk = yield recv(sock, size - len(data), timeout)
+        if not chunk:
+            raise ProtocolError('Connection closed by proxy.')
+        data += chunk
+    raise Return(data)
+
+
+def send_all(sock, data, timeout):
+    while data:
+        try:
+            sent = sock.send(data)
+        except ssl.SSLWantReadError:
+            yield WaitRead(sock, timeout)
+            continue
+        except ssl.SSLWantWriteError:
+            yield WaitWrite(sock, timeout)
+            continue
+        except socket.error as e:
+            if e.errno not in _would_block:
+                raise
+            yield WaitWrite(sock, timeout)
+            continue
+        data = data[sent:]
+
+
+def connect(host, port, timeout):
+    family, address = resolve(host, port)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    try:
+        err = sock.connect_ex(address)
+        if err in _in_progress:
+            yield WaitWrite(sock, timeout)
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, os.strerror(err))
+    except BaseException:
+        sock.close()
+        raise
+
+    raise Return(sock)
+
+
+# Exchange the SOCKS5 greeting and authenticate if needed.
+def socks5_greeting(sock, username, password, timeout):
+    if username:
+        yield send_all(sock, '\x05\x02\x00\x02', timeout)
+    else:
+        yield send_all(sock, '\x05\x01\x00', timeout)
+
+    reply = yield recv_exactly(sock, 2, timeout)
+    if reply[0] != '\x05':
+        raise ProtocolError('Invalid SOCKS5 greeting reply.')
+    if reply[1] == '\x02' and username:
+        password = password or ''
+        yield send_all(sock, '\x01{}{}{}{}'.format(
+            chr(len(username)), username, chr(len(password)), password),
+            timeout)
+        reply = yield recv_exactly(sock, 2, timeout)
+        if reply[1] != '\x00':
+            raise ProtocolError('SOCKS5 authentication failed.')
+    elif reply[1] != '\x00':
+        raise ProtocolError('SOCKS5 proxy refused authentication methods.')
+
+
+def socks5_handshake(sock, host, port, remote_dns, username, password,
+                     timeout):
+    yield socks5_greeting(sock, username, password, timeout)
+
+    if remote_dns:
+        address = '\x03' + chr(len(host)) + host
+    else:
+        address = '\x01' + socket.inet_aton(resolve(host, port)[1][0])
+    yield send_all(sock, '\x05\x01\x00' + address + struct.pack('>H', port),
+                   timeout)
+
+    reply = yield recv_exactly(sock, 4, timeout)
+    if reply[1] != '\x00':
+        raise ProtocolError('SOCKS5 connect failed with code {}.'.format(
+            ord(reply[1])))
+
+    # Consume the bound address sent back by the proxy.
+    if reply[3] == '\x01':
+        yield recv_exactly(sock, 4 + 2, timeout)
+    elif reply[3] == '\x04':
+        yield recv_exactly(sock, 16 + 2, timeout)
+    else:
+        length = yield recv_exactly(sock, 1, timeout)
+        yield recv_exactly(sock, ord(length) + 2, timeout)
+
+
+def socks4_handshake(sock, host, port, remote_dns, username, timeout):
+    if remote_dns:
+        request = struct.pack('>BBH', 4, 1, port) + '\x00\x00\x00\x01'
+        request += (username or '') + '\x00' + host + '\x00'
+    else:
+        request = struct.pack('>BBH', 4, 1, port)
+        request += socket.inet_aton(resolve(host, port)[1][0])
+        request += (username or '') + '\x00'
+    yield send_all(sock, request, timeout)
+
+    reply = yield recv_exactly(sock, 8, timeout)
+    if reply[1] != '\x5a':
+        raise ProtocolError('SOCKS4 connect failed with code {}.'.format(
+            ord(reply[1])))
+
+
+def http_tunnel(sock, host, port, auth, timeout):
+    request = 'CONNECT {0}:{1} HTTP/1.1\r\nHost: {0}:{1}\r\n'.format(
+        host, port)
+    if auth:
+        request += 'Proxy-Authorization: {}\r\n'.format(auth)
+    yield send_all(sock, request + '\r\n', timeout)
+
+    status, headers, rest = yield read_headers(sock, timeout)
+    if status != 200:
+        raise ProtocolError('Proxy CONNECT failed with status {}.'.format(
+            status))
+
+
+def start_tls(sock, host, timeout):
+    sock = get_ssl_context().wrap_socket(sock, server_hostname=host,
+                                         do_handshake_on_connect=False)
+    while True:
+        try:
+            sock.do_handshake()
+            break
+        except ssl.SSLWantReadError:
+            yield WaitRead(sock, timeout)
+        except ssl.SSLWantWriteError:
+            yield WaitWrite(sock, timeout)
+
+    raise Return(sock)
+
+
+def read_headers(sock, timeout):
+    data = ''
+    while '\r\n\r\n' not in data:
+        chunk = yield recv(sock, 8192, timeout)
+        if not chunk:
+            raise ProtocolError('Connection closed before response headers.')
+        data += chunk
+        if len(data) > 65536:
+            raise ProtocolError('Response headers too large.')
+
+    head, rest = data.split('\r\n\r\n', 1)
+    lines = head.split('\r\n')
+    try:
+        status = int(lines[0].split(None, 2)[1])
+    except (IndexError, ValueError):
+        raise ProtocolError('Invalid status line: {}'.format(lines[0]))
+
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    raise Return((status, headers, rest))
+
+
+def dechunk(body):
+    content = []
+    while body:
+        size_line, body = body.split('\r\n', 1)
+        size = int(size_line.split(';')[0], 16)
+        if size == 0:
+            break
+        content.append(body[:size])
+        body = body[size + 2:]
+    return ''.join(content)
+
+
+def read_body(sock, headers, body, timeout, max_size=1048576):
+    length = headers.get('content-length')
+    chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+
+    while len(body) < max_size:
+        if length is not None and len(body) >= int(length):
+            break
+        if chunked and body.endswith('0\r\n\r\n'):
+            break
+        chunk = yield recv(sock, 65536, timeout)
+        if not chunk:
+            break
+        body += chunk
+
+    if chunked:
+        body = dechunk(body)
+
+    encoding = headers.get('content-encoding', '').lower()
+    if encoding == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        try:
+            body = zlib.decompress(body)
+        except zlib.error:
+            body = zlib.decompress(body, -zlib.MAX_WBITS)
+
+    raise Return(body)
+
+
+# Open a connection to host:port through the proxy, with all the proxy
+# protocol negotiation done. Plain HTTP proxies are only tunneled if needed.
+def open_connection(proxy, host, port, tunnel, timeout):
+    if not proxy:
+        sock = yield connect(host, port, timeout)
+        raise Return(sock)
+
+    scheme, proxy_host, proxy_port, username, password = split_proxy(proxy)
+    sock = yield connect(proxy_host, proxy_port or 1080, timeout)
+    try:
+        if scheme in ('socks5', 'socks5h'):
+            yield socks5_handshake(sock, host, port, scheme == 'socks5h',
+                                   username, password, timeout)
+        elif scheme in ('socks4', 'socks4a'):
+            yield socks4_handshake(sock, host, port, scheme == 'socks4a',
+                                   username, timeout)
+        elif tunnel:
+            yield http_tunnel(sock, host, port, proxy_auth(proxy), timeout)
+    except BaseException:
+        sock.close()
+        raise
+
+    raise Return(sock)
+
+
+def proxy_auth(proxy):
+    scheme, host, port, username, password = split_proxy(proxy)
+    if not username:
+        return None
+    return 'Basic ' + b64encode('{}:{}'.format(username, password or ''))
+
+
+# Coroutine performing a GET request through a proxy.
+# If stream is enabled, the body is not read and only headers are returned.
+def request(url, proxy=None, headers={}, timeout=5, stream=False):
+    scheme, host, port, path = split_url(url)
+    start = time.time()
+    timings = {}
+    sock = None
+
+    # Plain HTTP proxies get the full URL in the request line.
+    http_proxy = proxy and split_proxy(proxy)[0] in ('http', 'https')
+    if http_proxy and scheme == 'http':
+        target = url
+    else:
+        target = path
+
+    lines = ['GET {} HTTP/1.1'.format(target)]
+    if not any(key.lower() == 'host' for key in headers):
+        lines.append('Host: {}'.format(host))
+    for key, value in headers.items():
+        lines.append('{}: {}'.format(key, value))
+    if http_proxy and scheme == 'http' and proxy_auth(proxy):
+        lines.append('Proxy-Authorization: {}'.format(proxy_auth(proxy)))
+
+    try:
+        try:
+            sock = yield open_connection(proxy, host, port,
+                                         scheme == 'https', timeout)
+            timings['connect'] = time.time() - start
+            if scheme == 'https':
+                sock = yield start_tls(sock, host, timeout)
+        except WaitTimeout:
+            raise ConnectTimeout('Connection to {} timed out.'.format(proxy))
+        except (socket.error, ProtocolError) as e:
+            raise ProxyConnectionError(e)
+
+        try:
+            yield send_all(sock, '\r\n'.join(lines) + '\r\n\r\n', timeout)
+            status, response_headers, body = yield read_headers(sock, timeout)
+            if not stream:
+                body = yield read_body(sock, response_headers, body, timeout)
+        except WaitTimeout:
+            raise ReadTimeout('Read from {} timed out.'.format(proxy))
+        except (socket.error, ProtocolError, zlib.error) as e:
+            raise ProxyConnectionError(e)
+
+        timings['total'] = time.time() - start
+
+    finally:
+        if sock is not None:
+            sock.close()
+
+    raise Return(Response(status, response_headers, body, timings))
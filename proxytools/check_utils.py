@@ -42,6 +42,21 @@ def get_args():
                         help='Disable anonymous proxy test.',
                         default=False,
                         action='store_true')
+    parser.add_argument('-ps', '--prescreen',
+                        help=('Pre-screen proxies with a TCP connection ' +
+                              '(and SOCKS5 greeting) before testing them.'),
+                        default=False,
+                        action='store_true')
+    parser.add_argument('-pst', '--prescreen-timeout',
+                        help=('Pre-screen connection timeout. ' +
+                              'Default is 2 seconds.'),
+                        default=2,
+                        type=float)
+    parser.add_argument('-psc', '--prescreen-concurrency',
+                        help=('Maximum concurrent pre-screen connections. ' +
+                              'Default is 500.'),
+                        default=500,
+                        type=int)
     mode = parser.add_mutually_exclusive_group()
     mode.add_argument('-nt', '--no-test',
                       help='Disable PTC/Niantic proxy test.',
@@ -60,21 +75,91 @@ def get_args():
                         help='Maximum concurrent proxy testing requests.',
                         default=100,
                         type=int)
+    parser.add_argument('-ac', '--adaptive-concurrency',
+                        help=('Adjust the number of concurrent proxy ' +
+                              'testing requests to the observed timeout ' +
+                              'rate and latency, up to --max-concurrency.'),
+                        default=False,
+                        action='store_true')
+    parser.add_argument('-en', '--engine',
+                        help=('Proxy testing engine. "futures" uses a ' +
+                              'thread per request, "eventloop" runs all ' +
+                              'requests in a single thread. ' +
+                              'Default is "futures".'),
+                        default='futures',
+                        choices=('futures', 'eventloop'))
     parser.add_argument('-bs', '--batch-size',
                         help='Check proxies in batches of limited size.',
                         default=300,
                         type=int)
+    parser.add_argument('-np', '--processes',
+                        help=('Split the proxy list across this many ' +
+                              'processes, each testing its share with ' +
+                              'its own concurrency. Default is 1.'),
+                        default=1,
+                        type=int)
     parser.add_argument('-l', '--limit',
                         help='Stop tests when we have enough good proxies.',
                         default=100,
                         type=int)
+    parser.add_argument('--cache-file',
+                        help=('Keep recent proxy results in this file ' +
+                              'and skip testing proxies with a recent ' +
+                              'result, see --cache-ttl-*.'),
+                        default=None)
+    parser.add_argument('--page-cache-file',
+                        help=('Keep scraped webpages in this file and ' +
+                              'only parse them again when they change.'),
+                        default=None)
+    parser.add_argument('--post-index-file',
+                        help=('Keep the posts harvested from each proxy ' +
+                              'list blog in this file and only scrape ' +
+                              'new posts, see --post-freshness.'),
+                        default=None)
+    parser.add_argument('--post-freshness',
+                        help=('Minutes after a post is first harvested ' +
+                              'during which it is scraped again, as it may ' +
+                              'still be updated. Default is 1440 (a day).'),
+                        default=1440,
+                        type=int)
+    parser.add_argument('-ctw', '--cache-ttl-working',
+                        help=('Minutes to reuse the result of a working ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 0.'),
+                        default=0,
+                        type=int)
+    parser.add_argument('-ctb', '--cache-ttl-banned',
+                        help=('Minutes to reuse the result of a banned ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 30.'),
+                        default=30,
+                        type=int)
+    parser.add_argument('-ctf', '--cache-ttl-failed',
+                        help=('Minutes to reuse the result of a failed ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 30.'),
+                        default=30,
+                        type=int)
+    parser.add_argument('-ctt', '--cache-ttl-timeout',
+                        help=('Minutes to reuse the result of a timeout ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 15.'),
+                        default=15,
+                        type=int)
     parser.add_argument('-ic', '--ignore-country',
                         help='Ignore proxies from countries in this list.',
                         action='append', default=['china'])
     parser.add_argument('-gu', '--geoip_url',
                         help='URL to lookup the geo-location/country of IP.',
-                        action='store_true',
                         default='http://www.freegeoip.net/json/{0}')
+    parser.add_argument('-gf', '--geoip-file',
+                        help=('Lookup the country of IPs in this local ' +
+                              'CSV range file (ip_from,ip_to,country_code' +
+                              '[,country_name], optionally gzipped) ' +
+                              'instead of using --geoip_url. Proxies ' +
+                              'from ignored countries are then dropped ' +
+                              'before testing.'),
+                        default=None)
     output = parser.add_mutually_exclusive_group()
     output.add_argument('--proxychains',
                         help='Output in proxychains-ng format.',
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from threading import Lock
+
+log = logging.getLogger('pgproxy')
+
+# File descriptors kept free for everything else (logs, DB, web server).
+fd_reserve = 64
+
+
+# Number of sockets the process can open, None if unknown.
+def get_socket_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, ValueError):
+        return None
+
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(1, soft - fd_reserve)
+
+
+# Returns the maximum number of concurrent requests to use, 0 meaning one
+# per proxy, bounded by the number of sockets we're allowed to open.
+def get_max_concurrency(max_concurrency, total_proxies):
+    if max_concurrency == 0:
+        max_concurrency = max(total_proxies, 1)
+
+    socket_limit = get_socket_limit()
+    if socket_limit and max_concurrency > socket_limit:
+        log.warning('Concurrency of %d exceeds the open files limit, ' +
+                    'using %d instead.', max_concurrency, socket_limit)
+        max_concurrency = socket_limit
+
+    return max_concurrency
+
+
+# Controls the number of concurrent requests (the window).
+# If adaptive, the window is adjusted AIMD-style from the outcome of the
+# requests: it grows by a fixed step as long as the timeout rate and latency
+# are stable, and is cut down as soon as either of them degrades, which
+# happens once the local network (NAT, conntrack) can't keep up.
+# Thread-safe, listeners are notified of every window change.
+class ConcurrencyController(object):
+
+    def __init__(self, maximum, adaptive=False, initial=50, minimum=10,
+                 step=10, decrease_factor=0.5, timeout_tolerance=0.2,
+                 latency_tolerance=2.0, warmup_samples=2):
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self._minimum = minimum
+        self.adaptive = adaptive
+        self.step = step
+        self.decrease_factor = decrease_factor
+        self.timeout_tolerance = timeout_tolerance
+        self.latency_tolerance = latency_tolerance
+        self.warmup_samples = warmup_samples
+
+        if adaptive:
+            self.window = max(self.minimum, min(initial, maximum))
+        else:
+            self.window = maximum
+
+        self.lowest_window = self.window
+        self.highest_window = self.window
+        self.listeners = []
+
+        self._lock = Lock()
+        self._reset_sample()
+        self._samples = 0
+        self._ignored = 0
+        self._baseline_timeout_rate = None
+        self._baseline_latency = None
+
+    def _reset_sample(self):
+        self._requests = 0
+        self._timeouts = 0
+        self._latencies = []
+
+    # Change the upper bound of the window, e.g. for a smaller batch.
+    def set_maximum(self, maximum):
+        with self._lock:
+            self.maximum = maximum
+            self.minimum = min(self._minimum, maximum)
+            if self.adaptive:
+                window = max(self.minimum, min(self.window, maximum))
+            else:
+                window = maximum
+            if window == self.window:
+                return
+            self.window = window
+
+        for listener in self.listeners:
+            listener(window)
+
+    # Record the outcome of a request: whether it timed out, and its
+    # latency in seconds if it got a response.
+    def record(self, timed_out, latency=None):
+        if not self.adaptive:
+            return
+
+        with self._lock:
+            # Requests that were already in flight when the window was cut
+            # down still reflect the old window.
+            if self._ignored > 0:
+                self._ignored -= 1
+                return
+
+            self._requests += 1
+            if timed_out:
+                self._timeouts += 1
+            elif latency is not None:
+                self._latencies.append(latency)
+
+            # Evaluate once we've seen about a window of requests.
+            if self._requests < max(50, self.window):
+                return
+
+            window = self._evaluate_sample()
+            self._reset_sample()
+            self._samples += 1
+
+            if window == self.window:
+                return
+            if window < self.window:
+                self._ignored = self.window
+            self.window = window
+            self.lowest_window = min(self.lowest_window, window)
+            self.highest_window = max(self.highest_window, window)
+
+        for listener in self.listeners:
+            listener(window)
+
+    def _evaluate_sample(self):
+        timeout_rate = float(self._timeouts) / self._requests
+        latency = None
+        if self._latencies:
+            latency = sorted(self._latencies)[len(self._latencies) // 2]
+
+        # Scraped lists are full of dead proxies, so timeouts are compared
+        # to what we normally see rather than to zero. Dead proxies only
+        # time out after a while, so the first samples are only learnt from.
+        if self._baseline_timeout_rate is None:
+            self._baseline_timeout_rate = timeout_rate
+        if self._baseline_latency is None:
+            self._baseline_latency = latency
+
+        congested = False
+        if self._samples >= self.warmup_samples:
+            congested = timeout_rate > (self._baseline_timeout_rate +
+                                        self.timeout_tolerance)
+        if latency is not None and self._baseline_latency:
+            congested |= latency > (self._baseline_latency *
+                                    self.latency_tolerance)
+
+        self._baseline_timeout_rate += 0.3 * (timeout_rate -
+                                              self._baseline_timeout_rate)
+
+        if congested:
+            window = max(self.minimum,
+                         int(self.window * self.decrease_factor))
+            if window != self.window:
+                log.info('Congestion detected (timeouts: %d%%, latency: ' +
+                         '%s), concurrency window: %d -> %d.',
+                         timeout_rate * 100, format_latency(latency),
+                         self.window, window)
+            return window
+
+        # Latency is only learnt from samples taken while not congested.
+        if latency is not None:
+            if self._baseline_latency is None:
+                self._baseline_latency = latency
+            else:
+                self._baseline_latency += 0.2 * (latency -
+                                                 self._baseline_latency)
+
+        window = min(self.maximum, self.window + self.step)
+        if window != self.window:
+            log.debug('Concurrency window: %d -> %d (timeouts: %d%%, ' +
+                      'latency: %s).', self.window, window,
+                      timeout_rate * 100, format_latency(latency))
+        return window
+
+
+def format_latency(latency):
+    if latency is None:
+        return 'n/a'
+    return '{:.2f}s'.format(latency)
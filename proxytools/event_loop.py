@@ -0,0 +1,419 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import errno
+import heapq
+import logging
+import select
+import sys
+import time
+import types
+from collections import deque
+
+log = logging.getLogger('pgproxy')
+
+
+# Coroutines are plain generators. They yield wait requests (WaitRead,
+# WaitWrite, Sleep, WaitTasks or Semaphore.acquire()) or other generators,
+# which are run as sub-coroutines. Python 2 generators can't return values,
+# so a coroutine hands a value back to its caller by raising Return.
+class Return(Exception):
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+# Thrown into a coroutine when a socket wait exceeds its timeout.
+class WaitTimeout(Exception):
+    pass
+
+
+# Stored as the exception of a task that was cancelled.
+class TaskCancelled(Exception):
+    pass
+
+
+class WaitRead(object):
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+
+
+class WaitWrite(object):
+    def __init__(self, sock, timeout=None):
+        self.sock = sock
+        self.timeout = timeout
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+# Suspend until the first (or all) of the given tasks are done.
+class WaitTasks(object):
+    def __init__(self, tasks, first=False):
+        self.tasks = list(tasks)
+        self.first = first
+
+
+class _Acquire(object):
+    def __init__(self, semaphore, priority):
+        self.semaphore = semaphore
+        self.priority = priority
+
+
+class Task(object):
+
+    def __init__(self, loop, coro):
+        self.loop = loop
+        self.done = False
+        self.result = None
+        self.exception = None
+        self._stack = [coro]
+        self._callbacks = []
+        # Incremented every time the task is suspended, so stale wake-ups
+        # (e.g. a timer for a wait that already completed) can be ignored.
+        self._token = 0
+        self._fd = None
+        # Semaphore that granted the task a slot it hasn't resumed with yet.
+        self._granted = None
+
+    def add_done_callback(self, fn):
+        if self.done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def cancel(self):
+        self.loop.cancel(self)
+
+    def _step(self, value=None, exc_info=None):
+        # From here on the coroutine owns the slot and releases it itself.
+        self._granted = None
+        while True:
+            gen = self._stack[-1]
+            try:
+                if exc_info:
+                    request = gen.throw(*exc_info)
+                else:
+                    request = gen.send(value)
+            except StopIteration:
+                value, exc_info = None, None
+            except Return as r:
+                value, exc_info = r.value, None
+            except Exception:
+                value, exc_info = None, sys.exc_info()
+            else:
+                if isinstance(request, types.GeneratorType):
+                    self._stack.append(request)
+                    value, exc_info = None, None
+                    continue
+
+                self.loop._suspend(self, request)
+                return
+
+            # The current generator has finished, hand its outcome to the
+            # parent coroutine or finish the task.
+            self._stack.pop()
+            if not self._stack:
+                self._finish(value, exc_info[1] if exc_info else None)
+                return
+
+    def _finish(self, result, exception):
+        self.done = True
+        self.result = result
+        self.exception = exception
+        self.loop._tasks.discard(self)
+
+        if exception and not isinstance(exception, TaskCancelled):
+            log.debug('Task finished with exception: %s', repr(exception))
+
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log.exception('Exception in task callback: %s', repr(e))
+
+
+# Semaphore for coroutines, e.g. to bound the number of open sockets.
+# The limit can be changed at any time. Priority waiters are served first.
+class Semaphore(object):
+
+    def __init__(self, loop, limit):
+        self.loop = loop
+        self.limit = limit
+        self.holders = 0
+        self._waiters = deque()
+        self._priority_waiters = deque()
+
+    def acquire(self, priority=False):
+        return _Acquire(self, priority)
+
+    def waiting(self):
+        return len(self._waiters) + len(self._priority_waiters)
+
+    def release(self):
+        self.holders -= 1
+        self._wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        while self.holders < self.limit:
+            if self._priority_waiters:
+                task, token = self._priority_waiters.popleft()
+            elif self._waiters:
+                task, token = self._waiters.popleft()
+            else:
+                break
+            if task.done or task._token != token:
+                continue
+            self.holders += 1
+            task._granted = self
+            self.loop._schedule(task)
+
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd, readable):
+        mask = select.EPOLLIN if readable else select.EPOLLOUT
+        self._epoll.register(fd, mask | select.EPOLLERR | select.EPOLLHUP)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        return [fd for fd, event in self._epoll.poll(timeout)]
+
+    def close(self):
+        self._epoll.close()
+
+
+class _PollPoller(object):
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd, readable):
+        mask = select.POLLIN if readable else select.POLLOUT
+        self._poll.register(fd, mask | select.POLLERR | select.POLLHUP)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        return [fd for fd, event in self._poll.poll(timeout)]
+
+    def close(self):
+        pass
+
+
+# Fallback for platforms without epoll/poll (Windows).
+# Limited to FD_SETSIZE sockets.
+class _SelectPoller(object):
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, readable):
+        if readable:
+            self._readers.add(fd)
+        else:
+            self._writers.add(fd)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout):
+        if not self._readers and not self._writers:
+            time.sleep(timeout or 0)
+            return []
+        r, w, x = select.select(self._readers, self._writers,
+                                self._readers | self._writers, timeout)
+        return set(r) | set(w) | set(x)
+
+    def close(self):
+        pass
+
+
+def make_poller():
+    if hasattr(select, 'epoll'):
+        return _EpollPoller()
+    if hasattr(select, 'poll'):
+        return _PollPoller()
+    return _SelectPoller()
+
+
+# Single threaded event loop driving coroutines over non-blocking sockets.
+# Not thread-safe: all tasks must be spawned and cancelled from the thread
+# running the loop.
+class EventLoop(object):
+
+    def __init__(self):
+        self._poller = make_poller()
+        self._fds = {}
+        self._timers = []
+        self._ready = deque()
+        self._seq = 0
+        self._tasks = set()
+
+    def spawn(self, coro, callback=None):
+        task = Task(self, coro)
+        if callback:
+            task.add_done_callback(callback)
+        self._tasks.add(task)
+        self._schedule(task)
+        return task
+
+    def cancel(self, task):
+        if task.done:
+            return
+
+        # Invalidate any pending wake-ups and stop watching its socket.
+        task._token += 1
+        self._release_fd(task)
+
+        # A slot granted to the task before it could resume would never be
+        # released by the coroutine.
+        if task._granted:
+            semaphore, task._granted = task._granted, None
+            semaphore.release()
+
+        # Closing the generators runs their finally blocks, which is where
+        # coroutines close their sockets and release their semaphores.
+        while task._stack:
+            gen = task._stack.pop()
+            try:
+                gen.close()
+            except Exception as e:
+                log.debug('Exception closing cancelled task: %s', repr(e))
+
+        task._finish(None, TaskCancelled())
+
+    def pending(self):
+        return len(self._tasks)
+
+    def run_once(self, timeout=None):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            delay = max(0, self._timers[0][0] - time.time())
+            timeout = delay if timeout is None else min(timeout, delay)
+
+        if self._fds or timeout != 0:
+            try:
+                fds = self._poller.poll(timeout)
+            except (select.error, IOError, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                fds = []
+
+            for fd in fds:
+                task = self._fds.get(fd)
+                if task is None:
+                    continue
+                self._release_fd(task)
+                self._schedule(task)
+
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, task, token, exc = heapq.heappop(self._timers)
+            if task.done or task._token != token:
+                continue
+            self._release_fd(task)
+            if exc:
+                self._schedule(task, exc_info=(exc, exc(), None))
+            else:
+                self._schedule(task)
+
+        # Only run what is ready now, anything scheduled while running
+        # waits for the next iteration so sockets keep being polled.
+        for i in range(len(self._ready)):
+            task, token, value, exc_info = self._ready.popleft()
+            if task.done or task._token != token:
+                continue
+            task._step(value, exc_info)
+
+    # Run until every spawned task has finished.
+    def run(self):
+        while self._tasks:
+            self.run_once()
+
+    # Cancel whatever is still running and release the poller.
+    def close(self):
+        for task in list(self._tasks):
+            self.cancel(task)
+        self._poller.close()
+
+    def _schedule(self, task, value=None, exc_info=None):
+        task._token += 1
+        self._ready.append((task, task._token, value, exc_info))
+
+    def _add_timer(self, task, delay, exc=None):
+        self._seq += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._seq, task,
+                                      task._token, exc))
+
+    def _release_fd(self, task):
+        if task._fd is not None:
+            self._poller.unregister(task._fd)
+            del self._fds[task._fd]
+            task._fd = None
+
+    def _suspend(self, task, request):
+        task._token += 1
+
+        if isinstance(request, (WaitRead, WaitWrite)):
+            fd = request.sock.fileno()
+            self._poller.register(fd, isinstance(request, WaitRead))
+            self._fds[fd] = task
+            task._fd = fd
+            if request.timeout is not None:
+                self._add_timer(task, request.timeout, WaitTimeout)
+
+        elif isinstance(request, Sleep):
+            self._add_timer(task, request.seconds)
+
+        elif isinstance(request, _Acquire):
+            semaphore = request.semaphore
+            if request.priority:
+                semaphore._priority_waiters.append((task, task._token))
+            else:
+                semaphore._waiters.append((task, task._token))
+            semaphore._wake()
+
+        elif isinstance(request, WaitTasks):
+            self._wait_tasks(task, request)
+
+        else:
+            self._schedule(task, exc_info=(
+                TypeError, TypeError('Unknown wait request: {}'.format(
+                    repr(request))), None))
+
+    def _wait_tasks(self, task, request):
+        token = task._token
+
+        def check(child=None):
+            if task.done or task._token != token:
+                return
+            done = [t for t in request.tasks if t.done]
+            if len(done) == len(request.tasks) or (done and request.first):
+                self._schedule(task)
+
+        for child in request.tasks:
+            if not child.done:
+                child.add_done_callback(check)
+        check()
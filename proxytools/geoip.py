@@ -0,0 +1,273 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import csv
+import gzip
+import logging
+import socket
+import struct
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urlparse import urlsplit
+
+from .shared_utils import get_country_from_ip, load_json, save_json
+
+log = logging.getLogger('pgproxy')
+
+# Loaded GeoIP indexes by filename, shared by everything in the process.
+_indexes = {}
+
+# Web service lookups of proxies missing from the country cache are made
+# concurrently, by this many threads.
+lookup_workers = 10
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+# Returns the host of a proxy URL (or plain address).
+def get_proxy_host(proxy):
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlsplit(proxy).hostname
+
+
+# Returns the IP address of a proxy URL (or plain address), None for host
+# names.
+def get_proxy_ip(proxy):
+    host = get_proxy_host(proxy)
+    try:
+        socket.inet_aton(host)
+    except (socket.error, TypeError):
+        return None
+    return host
+
+
+def parse_ip_field(value):
+    if value.isdigit():
+        return int(value)
+    return ip_to_int(value)
+
+
+# Offline IP to country lookups from a range file, held in memory as sorted
+# arrays of integer ranges and searched with bisect.
+# Reads CSV files (optionally gzipped) with one range per row:
+#   ip_from,ip_to,country_code[,country_name]
+# with IPs either as dotted quads or integers, like the free IP2Location
+# LITE DB1 and DB-IP lite country files. IPv6 rows are skipped.
+class GeoIPIndex(object):
+
+    def __init__(self, starts, ends, country_ids, countries):
+        self.starts = starts
+        self.ends = ends
+        self.country_ids = country_ids
+        self.countries = countries
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def load(cls, filename):
+        start_time = time.time()
+        opener = gzip.open if filename.endswith('.gz') else open
+
+        rows = []
+        countries = []
+        country_ids = {}
+        with opener(filename, 'rb') as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or ':' in row[0]:
+                    continue
+                try:
+                    start = parse_ip_field(row[0].strip())
+                    end = parse_ip_field(row[1].strip())
+                except (socket.error, ValueError, struct.error):
+                    # Header line or garbage.
+                    continue
+
+                code = row[2].strip().lower()
+                name = row[3].strip().lower() if len(row) > 3 else ''
+                # Unassigned ranges.
+                if code in ('', '-', 'zz'):
+                    continue
+
+                country = (code, name or code)
+                if country not in country_ids:
+                    country_ids[country] = len(countries)
+                    countries.append(country)
+                rows.append((start, end, country_ids[country]))
+
+        rows.sort()
+        index = cls(array('I', (r[0] for r in rows)),
+                    array('I', (r[1] for r in rows)),
+                    array('H', (r[2] for r in rows)),
+                    countries)
+
+        log.info('Loaded %d GeoIP ranges for %d countries from %s in ' +
+                 '%.2fs.', len(index), len(countries), filename,
+                 time.time() - start_time)
+        return index
+
+    # Returns the (code, name) of the country of an IP address, or None.
+    def lookup(self, ip):
+        try:
+            value = ip_to_int(ip)
+        except (socket.error, TypeError):
+            return None
+
+        i = bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        return self.countries[self.country_ids[i]]
+
+    # Returns the lowercase country name of a proxy, like
+    # get_country_from_ip(), or None if unknown.
+    def get_country(self, proxy):
+        country = self.lookup(get_proxy_ip(proxy))
+        return country[1] if country else None
+
+
+def load_geoip_index(filename):
+    if filename not in _indexes:
+        _indexes[filename] = GeoIPIndex.load(filename)
+    return _indexes[filename]
+
+
+# Drops the proxies from ignored countries before they're tested, using the
+# local GeoIP file. Countries are matched by code as well as by name.
+# Without a GeoIP file nothing is dropped here, countries are then looked up
+# with the web service for working proxies only.
+def filter_countries(args, proxies):
+    if not args.geoip_file or not args.ignore_country:
+        return proxies
+
+    index = load_geoip_index(args.geoip_file)
+    ignored = set(country.strip().lower()
+                  for country in args.ignore_country)
+
+    kept = []
+    skipped = {}
+    for proxy in proxies:
+        country = index.lookup(get_proxy_ip(proxy))
+        if country and (country[0] in ignored or country[1] in ignored):
+            skipped[country[1]] = skipped.get(country[1], 0) + 1
+        else:
+            kept.append(proxy)
+
+    if skipped:
+        log.info('Country pre-filter avoided %d of %d proxy checks, for ' +
+                 'proxies from ignored countries (%s).',
+                 len(proxies) - len(kept), len(proxies),
+                 ', '.join('{}: {}'.format(country, count)
+                           for country, count in sorted(skipped.items())))
+    return kept
+
+
+# Countries found with the GeoIP web service, by proxy host, so the same
+# proxies aren't looked up again on every refresh. Entries expire after ttl
+# seconds and the least recently used ones are evicted beyond max_size.
+# Kept in a JSON file between runs if a filename is given.
+class CountryCache(object):
+
+    def __init__(self, geoip_url, max_size, ttl, filename=None):
+        self.geoip_url = geoip_url
+        self.max_size = max_size
+        self.ttl = ttl
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+        if filename:
+            self._load_file()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load_file(self):
+        entries = load_json(self.filename, 'GeoIP cache')
+        if entries is None:
+            return
+
+        # Oldest first, so they're the first evicted.
+        now = time.time()
+        for host, entry in sorted(entries.items(), key=lambda e: e[1][1]):
+            if now - entry[1] < self.ttl:
+                self._store(host, tuple(entry))
+        log.info('Loaded %d cached proxy countries from %s.',
+                 len(self._entries), self.filename)
+
+    def _get(self, host, now):
+        entry = self._entries.pop(host, None)
+        if entry is None or now - entry[1] >= self.ttl:
+            return None
+        self._entries[host] = entry
+        return entry
+
+    def _store(self, host, entry):
+        self._entries.pop(host, None)
+        self._entries[host] = entry
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    # Returns {proxy: country} for the proxies, with lowercase country names
+    # like get_country_from_ip(), or None if the lookup failed. Hosts missing
+    # from the cache are looked up concurrently.
+    def get_countries(self, proxies):
+        hosts = dict((proxy, get_proxy_host(proxy)) for proxy in proxies)
+        found = {}
+        missing = set()
+
+        now = time.time()
+        with self._lock:
+            for proxy, host in hosts.items():
+                entry = self._get(host, now)
+                if entry:
+                    found[host] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.add(host)
+                    self.misses += 1
+
+        if missing:
+            missing = list(missing)
+            workers = min(lookup_workers, len(missing))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                countries = list(executor.map(
+                    lambda host: get_country_from_ip(self.geoip_url, host),
+                    missing))
+
+            now = time.time()
+            with self._lock:
+                for host, country in zip(missing, countries):
+                    found[host] = country
+                    # Failed lookups are tried again next time.
+                    if country is not None:
+                        self._store(host, (country, now))
+
+        return dict((proxy, found[host]) for proxy, host in hosts.items())
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return None
+        return self.hits * 100.0 / total
+
+    # Writes the entries that haven't expired yet.
+    def save(self):
+        if not self.filename:
+            return
+
+        now = time.time()
+        with self._lock:
+            entries = dict((host, entry)
+                           for host, entry in self._entries.items()
+                           if now - entry[1] < self.ttl)
+
+        save_json(self.filename, entries, 'GeoIP cache')
@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+from HTMLParser import HTMLParser
+
+# Lightweight extraction of known elements from HTML with regular
+# expressions, much faster than building a full BeautifulSoup tree. Only
+# meant for simple, non-nested elements like table cells, textareas and
+# scripts: callers fall back to BeautifulSoup when what they look for isn't
+# found.
+
+attr_re = re.compile(
+    r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+)))?')
+tag_re = re.compile(r'<[^>]*>')
+
+_element_res = {}
+_start_tag_res = {}
+
+unescape = HTMLParser().unescape
+
+
+def get_attrs(attrs_html):
+    attrs = {}
+    for m in attr_re.finditer(attrs_html):
+        value = m.group(2)
+        if value is None:
+            value = m.group(3)
+        if value is None:
+            value = m.group(4) or ''
+        attrs[m.group(1).lower()] = unescape(value)
+    return attrs
+
+
+def get_classes(attrs):
+    return attrs.get('class', '').split()
+
+
+# Text of an HTML fragment, like BeautifulSoup's get_text().
+def get_text(inner_html):
+    return unescape(tag_re.sub('', inner_html))
+
+
+# Yields (attrs, inner_html) for each <tag> element. Elements of the same
+# tag nested in each other aren't supported.
+def iter_elements(html, tag):
+    element_re = _element_res.get(tag)
+    if element_re is None:
+        element_re = re.compile(
+            r'<{0}(\s[^>]*)?>(.*?)</{0}\s*>'.format(tag), re.S | re.I)
+        _element_res[tag] = element_re
+
+    for m in element_re.finditer(html):
+        yield get_attrs(m.group(1) or ''), m.group(2)
+
+
+# Yields the attrs of each <tag> start tag, for void elements like <input>.
+def iter_start_tags(html, tag):
+    start_tag_re = _start_tag_res.get(tag)
+    if start_tag_re is None:
+        start_tag_re = re.compile(r'<{}(\s[^>]*)?/?>'.format(tag), re.I)
+        _start_tag_res[tag] = start_tag_re
+
+    for m in start_tag_re.finditer(html):
+        yield get_attrs(m.group(1) or '')
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import time
+from threading import Lock
+
+from .shared_utils import load_json, save_json
+
+log = logging.getLogger('pgproxy')
+
+# Pages not scraped for this long are dropped from the cache file.
+page_cache_expiry = 30 * 24 * 3600
+
+
+def get_content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+# Scraped pages kept in a JSON file between runs, with their validators
+# (ETag, Last-Modified), a hash of their content and what was parsed from
+# them. Pages are requested with conditional headers, and the parsed result
+# is reused when the site answers 304 Not Modified or sends the same content
+# again.
+class PageCache(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.not_modified = 0
+        self.unchanged = 0
+        self.parsed = 0
+        self._entries = {}
+        self._lock = Lock()
+
+        entries = load_json(filename, 'webpage cache')
+        if entries is not None:
+            self._entries = entries
+            log.info('Loaded %d cached webpages from %s.',
+                     len(self._entries), filename)
+
+    # Returns the conditional request headers for a page.
+    def get_headers(self, url):
+        entry = self._entries.get(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    # Returns the result parsed from the page last time if the response
+    # shows it didn't change, otherwise None.
+    def get_result(self, url, response):
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+
+        not_modified = response.status_code == 304
+        if not not_modified and (
+                response.status_code != 200 or
+                get_content_hash(response.content) != entry['hash']):
+            return None
+
+        with self._lock:
+            if not_modified:
+                self.not_modified += 1
+            else:
+                self.unchanged += 1
+            entry['last_seen'] = time.time()
+        return entry['result']
+
+    def put(self, url, response, result):
+        entry = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': get_content_hash(response.content),
+            'result': result,
+            'last_seen': time.time()
+        }
+        with self._lock:
+            self._entries[url] = entry
+            self.parsed += 1
+
+    def log_stats(self):
+        log.info('Webpage cache: %d not modified, %d unchanged, %d parsed.',
+                 self.not_modified, self.unchanged, self.parsed)
+        self.not_modified = 0
+        self.unchanged = 0
+        self.parsed = 0
+
+    # Writes the pages scraped recently.
+    def save(self):
+        now = time.time()
+        with self._lock:
+            entries = dict((url, entry) for url, entry in self._entries.items()
+                           if now - entry['last_seen'] < page_cache_expiry)
+
+        save_json(self.filename, entries, 'webpage cache')
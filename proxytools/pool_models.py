@@ -7,12 +7,14 @@ from datetime import datetime
 from threading import Lock
 
 from peewee import DeleteQuery, DateTimeField, CharField, SmallIntegerField, \
-    IntegerField, BooleanField, InsertQuery, fn, OperationalError
+    IntegerField, BooleanField, FloatField, InsertQuery, fn, OperationalError
 from playhouse.flask_utils import FlaskDB
-# from playhouse.migrate import migrate, MySQLMigrator
+from playhouse.migrate import migrate, MySQLMigrator
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 
+from .verdict_cache import VerdictCache, normalize_proxy_url
+
 
 log = logging.getLogger('pgproxy')
 
@@ -20,7 +22,10 @@ flaskDb = FlaskDB()
 
 request_lock = Lock()
 
-db_schema_version = 1
+db_schema_version = 3
+
+# Weight of the latest measurement in the smoothed proxy latency.
+latency_smoothing = 0.3
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
@@ -55,6 +60,17 @@ class ProxyPool(flaskDb.Model):
     failed_retry_count = IntegerField(null=False, default=0)
     last_modified = DateTimeField(index=True, default=datetime.now)
 
+    # proxy speed (in seconds) of the last working check, and smoothed
+    # over all working checks
+    connect_latency = FloatField(null=True)
+    last_latency = FloatField(null=True)
+    avg_latency = FloatField(null=True, index=True)
+
+    # last check result, used to skip proxies tested recently
+    last_checked = DateTimeField(null=True)
+    last_check_stage = Utf8mb4CharField(max_length=16, null=True)
+    last_check_result = SmallIntegerField(null=True)
+
     def serialize(self):
         return {
             'url': self.url,
@@ -62,7 +78,10 @@ class ProxyPool(flaskDb.Model):
             'invalid': self.invalid,
             'banned': self.banned,
             'failed': self.failed,
-            'last_modified': self.last_modified
+            'last_modified': self.last_modified,
+            'connect_latency': self.connect_latency,
+            'last_latency': self.last_latency,
+            'avg_latency': self.avg_latency
         }
 
 
@@ -133,11 +152,38 @@ def migrate_database(db, old_ver):
 
     log.info('Detected database version {}, updating to {}...'
              .format(old_ver, db_schema_version))
-    # migrator = MySQLMigrator(db)
-
-    # Version.update(val=db_schema_version).where(
-    #    Version.key == 'schema_version').execute()
-    # log.info("Done migrating database.")
+    migrator = MySQLMigrator(db)
+
+    if old_ver < 2:
+        migrate(
+            migrator.add_column('proxypool', 'connect_latency',
+                                FloatField(null=True)),
+            migrator.add_column('proxypool', 'last_latency',
+                                FloatField(null=True)),
+            migrator.add_column('proxypool', 'avg_latency',
+                                FloatField(null=True)),
+            migrator.add_index('proxypool', ('avg_latency',), False)
+        )
+
+    if old_ver < 3:
+        migrate(
+            migrator.add_column('proxypool', 'last_checked',
+                                DateTimeField(null=True)),
+            migrator.add_column('proxypool', 'last_check_stage',
+                                Utf8mb4CharField(max_length=16, null=True)),
+            migrator.add_column('proxypool', 'last_check_result',
+                                SmallIntegerField(null=True))
+        )
+
+    # Databases created before versioning don't have the table yet.
+    if not Version.table_exists():
+        db.create_tables([Version], safe=True)
+        InsertQuery(Version, {Version.key: 'schema_version',
+                              Version.val: db_schema_version}).execute()
+    else:
+        Version.update(val=db_schema_version).where(
+            Version.key == 'schema_version').execute()
+    log.info("Done migrating database.")
 
 
 def migrate_varchar_columns(db, *fields):
@@ -179,14 +225,15 @@ def db_updater(args, q, db):
                     log.warning('%s... Retrying...', repr(e))
                     time.sleep(5)
 
-            # Loop the queue.
+            # Loop the queue, writing the updates in batches.
             while True:
-                data = q.get()
-                update_proxy(args, data, db)
-                q.task_done()
+                batch = q.get_batch(args.db_batch_size,
+                                    args.db_batch_delay / 1000.0)
+                update_proxies(args, batch, db)
+                q.batch_done()
 
                 # Helping out the GC.
-                del data
+                del batch
 
         except Exception as e:
             log.exception('Exception in db_updater: %s', repr(e))
@@ -209,6 +256,13 @@ def create_tables(db):
 def update_proxy(args, data, db):
     with db.atomic():
         try:
+            if is_verdict_update(data):
+                values = get_upsert_values(data)
+                del values['url']
+                ProxyPool.update(**values).where(
+                    ProxyPool.url == data['url']).execute()
+                return
+
             proxy, created = ProxyPool.get_or_create(url=data['url'])
             metadata = {}
             for key, value in data.items():
@@ -216,6 +270,8 @@ def update_proxy(args, data, db):
                     setattr(proxy, key, value)
                 else:
                     metadata[key] = value
+            if metadata.get('_latency') is not None:
+                update_latency(proxy, metadata['_latency'])
             proxy.last_modified = datetime.now()
             proxy.save()
             if args.log_db_updates:
@@ -235,6 +291,226 @@ def update_proxy(args, data, db):
                 time.sleep(1)
 
 
+# Write a batch of updates in one transaction, with a multi-row
+# INSERT ... ON DUPLICATE KEY UPDATE for each set of updated columns, or an
+# UPDATE of the existing proxies for check results. If that fails, the
+# updates are written one by one.
+def update_proxies(args, batch, db):
+    try:
+        with db.atomic():
+            for sql, params in get_upsert_statements(batch, db):
+                db.execute_sql(sql, params)
+    except Exception as e:
+        log.warning('%s... Writing %d updates one by one.', repr(e),
+                    len(batch))
+        for data in batch:
+            update_proxy(args, data, db)
+        return
+
+    if args.log_db_updates:
+        for data in batch:
+            log.info("Processed update for {}".format(data['url']))
+
+
+# Columns of the last check result, written by the verdict cache.
+verdict_columns = ('last_checked', 'last_check_stage', 'last_check_result')
+
+
+# Updates only holding a check result don't add proxies: scraped proxies
+# that weren't imported only keep their verdict in memory.
+def is_verdict_update(data):
+    return all(key == 'url' or key in verdict_columns for key in data)
+
+
+# Columns set on new rows when an update doesn't include them.
+upsert_defaults = ('working', 'invalid', 'banned', 'banned_retry_count',
+                   'failed', 'failed_retry_count')
+
+
+# The values written by an update by column name, like update_proxy() does.
+# Keys that aren't columns are left out. A check result on its own doesn't
+# modify the proxy.
+def get_upsert_values(data):
+    values = {}
+    for key, value in data.items():
+        if key in ProxyPool._meta.fields:
+            values[key] = value
+    if not is_verdict_update(data):
+        values['last_modified'] = datetime.now()
+
+    # The new latency is smoothed with the stored one by the statement.
+    latency = data.get('_latency')
+    if latency is not None:
+        connect, total = latency
+        values['connect_latency'] = connect
+        if total is not None:
+            values['last_latency'] = total
+            values['avg_latency'] = total
+
+    return values
+
+
+# Group the updates into (sql, params) statements, one per set of columns.
+# Updates are only grouped with earlier ones if that doesn't reorder the
+# updates of a proxy, which the update queue already merged anyway.
+def get_upsert_statements(batch, db):
+    statements = []
+    open_statements = {}
+    last_statement = {}
+    for data in batch:
+        values = get_upsert_values(data)
+        key = (is_verdict_update(data), tuple(sorted(values)))
+        index = open_statements.get(key)
+        if index is None or last_statement.get(data['url'], -1) >= index:
+            index = len(statements)
+            statements.append((key, []))
+            open_statements[key] = index
+
+        statements[index][1].append(values)
+        last_statement[data['url']] = index
+
+    sql = []
+    for (verdict, columns), rows in statements:
+        if verdict:
+            sql.append(get_update_statement(columns, rows, db))
+        else:
+            sql.append(get_upsert_statement(columns, rows, db))
+    return sql
+
+
+def get_upsert_statement(columns, rows, db):
+    fields = [ProxyPool._meta.fields[name] for name in columns]
+    fields += [ProxyPool._meta.fields[name] for name in upsert_defaults
+               if name not in columns]
+
+    def quote(field):
+        return db.quote_char + field.db_column + db.quote_char
+
+    params = []
+    for values in rows:
+        for field in fields:
+            params.append(field.db_value(values.get(field.name,
+                                                    field.default)))
+
+    updates = []
+    for field in fields[:len(columns)]:
+        if field.name == 'url':
+            continue
+        if field.name == 'avg_latency':
+            updates.append(
+                '{0} = IF({0} IS NULL, VALUES({0}), '
+                '{0} + {1} * VALUES({0}) - {1} * {0})'.format(
+                    quote(field), latency_smoothing))
+        else:
+            updates.append('{0} = VALUES({0})'.format(quote(field)))
+
+    row = '({})'.format(', '.join([db.interpolation] * len(fields)))
+    sql = ('INSERT INTO {0}{1}{0} ({2}) VALUES {3} '
+           'ON DUPLICATE KEY UPDATE {4}').format(
+        db.quote_char, ProxyPool._meta.db_table,
+        ', '.join(quote(field) for field in fields),
+        ', '.join([row] * len(rows)), ', '.join(updates))
+    return sql, params
+
+
+# Multi-row UPDATE of existing proxies, joined with the new values.
+def get_update_statement(columns, rows, db):
+    fields = [ProxyPool._meta.fields[name] for name in columns]
+
+    def quote(field):
+        return db.quote_char + field.db_column + db.quote_char
+
+    params = []
+    for values in rows:
+        for field in fields:
+            params.append(field.db_value(values[field.name]))
+
+    first_row = 'SELECT {}'.format(', '.join(
+        '{} AS {}'.format(db.interpolation, quote(field))
+        for field in fields))
+    row = 'SELECT {}'.format(', '.join([db.interpolation] * len(fields)))
+    sql = ('UPDATE {0}{1}{0} AS p JOIN ({2}) AS v ON p.{3} = v.{3} '
+           'SET {4}').format(
+        db.quote_char, ProxyPool._meta.db_table,
+        ' UNION ALL '.join([first_row] + [row] * (len(rows) - 1)),
+        quote(ProxyPool.url),
+        ', '.join('p.{0} = v.{0}'.format(quote(field)) for field in fields
+                  if field.name != 'url'))
+    return sql, params
+
+
+# Record a new latency measurement (connect, total) of a proxy.
+def update_latency(proxy, latency):
+    connect, total = latency
+    proxy.connect_latency = connect
+    if total is None:
+        return
+
+    proxy.last_latency = total
+    if proxy.avg_latency is None:
+        proxy.avg_latency = total
+    else:
+        proxy.avg_latency += latency_smoothing * (total - proxy.avg_latency)
+
+
+# Verdict cache backed by the last check result of each proxy. New results
+# are written through the DB updates queue, to the proxies in the pool:
+# those of scraped proxies that aren't imported are only kept in memory.
+class PoolVerdictCache(VerdictCache):
+
+    def __init__(self, ttls, db_updates_queue):
+        super(PoolVerdictCache, self).__init__(ttls)
+        self.db_updates_queue = db_updates_queue
+        self._loaded = set()
+
+    def _load(self, keys):
+        keys = [key for key in keys if key not in self._loaded]
+        if not keys:
+            return
+        self._loaded.update(keys)
+
+        # Proxy URLs are stored the way they were scraped, which is nearly
+        # always normalized already.
+        for x in xrange(0, len(keys), 500):
+            query = (ProxyPool
+                     .select(ProxyPool.url,
+                             ProxyPool.last_checked,
+                             ProxyPool.last_check_stage,
+                             ProxyPool.last_check_result)
+                     .where((ProxyPool.url << keys[x:x+500]) &
+                            (ProxyPool.last_checked.is_null(False))))
+            for p in query:
+                key = normalize_proxy_url(p.url)
+                if key not in self._entries:
+                    self._entries[key] = (
+                        p.last_check_stage, p.last_check_result,
+                        time.mktime(p.last_checked.timetuple()))
+
+    # Proxies are loaded again once their results expired.
+    def _expire(self, now):
+        super(PoolVerdictCache, self)._expire(now)
+        self._loaded.clear()
+
+    def put(self, proxy, stage, result):
+        super(PoolVerdictCache, self).put(proxy, stage, result)
+        update = self.get_update(proxy)
+        update['url'] = proxy
+        self.db_updates_queue.put(update)
+
+    # The last result of a proxy as update fields, so the update importing
+    # the proxy can record it too.
+    def get_update(self, proxy):
+        entry = self._entries.get(normalize_proxy_url(proxy))
+        if not entry:
+            return {}
+
+        stage, result, checked_at = entry
+        return {
+            'last_checked': datetime.fromtimestamp(checked_at),
+            'last_check_stage': stage,
+            'last_check_result': result}
+
+
 def working_proxy_count():
 
     query = (ProxyPool
@@ -272,7 +548,10 @@ def get_working_proxies():
     return proxies
 
 
-def get_filtered_proxies(working, banned, failed, invalid):
+# Proxies can be sorted by their smoothed latency (fastest first) and limited
+# to a maximum latency, proxies without latency are then left out.
+def get_filtered_proxies(working, banned, failed, invalid, sort=None,
+                         max_latency=None, limit=None):
 
     expression = (ProxyPool.url != '')
     first = True
@@ -304,8 +583,17 @@ def get_filtered_proxies(working, banned, failed, invalid):
         else:
             expression |= (ProxyPool.invalid == 1)
 
+    if max_latency is not None:
+        expression = (expression) & (ProxyPool.avg_latency <= max_latency)
+
     query = (ProxyPool.select().where(expression))
 
+    if sort == 'latency':
+        query = query.order_by(ProxyPool.avg_latency.is_null(),
+                               ProxyPool.avg_latency.asc())
+    if limit:
+        query = query.limit(limit)
+
     proxies = []
     for p in query:
         proxies.append(p)
@@ -335,7 +623,7 @@ def purge_invalid_proxies():
         log.error('Failed purge invalid proxies query: {}'.format(e))
 
 
-def add_proxy_direct(url, working, banned, failed):
+def add_proxy_direct(url, working, banned, failed, latency=None):
 
     proxy, created = ProxyPool.get_or_create(url=url)
     proxy.working = working
@@ -348,6 +636,9 @@ def add_proxy_direct(url, working, banned, failed):
         proxy.banned_retry_count = 0
         proxy.failed_retry_count = 0
 
+    if latency is not None:
+        update_latency(proxy, latency)
+
     proxy.save()
     log.info("add_proxy for {}. working: {}, failed: {}, banned: {}"
              .format(url, working, failed, banned))
@@ -50,6 +50,21 @@ def get_args():
                         help='Disable anonymous proxy test.',
                         default=False,
                         action='store_true')
+    parser.add_argument('-ps', '--prescreen',
+                        help=('Pre-screen proxies with a TCP connection ' +
+                              '(and SOCKS5 greeting) before testing them.'),
+                        default=False,
+                        action='store_true')
+    parser.add_argument('-pst', '--prescreen-timeout',
+                        help=('Pre-screen connection timeout. ' +
+                              'Default is 2 seconds.'),
+                        default=2,
+                        type=float)
+    parser.add_argument('-psc', '--prescreen-concurrency',
+                        help=('Maximum concurrent pre-screen connections. ' +
+                              'Default is 500.'),
+                        default=500,
+                        type=int)
 
     parser.add_argument('-er', '--extra-request',
                         help='Make an extra request to validate PTC.',
@@ -65,6 +80,19 @@ def get_args():
                         help='Maximum concurrent proxy testing requests.',
                         default=100,
                         type=int)
+    parser.add_argument('-ac', '--adaptive-concurrency',
+                        help=('Adjust the number of concurrent proxy ' +
+                              'testing requests to the observed timeout ' +
+                              'rate and latency, up to --max-concurrency.'),
+                        default=False,
+                        action='store_true')
+    parser.add_argument('-en', '--engine',
+                        help=('Proxy testing engine. "futures" uses a ' +
+                              'thread per request, "eventloop" runs all ' +
+                              'requests in a single thread. ' +
+                              'Default: futures'),
+                        default='futures',
+                        choices=('futures', 'eventloop'))
     parser.add_argument('-bs', '--batch-size',
                         help='Check proxies in batches of limited size.',
                         default=300,
@@ -73,13 +101,78 @@ def get_args():
                         help='Minimum number of good proxies to maintain.',
                         default=100,
                         type=int)
+    parser.add_argument('-ctw', '--cache-ttl-working',
+                        help=('Minutes to reuse the result of a working ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 0.'),
+                        default=0,
+                        type=int)
+    parser.add_argument('-ctb', '--cache-ttl-banned',
+                        help=('Minutes to reuse the result of a banned ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 30.'),
+                        default=30,
+                        type=int)
+    parser.add_argument('-ctf', '--cache-ttl-failed',
+                        help=('Minutes to reuse the result of a failed ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 30.'),
+                        default=30,
+                        type=int)
+    parser.add_argument('-ctt', '--cache-ttl-timeout',
+                        help=('Minutes to reuse the result of a timeout ' +
+                              'proxy instead of testing it again, 0 to ' +
+                              'always test. Default is 15.'),
+                        default=15,
+                        type=int)
     parser.add_argument('-ic', '--ignore-country',
                         help='Ignore proxies from countries in this list.',
                         action='append', default=['china'])
     parser.add_argument('-gu', '--geoip_url',
                         help='URL to lookup the geo-location/country of IP.',
-                        action='store_true',
                         default='http://www.freegeoip.net/json/{0}')
+    parser.add_argument('-gf', '--geoip-file',
+                        help=('Lookup the country of IPs in this local ' +
+                              'CSV range file (ip_from,ip_to,country_code' +
+                              '[,country_name], optionally gzipped) ' +
+                              'instead of using --geoip_url. Proxies ' +
+                              'from ignored countries are then dropped ' +
+                              'before testing.'),
+                        default=None)
+    parser.add_argument('-gcf', '--geoip-cache-file',
+                        help=('Keep the countries found with --geoip_url ' +
+                              'in this file between restarts. Default ' +
+                              'is geoip_cache.json.'),
+                        default='geoip_cache.json')
+    parser.add_argument('-gcs', '--geoip-cache-size',
+                        help=('Maximum number of proxy countries to ' +
+                              'keep cached. Default is 20000.'),
+                        default=20000,
+                        type=int)
+    parser.add_argument('-gct', '--geoip-cache-ttl',
+                        help=('Minutes to reuse a cached proxy country ' +
+                              'before looking it up again. Default is ' +
+                              '10080 (a week).'),
+                        default=10080,
+                        type=int)
+    parser.add_argument('--page-cache-file',
+                        help=('Keep scraped webpages in this file and ' +
+                              'only parse them again when they change, ' +
+                              'empty to disable. Default is ' +
+                              'page_cache.json.'),
+                        default='page_cache.json')
+    parser.add_argument('--post-index-file',
+                        help=('Keep the posts harvested from each proxy ' +
+                              'list blog in this file and only scrape ' +
+                              'new posts, empty to disable. Default is ' +
+                              'post_index.json.'),
+                        default='post_index.json')
+    parser.add_argument('--post-freshness',
+                        help=('Minutes after a post is first harvested ' +
+                              'during which it is scraped again, as it may ' +
+                              'still be updated. Default is 1440 (a day).'),
+                        default=1440,
+                        type=int)
 
     parser.add_argument('--host',
                         help='Binding IP.',
@@ -105,6 +198,15 @@ def get_args():
     parser.add_argument('--db-max-connections',
                         help='Database max connections.',
                         type=int, default=20)
+    parser.add_argument('--db-batch-size',
+                        help=('Write up to this many queued proxy ' +
+                              'updates to the database at once. ' +
+                              'Default 200.'),
+                        type=int, default=200)
+    parser.add_argument('--db-batch-delay',
+                        help=('Milliseconds to wait for more proxy ' +
+                              'updates to write at once. Default 100.'),
+                        type=int, default=100)
 
     onstrt = parser.add_mutually_exclusive_group()
     onstrt.add_argument('--initial-validate-working',
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from threading import Lock
+
+from .shared_utils import load_json, save_json
+
+log = logging.getLogger('pgproxy')
+
+# Posts no longer listed by their source for this long are forgotten.
+post_index_expiry = 30 * 24 * 3600
+
+
+# Post URLs found on the index pages of blog-style sources, by source, kept
+# in a JSON file between runs. Entries are [harvested, last_listed] times,
+# harvested being when proxies were first parsed from the post, or None.
+# Posts are scraped until they're harvested, and then within the freshness
+# window (in seconds) after that.
+class PostIndex(object):
+
+    def __init__(self, filename, freshness):
+        self.filename = filename
+        self.freshness = freshness
+        self.new = 0
+        self.fresh = 0
+        self.skipped = 0
+        self._sources = {}
+        self._lock = Lock()
+
+        sources = load_json(filename, 'post index')
+        if sources is not None:
+            self._sources = sources
+            log.info('Loaded %d indexed posts from %s.',
+                     sum(len(posts) for posts in self._sources.values()),
+                     filename)
+
+    # Returns the post URLs listed by a source that should be scraped.
+    def select(self, source, urls):
+        now = time.time()
+        selected = []
+        with self._lock:
+            posts = self._sources.setdefault(source, {})
+            for url in urls:
+                entry = posts.setdefault(url, [None, now])
+                entry[1] = now
+                if entry[0] is None:
+                    self.new += 1
+                    selected.append(url)
+                elif now - entry[0] < self.freshness:
+                    self.fresh += 1
+                    selected.append(url)
+                else:
+                    self.skipped += 1
+
+        if len(selected) < len(urls):
+            log.info('Skipping %d already harvested posts of %s.',
+                     len(urls) - len(selected), source)
+        return selected
+
+    # Records that proxies were parsed from a post.
+    def harvested(self, url):
+        with self._lock:
+            for posts in self._sources.values():
+                entry = posts.get(url)
+                if entry and entry[0] is None:
+                    entry[0] = time.time()
+
+    def log_stats(self):
+        log.info('Post index: %d new posts, %d fresh, %d skipped.',
+                 self.new, self.fresh, self.skipped)
+        self.new = 0
+        self.fresh = 0
+        self.skipped = 0
+
+    # Writes the posts still listed recently.
+    def save(self):
+        now = time.time()
+        with self._lock:
+            sources = {}
+            for source, posts in self._sources.items():
+                sources[source] = dict(
+                    (url, entry) for url, entry in posts.items()
+                    if now - entry[1] < post_index_expiry)
+
+        save_json(self.filename, sources, 'post index')
@@ -2,45 +2,85 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import os
 import re
 import requests
+import time
 import jsbeautifier.unpackers.packer as packer
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from tempfile import SpooledTemporaryFile
+from threading import Lock
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
+from urlparse import urlsplit
 
 from bs4 import BeautifulSoup
 from zipfile import ZipFile, is_zipfile
 
-from .utils import validate_ip
+from .html_extract import (get_classes, get_text, iter_elements,
+                           iter_start_tags, unescape)
+from .page_cache import get_content_hash
+from .shared_utils import validate_ip
 
 log = logging.getLogger('pgproxy')
 
+# Pages downloaded at the same time, in total and from any single host.
+scrape_workers = 12
+scrape_host_concurrency = 2
 
-def download_webpage(target_url, proxy=None, timeout=5):
-    try:
-        s = requests.Session()
+# Downloaded files are read in chunks of this size, and kept in memory up to
+# spool_max_size.
+download_chunk_size = 64 * 1024
+spool_max_size = 8 * 1024 * 1024
+
+# Extract proxy lists from known page structures without BeautifulSoup when
+# possible. Disable to always parse pages with BeautifulSoup.
+fast_extraction = True
+
+# Seconds the values decoded from port obfuscation scripts are reused.
+script_cache_ttl = 3600
+
+
+# Shared by all the scraper threads, so pages from the same host reuse
+# their connections.
+_session = None
+_session_lock = Lock()
 
-        retries = Retry(total=3,
-                        backoff_factor=0.5,
-                        status_forcelist=[500, 502, 503, 504])
 
-        s.mount('http://', HTTPAdapter(max_retries=retries))
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
 
-        headers = {
-            'User-Agent': ('Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) ' +
-                           'Gecko/20100101 Firefox/54.0'),
-            'Referer': 'http://google.com'
-        }
+            retries = Retry(total=3,
+                            backoff_factor=0.5,
+                            status_forcelist=[500, 502, 503, 504])
 
-        r = s.get(target_url,
-                  proxies={'http': proxy, 'https': proxy},
-                  timeout=timeout,
-                  headers=headers)
+            # Keep a connection per scraper thread to each host.
+            adapter = HTTPAdapter(pool_connections=scrape_workers,
+                                  pool_maxsize=scrape_workers,
+                                  max_retries=retries)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
 
-        if r.status_code == 200:
-            return r.content
+            _session.headers.update({
+                'User-Agent': ('Mozilla/5.0 (Windows NT 6.1; WOW64; ' +
+                               'rv:54.0) Gecko/20100101 Firefox/54.0'),
+                'Referer': 'http://google.com'
+            })
+
+        return _session
+
+
+# Returns the response for a webpage, or None if the request failed.
+def download_page(target_url, proxy=None, timeout=5, headers=None):
+    try:
+        return get_session().get(target_url,
+                                 proxies={'http': proxy, 'https': proxy},
+                                 timeout=timeout,
+                                 headers=headers)
 
     except Exception as e:
         log.exception('Failed do download webpage from %s: %s.', target_url, e)
@@ -48,24 +88,110 @@ def download_webpage(target_url, proxy=None, timeout=5):
     return None
 
 
-def download_file(target_url, filename):
+def download_webpage(target_url, proxy=None, timeout=5):
+    r = download_page(target_url, proxy, timeout)
+    if r is not None and r.status_code == 200:
+        return r.content
+
+    return None
+
+
+# Returns a file object with the downloaded file, or None if the download
+# failed. Files are kept in memory, or spooled to disk past spool_max_size.
+def download_file(target_url, timeout=30):
+    f = SpooledTemporaryFile(max_size=spool_max_size)
     try:
-        headers = {
-            'User-Agent': ('Mozilla/5.0 (Windows NT 6.1; WOW64; rv:54.0) ' +
-                           'Gecko/20100101 Firefox/54.0'),
-            'Referer': 'http://google.com'
-        }
-        r = requests.get(target_url, headers=headers)
+        r = get_session().get(target_url, stream=True, timeout=timeout)
+        r.raise_for_status()
 
-        with open(filename, 'wb') as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
+        for chunk in r.iter_content(chunk_size=download_chunk_size):
+            f.write(chunk)
 
     except Exception as e:
         log.exception('Failed do download file from %s: %s.', target_url, e)
-        return False
+        f.close()
+        return None
+
+    f.seek(0)
+    return f
+
+
+# What was decoded from the scripts obfuscating port numbers, keyed by the
+# hash of the script, so each script is only decoded once per TTL. Scripts
+# downloaded from a URL aren't downloaded again until they expire. Decoded
+# values are shared and must not be modified.
+class ScriptCache(object):
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._urls = {}
+        self._decoded = {}
+        self._lock = Lock()
+
+    # Returns decode(script), from the cache if the script was seen before.
+    # Empty results aren't cached.
+    def decode(self, script, decode):
+        key = get_script_hash(script)
+        now = time.time()
+        with self._lock:
+            entry = self._decoded.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.hits += 1
+                return entry[0]
+
+        value = decode(script)
+        with self._lock:
+            self.misses += 1
+            if value:
+                self._expire(now)
+                self._decoded[key] = (value, now)
+        return value
+
+    # Returns decode() of the script at url, only downloading it again once
+    # it expired. Returns None if the download failed.
+    def decode_url(self, url, decode):
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry and now - entry[1] < self.ttl:
+                decoded = self._decoded.get(entry[0])
+                if decoded:
+                    self.hits += 1
+                    return decoded[0]
+
+        script = download_webpage(url)
+        if script is None:
+            return None
+
+        value = self.decode(script, decode)
+        if value:
+            with self._lock:
+                self._urls[url] = (get_script_hash(script), now)
+        return value
 
-    return True
+    def _expire(self, now):
+        for cache in (self._urls, self._decoded):
+            for key, entry in cache.items():
+                if now - entry[1] >= self.ttl:
+                    del cache[key]
+
+    def log_stats(self):
+        if self.hits or self.misses:
+            log.info('Script cache: %d decoded, %d reused.',
+                     self.misses, self.hits)
+        self.hits = 0
+        self.misses = 0
+
+
+script_cache = ScriptCache(script_cache_ttl)
+
+
+def get_script_hash(script):
+    if isinstance(script, unicode):
+        script = script.encode('utf-8')
+    return get_content_hash(script)
 
 
 # Sockslist.net uses javascript to obfuscate proxies port number.
@@ -112,37 +238,84 @@ def crazy_decode(dictionary, code):
         return answer
 
 
+# Extract from the HTML with the fast path if possible, otherwise with
+# BeautifulSoup: fast(html) returns None when it doesn't find what it looks
+# for, soup(soup) works on the parsed document.
+def extract(html, fast, soup):
+    if fast_extraction:
+        result = fast(html)
+        if result is not None:
+            return result
+
+    return soup(BeautifulSoup(html, 'html.parser'))
+
+
+# Scripts and proxy table rows (ip, port cell, country) of a sockslist page.
+def extract_sockslist(html):
+    for attrs, table in iter_elements(html, 'table'):
+        if 'proxytbl' in get_classes(attrs):
+            break
+    else:
+        return None
+
+    rows = []
+    for attrs, row in iter_elements(table, 'tr'):
+        cells = {}
+        for td_attrs, cell in iter_elements(row, 'td'):
+            for name in get_classes(td_attrs):
+                cells.setdefault(name, cell)
+        if 't_ip' not in cells:
+            continue
+
+        # The port is written by a script, which we keep as is.
+        rows.append((get_text(cells['t_ip']), cells.get('t_port', ''),
+                     get_text(cells.get('t_country', ''))))
+
+    scripts = [script for attrs, script in iter_elements(html, 'script')]
+    return scripts, rows
+
+
+def extract_sockslist_soup(soup):
+    scripts = [script.get_text() for script in soup.find_all('script')]
+
+    table = soup.find('table', class_='proxytbl')
+    if table is None:
+        return scripts, None
+
+    rows = []
+    for table_row in table.find_all('tr'):
+        ip_td = table_row.find('td', class_='t_ip')
+        if ip_td is None:
+            continue
+        rows.append((ip_td.get_text(),
+                     table_row.find('td', class_='t_port').get_text(),
+                     table_row.find('td', class_='t_country').get_text()))
+
+    return scripts, rows
+
+
 def parse_sockslist(html, ignore_country=[]):
     proxies = []
     dictionary = {}
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
+    scripts, rows = extract(html, extract_sockslist, extract_sockslist_soup)
 
-    for script in soup.find_all('script'):
-        code = script.get_text()
+    for code in scripts:
         for line in code.split('\n'):
             if '^' in line and ';' in line and ' = ' in line:
                 line = line.strip()
                 log.debug('Found crazy XOR decoding secret code.')
-                dictionary = parse_crazy_encoding(line)
+                dictionary = script_cache.decode(line, parse_crazy_encoding)
                 log.debug('Crazy XOR decoding dictionary: %s', dictionary)
 
-    table = soup.find('table', class_='proxytbl')
-    if table is None:
+    if rows is None:
         log.error('Unable to find table with proxy list.')
         return proxies
 
-    for table_row in table.find_all('tr'):
-        ip_td = table_row.find('td', class_='t_ip')
-        if ip_td is None:
-            continue
-        ip = ip_td.get_text()
-
+    for ip, port_text, country in rows:
         if not validate_ip(ip):
             log.warning('Invalid IP found: %s', ip)
             continue
 
-        port_text = table_row.find('td', class_='t_port').get_text()
         try:
             # Find encoded string with proxy port.
             m = re.search('(?<=document.write\()([\w\d\^]+)\)', port_text)
@@ -154,7 +327,6 @@ def parse_sockslist(html, ignore_country=[]):
         except Exception as e:
             log.error('Unable to parse proxy port: %s', repr(e))
             continue
-        country = table_row.find('td', class_='t_country').get_text()
 
         if country in ignore_country:
             continue
@@ -163,301 +335,313 @@ def parse_sockslist(html, ignore_country=[]):
     return proxies
 
 
-def scrape_sockslist_net(ignore_country):
-    urls = (
+def sockslist_net_tasks(ignore_country):
+    def parse(html):
+        return parse_sockslist(html, ignore_country)
+
+    return [(url, parse, None, False) for url in (
         'https://sockslist.net/list/proxy-socks-5-list#proxylist',
         'https://sockslist.net/list/proxy-socks-5-list/2#proxylist',
-        'https://sockslist.net/list/proxy-socks-5-list/3#proxylist'
-    )
-    proxylist = set()
-    for url in urls:
-        html = download_webpage(url)
-        if html is None:
-            log.error('Failed to download webpage: %s', url)
-            continue
-        proxies = parse_sockslist(html, ignore_country)
-        proxylist.update(proxies)
-        log.info('Parsed webpage %s and got %d socks5 proxies.',
-                 url, len(proxies))
+        'https://sockslist.net/list/proxy-socks-5-list/3#proxylist')]
 
-    return proxylist
 
+# Text of the textarea holding the proxy list of a blog post.
+def extract_textarea(html):
+    for attrs, text in iter_elements(html, 'textarea'):
+        if attrs.get('onclick') == 'this.focus();this.select()':
+            if '<' in text:
+                return None
+            return unescape(text)
 
-def parse_socksproxylist24(html):
-    proxies = []
-    soup = BeautifulSoup(html, 'html.parser')
-    content = soup.prettify()
+    return None
+
+
+def extract_textarea_soup(soup):
+    textarea = soup.find('textarea', onclick='this.focus();this.select()')
+    if textarea is None:
+        return None
+    return textarea.get_text()
 
-    proxylist = soup.find('textarea', onclick='this.focus();this.select()')
-    if proxylist is None:
-        log.error('Unable to find textarea with proxy list.')
-        return proxies
 
-    proxylist = proxylist.get_text().split('\n')
-    for proxy in proxylist:
+def parse_proxy_lines(lines, protocol):
+    proxies = []
+    for proxy in lines:
         proxy = proxy.strip()
         if proxy and validate_ip(proxy.split(':')[0]):
-            proxies.append('socks5://{}'.format(proxy))
+            proxies.append('{}://{}'.format(protocol, proxy))
 
-    if not proxies:
-        log.debug('Blank webpage: %s', content)
     return proxies
 
 
-def parse_socksproxylist24_links(html):
+# Post URLs listed on the index page of a blog.
+def extract_post_links(html):
     urls = []
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
+    for attrs, post_title in iter_elements(html, 'h3'):
+        if get_classes(attrs) != ['post-title', 'entry-title']:
+            continue
+        for link_attrs in iter_start_tags(post_title, 'a'):
+            urls.append(link_attrs.get('href'))
+            break
+
+    return urls or None
+
 
+def extract_post_links_soup(soup):
+    urls = []
     for post_title in soup.find_all('h3', class_='post-title entry-title'):
         url = post_title.find('a')
         if url is None:
             continue
-        url = url.get('href')
+        urls.append(url.get('href'))
+
+    return urls
+
+
+def parse_post_links(html):
+    urls = extract(html, extract_post_links, extract_post_links_soup)
+    for url in urls:
         log.debug('Found potential proxy list in: %s', url)
-        urls.append(url)
 
     return urls
 
 
-def scrape_socksproxylist24_top():
-    url = 'http://www.socksproxylist24.top'
-    proxylist = set()
+def parse_socksproxylist24(html):
+    proxylist = extract(html, extract_textarea, extract_textarea_soup)
+    if proxylist is None:
+        log.error('Unable to find textarea with proxy list.')
+        return []
+
+    proxies = parse_proxy_lines(proxylist.split('\n'), 'socks5')
+    if not proxies:
+        log.debug('Blank webpage: %s', html)
+    return proxies
+
 
-    html = download_webpage(url)
-    if html is None:
-        log.error('Failed to download webpage: %s', url)
-        return proxylist
+def parse_socksproxylist24_links(html):
+    return parse_post_links(html)
 
-    urls = parse_socksproxylist24_links(html)
-    log.info('Parsed webpage %s and got %d links to proxylists.',
-             url, len(urls))
 
-    for url in urls:
-        html = download_webpage(url)
-        if html is None:
-            log.error('Failed to download webpage: %s', url)
-            continue
-        proxies = parse_socksproxylist24(html)
-        proxylist.update(proxies)
-        log.info('Parsed webpage %s and got %d socks5 proxies.',
-                 url, len(proxies))
+def socksproxylist24_top_tasks():
+    return [('http://www.socksproxylist24.top',
+             parse_socksproxylist24_links, parse_socksproxylist24, True)]
+
+
+# Proxy list of a vipsocks24 post and the URL of its zipped version, only
+# looked for when the list isn't on the page.
+def extract_vipsocks24(html):
+    proxylist = extract_textarea(html)
+    if proxylist is None:
+        return None
+    return proxylist, None
+
 
-    return proxylist
+def extract_vipsocks24_soup(soup):
+    proxylist = extract_textarea_soup(soup)
+    if proxylist is not None:
+        return proxylist, None
+
+    download_button = soup.find('img', alt='Download')
+    if download_button is None or download_button.parent.name != 'a':
+        return None, None
+    return None, download_button.parent.get('href')
 
 
 def parse_vipsocks24(html):
     proxies = []
-    soup = BeautifulSoup(html, 'html.parser')
-    content = soup.prettify()
+    proxylist, proxylist_url = extract(html, extract_vipsocks24,
+                                       extract_vipsocks24_soup)
 
-    proxylist = soup.find('textarea', onclick='this.focus();this.select()')
     if proxylist is None:
-        log.error('Unable to find textarea with proxy list.')
-        download_button = soup.find('img', alt='Download')
-        if download_button is None or download_button.parent.name != 'a':
+        if proxylist_url is None:
+            log.error('Unable to find textarea with proxy list.')
             log.error('Unable to find download button for proxy list.')
         else:
-            proxylist_url = download_button.parent.get('href')
-            download_path = 'download'
-            if not os.path.exists(download_path):
-                os.makedirs(download_path)
-
-            filename = '{}/vipsocks24.zip'.format(download_path)
-            if download_file(proxylist_url, filename) and is_zipfile(filename):
-                with ZipFile(filename, 'r') as myzip:
-                    for proxyfile in myzip.namelist():
-                        if not proxyfile.endswith('.txt'):
-                            log.debug('Skipped archived file %s.', proxyfile)
-                            continue
-                        with myzip.open(proxyfile, 'rU') as proxylist:
-                            for proxy in proxylist:
-                                proxy = proxy.strip()
-                                if proxy and validate_ip(proxy.split(':')[0]):
-                                    proxies.append('socks5://{}'.format(proxy))
+            log.debug('Proxy list is zipped: %s', proxylist_url)
+            proxies = parse_vipsocks24_zip(proxylist_url)
         return proxies
 
-    proxylist = proxylist.get_text().split('\n')
-    for proxy in proxylist:
-        proxy = proxy.strip()
-        if proxy and validate_ip(proxy.split(':')[0]):
-            proxies.append('socks5://{}'.format(proxy))
-
+    proxies = parse_proxy_lines(proxylist.split('\n'), 'socks5')
     if not proxies:
-        log.debug('Blank webpage: %s', content)
+        log.debug('Blank webpage: %s', html)
     return proxies
 
 
-def parse_vipsocks24_links(html):
-    urls = []
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
-
-    for post_title in soup.find_all('h3', class_='post-title entry-title'):
-        url = post_title.find('a')
-        if url is None:
-            continue
-        url = url.get('href')
-        log.debug('Found potential proxy list in: %s', url)
-        urls.append(url)
-
-    return urls
+# Proxies of the text files in a zipped proxy list, read line by line.
+def parse_vipsocks24_zip(url):
+    proxies = []
+    archive = download_file(url)
+    if archive is None:
+        return proxies
 
+    with archive:
+        if not is_zipfile(archive):
+            log.error('Downloaded proxy list is not a zip file: %s', url)
+            return proxies
 
-def scrape_vipsocks24_net():
-    url = 'http://vipsocks24.net/'
-    proxylist = set()
+        with ZipFile(archive, 'r') as myzip:
+            for proxyfile in myzip.namelist():
+                if not proxyfile.endswith('.txt'):
+                    log.debug('Skipped archived file %s.', proxyfile)
+                    continue
+                with myzip.open(proxyfile, 'rU') as proxylist:
+                    proxies.extend(parse_proxy_lines(proxylist, 'socks5'))
 
-    html = download_webpage(url)
-    if html is None:
-        log.error('Failed to download webpage: %s', url)
-        return proxylist
+    return proxies
 
-    urls = parse_vipsocks24_links(html)
-    log.info('Parsed webpage %s and got %d links to proxylists.',
-             url, len(urls))
 
-    for url in urls:
-        html = download_webpage(url)
-        if html is None:
-            log.error('Failed to download webpage: %s', url)
-            continue
-        proxies = parse_vipsocks24(html)
-        proxylist.update(proxies)
-        log.info('Parsed webpage %s and got %d socks5 proxies.',
-                 url, len(proxies))
+def parse_vipsocks24_links(html):
+    return parse_post_links(html)
 
-    return proxylist
 
+def vipsocks24_net_tasks():
+    return [('http://vipsocks24.net/',
+             parse_vipsocks24_links, parse_vipsocks24, True)]
 
-def scrape_proxyserverlist24_top():
-    url = 'http://proxyserverlist24.top/'
-    proxylist = set()
 
-    html = download_webpage(url)
-    if html is None:
-        log.error('Failed to download webpage: %s', url)
-        return proxylist
+def proxyserverlist24_top_tasks():
+    return [('http://proxyserverlist24.top/',
+             parse_proxyserverlist24_links, parse_proxyserverlist24, True)]
 
-    urls = parse_proxyserverlist24_links(html)
-    log.info('Parsed webpage %s and got %d links to proxylists.',
-             url, len(urls))
 
-    for url in urls:
-        html = download_webpage(url)
-        if html is None:
-            log.error('Failed to download webpage: %s', url)
+# Proxy list of a proxyserverlist24 post, in the third span of a <pre>.
+def extract_proxyserverlist24(html):
+    for attrs, container in iter_elements(html, 'pre'):
+        if 'alt2' not in get_classes(attrs) or attrs.get('dir') != 'ltr':
             continue
-        proxies = parse_proxyserverlist24(html)
-        proxylist.update(proxies)
-        log.info('Parsed webpage %s and got %d http proxies.',
-                 url, len(proxies))
 
-    return proxylist
+        # Nested spans would be counted differently.
+        spans = [text for attrs, text in iter_elements(container, 'span')]
+        if len(spans) < 3 or any('<span' in text for text in spans[:3]):
+            return None
+        return get_text(spans[2])
 
+    return None
 
-def parse_proxyserverlist24(html):
-    proxies = []
-    soup = BeautifulSoup(html, 'html.parser')
-    content = soup.prettify()
 
+def extract_proxyserverlist24_soup(soup):
     container = soup.find('pre', attrs={'class': 'alt2', 'dir': 'ltr'})
     if not container:
-        log.error('Unable to find element with proxy list.')
-        return proxies
+        return None
 
     spans = container.find_all('span')
     if not spans or len(spans) < 3:
-        log.error('Unable to find element with proxy list.')
-        return proxies
+        return None
+    return spans[2].get_text()
 
-    proxylist = spans[2].get_text().split('\n')
-    for proxy in proxylist:
-        proxy = proxy.strip()
-        if proxy and validate_ip(proxy.split(':')[0]):
-            proxies.append('http://{}'.format(proxy))
 
+def parse_proxyserverlist24(html):
+    proxylist = extract(html, extract_proxyserverlist24,
+                        extract_proxyserverlist24_soup)
+    if proxylist is None:
+        log.error('Unable to find element with proxy list.')
+        return []
+
+    proxies = parse_proxy_lines(proxylist.split('\n'), 'http')
     if not proxies:
-        log.debug('Blank webpage: %s', content)
+        log.debug('Blank webpage: %s', html)
     return proxies
 
 
 def parse_proxyserverlist24_links(html):
-    urls = []
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
+    return parse_post_links(html)
 
-    for post_title in soup.find_all('h3', class_='post-title entry-title'):
-        url = post_title.find('a')
-        if url is None:
-            continue
-        url = url.get('href')
-        log.debug('Found potential proxy list in: %s', url)
-        urls.append(url)
 
-    return urls
+def premproxy_free_tasks(ignore_country):
+    base_url = 'https://premproxy.com'
+    list_url = 'https://premproxy.com/list/'
 
+    def parse_pages(html):
+        return parse_premproxy_free_pages(base_url, list_url, html)
 
-def scrape_premproxy_free(ignore_country):
+    def parse(html):
+        return parse_premproxy_free(base_url, ignore_country, html)
 
-    proxylist = set()
-    base_url = 'https://premproxy.com'
-    list_url = 'https://premproxy.com/list/'
+    return [(list_url, parse_pages, parse, False)]
 
-    # Extract the available pages
-    urls = extract_preproxy_free_pages(list_url)
-    if len(urls) == 0:
-        log.error('Failed to obtain pages: %s', list_url)
-        return proxylist
 
-    # Now go through each of the page links and extract the data.
-    for url in urls:
+# Text and URL of the pagination links of a premproxy page.
+def extract_pagination(html):
+    for attrs, pagination in iter_elements(html, 'ul'):
+        if 'pagination' in get_classes(attrs):
+            return [(get_text(text), link_attrs.get('href'))
+                    for link_attrs, text in iter_elements(pagination, 'a')]
 
-        if "list" in url:
-            page_url = base_url + url
-        else:
-            page_url = list_url + url
+    return None
 
-        html = download_webpage(page_url)
-        if html is None:
-            log.error('Failed to download webpage: %s', page_url)
-            continue
 
-        proxies = parse_premproxy_free(
-            base_url, ignore_country, html)
-        proxylist.update(proxies)
-        log.info('Parsed webpage %s and got %d http proxies.',
-                 page_url, len(proxies))
+def extract_pagination_soup(soup):
+    pagination = soup.find('ul', class_='pagination')
+    if not pagination:
+        return None
 
-    return proxylist
+    return [(link.get_text(), link.get('href'))
+            for link in pagination.findAll("a")]
 
 
-def extract_preproxy_free_pages(list_url):
+# Extract the available pages.
+def parse_premproxy_free_pages(base_url, list_url, html):
 
     urls = []
 
-    html = download_webpage(list_url)
-    if html is None:
-        log.error('Failed to download webpage: %s', list_url)
-        return urls
-
     # Check to see how many additional pages we can grab.
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
-
-    pagination = soup.find('ul', class_='pagination')
-    if not pagination:
+    links = extract(html, extract_pagination, extract_pagination_soup)
+    if not links:
         log.error('Unable to find element with proxy list.')
         return urls
 
-    links = pagination.findAll("a")
-    for link in links:
-        if not link.get_text() == 'next':
-            urls.append(link.get('href'))
+    for text, url in links:
+        if text == 'next':
+            continue
+
+        if "list" in url:
+            urls.append(base_url + url)
+        else:
+            urls.append(list_url + url)
 
     return urls
 
 
+# Script sources and proxy rows (country, checkbox attributes) of a
+# premproxy page.
+def extract_premproxy(html):
+    rows = []
+    for attrs, row in iter_elements(html, 'tr'):
+        if not set(get_classes(attrs)) & set(('anon', 'transp')):
+            continue
+
+        country = None
+        for td_attrs, cell in iter_elements(row, 'td'):
+            if td_attrs.get('data-label') == 'Country: ':
+                country = get_text(cell)
+                break
+
+        input = next(iter_start_tags(row, 'input'), None)
+        rows.append((country, input))
+
+    if not rows:
+        return None
+
+    scripts = [attrs.get('src')
+               for attrs, script in iter_elements(html, 'script')]
+    return scripts, rows
+
+
+def extract_premproxy_soup(soup):
+    scripts = [script.get('src') for script in soup.findAll('script')]
+
+    rows = []
+    for row in soup.findAll('tr', ["anon", "transp"]):
+        country = None
+        country_td = row.find('td', attrs={'data-label': 'Country: '})
+        if country_td:
+            country = country_td.get_text()
+
+        input = row.find('input')
+        rows.append((country, input.attrs if input else None))
+
+    return scripts, rows
+
+
 def parse_premproxy_free(base_url, ignore_country, html):
 
     proxies = []
@@ -465,65 +649,60 @@ def parse_premproxy_free(base_url, ignore_country, html):
         log.info('no page')
         return proxies
 
-    soup = BeautifulSoup(html, 'html.parser')
-    soup.prettify()
+    scripts, rows = extract(html, extract_premproxy, extract_premproxy_soup)
 
     # For now, we'll assume <script> #2 in the list is the one with ports.
-    scripts = soup.findAll('script')
-    js_url = base_url + scripts[1].get('src')
+    js_url = base_url + scripts[1]
     ports = extract_ports(js_url)
     if (len(ports) == 0):
         log.info('no ports')
         return proxies
 
     # Verify that a row contains ip/port and country.
-    container = soup.find('tr', ["anon", "transp"])
-    if not container:
+    if not rows:
         log.error('Unable to find element with proxy list.')
         return proxies
 
+    return get_premproxy_proxies(rows, ports, ignore_country)
+
+
+def get_premproxy_proxies(rows, ports, ignore_country):
+
     # Go through each row and pull out the informaton wanted.
     ips = []
-    for row in soup.findAll('tr', ["anon", "transp"]):
+    for country, input in rows:
 
-        # Extract and check against ignored countries.
-        country_td = row.find('td', attrs={'data-label': 'Country: '})
-        if country_td:
-            country = country_td.get_text().lower()
-            if country in ignore_country:
-                continue
+        # Check against ignored countries.
+        if country is not None and country.lower() in ignore_country:
+            continue
 
         # The ip/port list is provided via the checkbox, so grab it.
-        input = row.find('input')
-        if input['type'] in ('checkbox'):
-            value = ''
-            if input.has_attr('value'):
-                value = input['value']
-                if value is not None:
-                    # Assume "IP | css"
-                    parts = value.split('|')
-                    if (len(parts) == 2):
-                        if parts[1] in ports:
-                            url = "{}:{}".format(parts[0], ports[parts[1]])
-                            ips.append(url)
-
-    for ip in ips:
-        ip = ip.strip()
-        if ip and validate_ip(ip.split(':')[0]):
-            proxies.append('http://{}'.format(ip))
+        if input is None or input.get('type') != 'checkbox':
+            continue
 
-    return proxies
+        value = input.get('value')
+        if value is not None:
+            # Assume "IP | css"
+            parts = value.split('|')
+            if (len(parts) == 2):
+                if parts[1] in ports:
+                    url = "{}:{}".format(parts[0], ports[parts[1]])
+                    ips.append(url)
+
+    return parse_proxy_lines(ips, 'http')
 
 
 def extract_ports(js_url):
+    ports = script_cache.decode_url(js_url, decode_ports)
+    if ports is None:
+        log.error('Failed to download webpage: %s', js_url)
+        return {}
+    return ports
 
-    dict = {}
 
-    # Download the JS file.
-    html = download_webpage(js_url)
-    if html is None:
-        log.error('Failed to download webpage: %s', js_url)
-        return dict
+def decode_ports(html):
+
+    dict = {}
 
     try:
         # For now, try and extract out the css/port pairs from the JS.
@@ -548,5 +727,111 @@ def extract_ports(js_url):
         return dict
 
     except Exception as e:
-        log.exception('Failed do extract ports from %s: %s.', js_url, e)
+        log.exception('Failed do extract ports: %s.', e)
         return dict
+
+
+def scrape_task(url, parse, parse_linked, posts, page_cache=None,
+                post_index=None):
+    headers = None
+    if page_cache:
+        headers = page_cache.get_headers(url)
+
+    r = download_page(url, headers=headers)
+    if r is None:
+        log.error('Failed to download webpage: %s', url)
+        return [], []
+
+    # Unchanged pages aren't parsed again.
+    result = None
+    if page_cache:
+        result = page_cache.get_result(url, r)
+
+    if result is not None:
+        log.info('Webpage %s is unchanged, reusing its %d results.',
+                 url, len(result))
+    elif r.status_code != 200:
+        log.error('Failed to download webpage: %s', url)
+        return [], []
+    else:
+        result = parse(r.content)
+        if page_cache:
+            page_cache.put(url, r, result)
+
+        if parse_linked is None:
+            log.info('Parsed webpage %s and got %d proxies.',
+                     url, len(result))
+        else:
+            log.info('Parsed webpage %s and got %d links to proxylists.',
+                     url, len(result))
+
+    if parse_linked is None:
+        # Posts are only harvested once proxies were parsed from them, e.g.
+        # not when the list they link to failed to download.
+        if post_index and result:
+            post_index.harvested(url)
+        return result, []
+
+    # Only scrape the posts we haven't harvested yet.
+    urls = result
+    if posts and post_index:
+        urls = post_index.select(url, result)
+    return [], [(url, parse_linked, None, False) for url in urls]
+
+
+# Scrape proxy lists concurrently and yield (source, url, proxies, elapsed)
+# as each page is parsed, elapsed being the seconds spent on the page.
+# source_tasks is a list of (source, tasks), source tagging the results of
+# its tasks and of the pages they link to. A task is (url, parse,
+# parse_linked, posts): parse(html) returns the proxies found on the page,
+# or with parse_linked set, the URLs of the pages with proxies, which are
+# then scraped with parse_linked. posts is set for blogs, whose linked pages
+# are posts that don't change once published. With a page cache, pages that
+# didn't change since they were last scraped aren't parsed again. With a
+# post index, linked pages are only scraped while they're new.
+def iter_scrape(source_tasks, page_cache=None, post_index=None,
+                workers=scrape_workers,
+                host_concurrency=scrape_host_concurrency):
+    pending = deque((source, task)
+                    for source, tasks in source_tasks for task in tasks)
+    running = {}
+    host_counts = {}
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while pending or running:
+            # Start the tasks whose host isn't busy, keep the others queued.
+            queued = deque()
+            while pending:
+                source, task = pending.popleft()
+                host = urlsplit(task[0]).hostname
+                if (len(running) >= workers or
+                        host_counts.get(host, 0) >= host_concurrency):
+                    queued.append((source, task))
+                    continue
+
+                host_counts[host] = host_counts.get(host, 0) + 1
+                future = executor.submit(scrape_task, *task,
+                                         page_cache=page_cache,
+                                         post_index=post_index)
+                running[future] = (source, task[0], host, time.time())
+            pending = queued
+
+            done, not_done = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                source, url, host, started = running.pop(future)
+                host_counts[host] -= 1
+                elapsed = time.time() - started
+                try:
+                    proxies, tasks = future.result()
+                except Exception as e:
+                    log.exception('Failed to scrape webpage %s: %s.', url, e)
+                    yield source, url, [], elapsed
+                    continue
+
+                pending.extend((source, task) for task in tasks)
+                yield source, url, proxies, elapsed
+    finally:
+        for future in running:
+            future.cancel()
+        executor.shutdown(wait=False)
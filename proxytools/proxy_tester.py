@@ -3,10 +3,19 @@
 
 import requests
 import logging
+from collections import deque
+from Queue import Queue
+from threading import Event, Lock, Thread
 from requests_futures.sessions import FuturesSession
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
+from . import async_requests
+from .concurrency import (ConcurrencyController, format_latency,
+                          get_max_concurrency)
+from .event_loop import (EventLoop, Return, Semaphore, Sleep, TaskCancelled,
+                         WaitTasks, WaitTimeout)
+
 log = logging.getLogger('pgproxy')
 
 # Proxy check result constants.
@@ -19,6 +28,39 @@ check_result_exception = 5
 check_result_empty = 6
 check_result_max = 6  # Should be equal to maximal return code.
 
+# Proxy check stages, a proxy is only tested against PTC/Niantic once it has
+# passed the anonymity test.
+check_stage_anonymity = 'anonymity'
+check_stage_status = 'status'
+
+# Seconds between checks of the event loop thread for a stop request.
+loop_stop_interval = 0.1
+
+# PTC/Niantic status codes of banned proxies.
+banned_status_codes = [403, 409]
+
+# Requests used to test proxies, shared by all testing engines.
+proxy_test_login_url = ('https://sso.pokemon.com/sso/login'
+                        '?service=https%3A%2F%2Fsso.pokemon.com'
+                        '%2Fsso%2Foauth2.0%2FcallbackAuthorize'
+                        '&locale=en_US')
+proxy_test_niantic_url = 'https://pgorelease.nianticlabs.com/plfe/version'
+proxy_test_ptc_url = 'https://club.pokemon.com/us/pokemon-trainer-club'
+
+proxy_judge_headers = {
+    'Connection': 'close',
+    'Accept': '*/*',
+    'User-Agent': 'pokemongo/0 CFNetwork/893.14.2 Darwin/17.3.0',
+    'Accept-Language': 'en-us',
+    'Accept-Encoding': 'br, gzip, deflate',
+    'X-Unity-Version': '2017.1.2f1'}
+
+proxy_test_headers = dict(proxy_judge_headers, Host='sso.pokemon.com')
+
+# Names of the PTC/Niantic requests, in the order they're sent. Their timings
+# are reported under these names.
+proxy_test_probes = ('login', 'niantic', 'ptc')
+
 
 # Background handler for completed proxy check requests.
 # Currently doesn't do anything.
@@ -69,77 +111,101 @@ def get_local_ip(proxy_judge):
     return local_ip
 
 
-def test_proxies(args, proxies):
-    total_proxies = len(proxies)
-    show_warnings = total_proxies <= 10
-
-    max_concurrency = args.max_concurrency
+# Call fn once the PTC/Niantic request futures of a proxy decide its result:
+# when one of them fails or reports a ban, or when all of them are done.
+# The remaining requests are then cancelled, or if already running, their
+# response is closed as soon as it arrives.
+def when_decided(proxy, futures, fn):
+    futures = [f for f in futures if f]
+    state = {'pending': len(futures), 'decided': False}
+    lock = Lock()
+
+    def done(future):
+        with lock:
+            state['pending'] -= 1
+            if state['decided']:
+                if not future.cancelled() and not future.exception():
+                    future.result().close()
+                return
+
+            decided = (state['pending'] == 0 or
+                       is_decisive_status(*get_request_status(proxy, future)))
+            state['decided'] = decided
+
+        if decided:
+            for other in futures:
+                other.cancel()
+            fn()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def log_concurrency(controller):
+    if controller.adaptive:
+        log.info('Adaptive concurrency: ended with %d concurrent requests ' +
+                 '(lowest: %d, highest: %d).', controller.window,
+                 controller.lowest_window, controller.highest_window)
+
+
+# Feed the outcome of a finished request future to the controller.
+def record_request_future(controller, future):
+    if future.cancelled():
+        return
+    exception = future.exception()
+    if exception:
+        controller.record(isinstance(exception, requests.exceptions.Timeout))
+    else:
+        controller.record(False, future.result().elapsed.total_seconds())
 
-    # If proxy testing concurrency is set to automatic, use max.
-    if args.max_concurrency == 0:
-        max_concurrency = total_proxies
 
-    log.info('Testing anonymity of %d proxies with %d concurrency.',
-             total_proxies, max_concurrency)
+def log_check_error(error, show_warnings):
+    # Decrease output amount if there are a lot of proxies.
+    if show_warnings:
+        log.warning(error)
+    else:
+        log.debug(error)
 
-    session = get_async_requests_session(
-        args.retries,
-        args.backoff_factor,
-        max_concurrency)
 
-    test_queue = []
-    anon_proxies = []
-    failed_proxies = []
+# Evaluates the status of an AZenv judge request future, and returns the
+# result (optionally with an error).
+def get_anonymity_test_status(args, proxy, future):
+    try:
+        response = future.result()
+        # let's check the content
+        proxy_error = get_anonymity_status(args, proxy, response.content)
+        if proxy_error:
+            return (proxy_error, check_result_wrong)
 
-    for proxy in proxies:
+    except requests.exceptions.ConnectTimeout:
+        return ('Connection timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
+    except requests.exceptions.ReadTimeout:
+        return ('Read timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
+    except requests.exceptions.ConnectionError:
+        return ('Failed to connect to proxy {}.'.format(proxy),
+                check_result_failed)
+    except Exception as e:
+        return (e, check_result_exception)
 
-        future = session.get(
-            args.proxy_judge,
-            proxies={'http': proxy, 'https': proxy},
-            timeout=args.timeout,
-            headers={
-                 'Connection': 'close',
-                 'Accept': '*/*',
-                 'User-Agent': 'pokemongo/0 CFNetwork/893.14.2 Darwin/17.3.0',
-                 'Accept-Language': 'en-us',
-                 'Accept-Encoding': 'br, gzip, deflate',
-                 'X-Unity-Version': '2017.1.2f1'},
-            background_callback=__proxy_check_completed)
-        test_queue.append((proxy, future))
+    return (None, check_result_ok)
 
-    for proxy, future in test_queue:
-        proxy_error = None
-        try:
-            response = future.result()
-            # let's check the content
-            result = parse_azevn(response.content)
-            if result['remote_addr'] == args.local_ip:
-                proxy_error = 'Non-anonymous proxy {}'.format(proxy)
-            elif result['x_unity_version'] != '2017.1.2f1':
-                proxy_error = 'Bad headers with proxy {}'.format(proxy)
-            elif result['user_agent'] != ('pokemongo/0 ' +
-                                          'CFNetwork/893.14.2 ' +
-                                          'Darwin/17.3.0'):
-                proxy_error = 'Bad user-agent with proxy {}'.format(proxy)
-
-        except requests.exceptions.ConnectTimeout:
-            proxy_error = 'Connection timeout for proxy {}.'.format(proxy)
-        except requests.exceptions.ConnectionError:
-            proxy_error = 'Failed to connect to proxy {}.'.format(proxy)
-        except Exception as e:
-            proxy_error = e
 
-        if proxy_error:
-            if show_warnings:
-                log.warning(proxy_error)
-            else:
-                log.debug(proxy_error)
-            failed_proxies.append(proxy)
-        else:
-            log.debug('Good anonymous proxy: %s', proxy)
-            anon_proxies.append(proxy)
+# Evaluates the AZenv judge response and returns an error if the proxy is
+# not anonymous or tampers with our headers.
+def get_anonymity_status(args, proxy, content):
+    result = parse_azevn(content)
+    if result['remote_addr'] == args.local_ip:
+        return 'Non-anonymous proxy {}'.format(proxy)
+    elif result['x_unity_version'] != '2017.1.2f1':
+        return 'Bad headers with proxy {}'.format(proxy)
+    elif result['user_agent'] != ('pokemongo/0 ' +
+                                  'CFNetwork/893.14.2 ' +
+                                  'Darwin/17.3.0'):
+        return 'Bad user-agent with proxy {}'.format(proxy)
 
-    return anon_proxies, failed_proxies
+    return None
 
 
 def parse_azevn(response):
@@ -165,49 +231,71 @@ def parse_azevn(response):
 
 # Evaluates the status of PTC and Niantic request futures, and returns the
 # result (optionally with an error).
-# Warning: blocking! Can only get status code if request has finished.
+# Only finished requests are looked at: a connection problem or a ban on any
+# of them decides the result, so the others may have been cancelled. If no
+# finished request decided it, all of them must have finished.
 def get_proxy_test_status(proxy, future_login, future_niantic, future_ptc):
 
-    # Start by assuming everything is OK.
-    check_result = check_result_ok
-    proxy_error = None
+    status_codes = []
+    for future in (future_login, future_niantic, future_ptc):
+        if future is None:
+            # No extra PTC request was made.
+            status_codes.append(200)
+            continue
+
+        if not future.done() or future.cancelled():
+            status_codes.append(None)
+            continue
+
+        status_code, proxy_error, check_result = get_request_status(proxy,
+                                                                    future)
+
+        # If we've already encountered a problem, stop here.
+        if proxy_error:
+            return (proxy_error, check_result)
+
+        status_codes.append(status_code)
 
-    # Make sure we don't trip any code quality tools that test scope.
-    ptc_response = None
-    login_response = None
-    niantic_response = None
+    return evaluate_status_codes(proxy, *status_codes)
 
-    # Make sure both requests are completed.
+
+# Returns the status code of a finished request future, or the result of the
+# proxy check if the request failed.
+def get_request_status(proxy, future):
     try:
-        login_response = future_login.result()
-        niantic_response = future_niantic.result()
-        if future_ptc:
-            ptc_response = future_ptc.result()
+        response = future.result()
     except requests.exceptions.ConnectTimeout:
-        proxy_error = ('Connection timeout for'
-                       + ' proxy {}.').format(proxy)
-        check_result = check_result_timeout
+        return (None,
+                'Connection timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
+    except requests.exceptions.ReadTimeout:
+        return (None,
+                'Read timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
     except requests.exceptions.ConnectionError:
-        proxy_error = 'Failed to connect to proxy {}.'.format(proxy)
-        check_result = check_result_failed
+        return (None,
+                'Failed to connect to proxy {}.'.format(proxy),
+                check_result_failed)
     except Exception as e:
-        proxy_error = e
-        check_result = check_result_exception
+        return (None, e, check_result_exception)
 
-    # If we've already encountered a problem, stop here.
-    if proxy_error:
-        return (proxy_error, check_result)
+    # Explicitly release connection back to the pool, because we don't need
+    # or want to consume the content.
+    response.close()
 
-    # Evaluate response status code.
-    login_status = login_response.status_code
-    niantic_status = niantic_response.status_code
+    return (response.status_code, None, check_result_ok)
 
-    if ptc_response:
-        ptc_status = ptc_response.status_code
-    else:
-        ptc_status = 200
 
-    banned_status_codes = [403, 409]
+# Whether a finished request decides the proxy result on its own.
+def is_decisive_status(status_code, proxy_error, check_result):
+    return (check_result != check_result_ok or
+            status_code in banned_status_codes)
+
+
+# Classifies a proxy from the status codes of the PTC and Niantic requests.
+def evaluate_status_codes(proxy, login_status, niantic_status, ptc_status):
+    check_result = check_result_ok
+    proxy_error = None
 
     if niantic_status == 200 and login_status == 200 and ptc_status == 200:
         log.debug('Proxy %s is ok.', proxy)
@@ -231,35 +319,45 @@ def get_proxy_test_status(proxy, future_login, future_niantic, future_ptc):
                                              ptc_status)
         check_result = check_result_wrong
 
-    # Explicitly release connection back to the pool, because we don't need
-    # or want to consume the content.
-    login_response.close()
-    niantic_response.close()
-    if ptc_response:
-        ptc_response.close()
-
     return (proxy_error, check_result)
 
 
-def start_request_login(session, proxy, timeout):
+# Returns the timings of the finished PTC/Niantic request futures.
+# Requests doesn't expose the connect time, only the time until the response
+# headers were received.
+def get_request_timings(futures):
+    timings = {}
+    for name, future in zip(proxy_test_probes, futures):
+        if (future is None or not future.done() or future.cancelled() or
+                future.exception()):
+            continue
+        timings[name] = {
+            'connect': None,
+            'total': future.result().elapsed.total_seconds()}
+
+    return timings
+
 
-    proxy_test_ptc_url = 'https://sso.pokemon.com/sso/login' \
-                         '?service=https%3A%2F%2Fsso.pokemon.com' \
-                         '%2Fsso%2Foauth2.0%2FcallbackAuthorize' \
-                         '&locale=en_US'
+# Returns the average (connect, total) latency of a proxy from the timings of
+# its requests, None for anything that wasn't measured.
+def get_latency(timings):
+    latency = []
+    for key in ('connect', 'total'):
+        values = [probe[key] for probe in timings.values()
+                  if probe.get(key) is not None]
+        latency.append(sum(values) / len(values) if values else None)
+
+    return tuple(latency)
+
+
+def start_request_login(session, proxy, timeout):
 
     # Send request to pokemon.com.
     future_ptc = session.get(
-        proxy_test_ptc_url,
+        proxy_test_login_url,
         proxies={'http': proxy, 'https': proxy},
         timeout=timeout,
-        headers={'Host': 'sso.pokemon.com',
-                 'Connection': 'close',
-                 'Accept': '*/*',
-                 'User-Agent': 'pokemongo/0 CFNetwork/893.14.2 Darwin/17.3.0',
-                 'Accept-Language': 'en-us',
-                 'Accept-Encoding': 'br, gzip, deflate',
-                 'X-Unity-Version': '2017.1.2f1'},
+        headers=proxy_test_headers,
         background_callback=__proxy_check_completed,
         stream=True)
 
@@ -267,20 +365,12 @@ def start_request_login(session, proxy, timeout):
 
 
 def start_request_niantic(session, proxy, timeout):
-    proxy_test_url = 'https://pgorelease.nianticlabs.com/plfe/version'
-
     # Send request to nianticlabs.com.
     future_niantic = session.get(
-        proxy_test_url,
+        proxy_test_niantic_url,
         proxies={'http': proxy, 'https': proxy},
         timeout=timeout,
-        headers={'Host': 'sso.pokemon.com',
-                 'Connection': 'close',
-                 'Accept': '*/*',
-                 'User-Agent': 'pokemongo/0 CFNetwork/893.14.2 Darwin/17.3.0',
-                 'Accept-Language': 'en-us',
-                 'Accept-Encoding': 'br, gzip, deflate',
-                 'X-Unity-Version': '2017.1.2f1'},
+        headers=proxy_test_headers,
         background_callback=__proxy_check_completed,
         stream=True)
 
@@ -288,8 +378,6 @@ def start_request_niantic(session, proxy, timeout):
 
 
 def start_request_ptc(session, proxy, timeout):
-    proxy_test_ptc_url = 'https://club.pokemon.com/us/pokemon-trainer-club'
-
     # log.debug('Checking proxy: %s.', proxy)
 
     # Send request to pokemon.com.
@@ -297,13 +385,7 @@ def start_request_ptc(session, proxy, timeout):
         proxy_test_ptc_url,
         proxies={'http': proxy, 'https': proxy},
         timeout=timeout,
-        headers={'Host': 'sso.pokemon.com',
-                 'Connection': 'close',
-                 'Accept': '*/*',
-                 'User-Agent': 'pokemongo/0 CFNetwork/893.14.2 Darwin/17.3.0',
-                 'Accept-Language': 'en-us',
-                 'Accept-Encoding': 'br, gzip, deflate',
-                 'X-Unity-Version': '2017.1.2f1'},
+        headers=proxy_test_headers,
         background_callback=__proxy_check_completed,
         stream=True)
 
@@ -331,104 +413,597 @@ def start_request_futures(
     return (future_login, future_niantic, future_ptc)
 
 
-# Check all proxies and return a working list with proxies.
-def check_proxies(args, proxies, capture_failed_anon):
+# Long-lived testing context, owning what the engines need across batches
+# and runs: the request sessions (thread pools and connection pools) of the
+# futures engine, the event loop of the eventloop engine and the concurrency
+# controller, so the adaptive window carries over. Call close() when done.
+# If a verdict cache is set, proxies with a recent result aren't tested.
+class ProxyTester(object):
+
+    def __init__(self, args, cache=None):
+        self.args = args
+        self.cache = cache
+        self.controller = None
+        self._sessions = None
+        self._pool_size = 0
+        self._loop = None
+        self._slots = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Returns the concurrency controller, bounded for a batch of proxies.
+    def get_controller(self, total_proxies):
+        max_concurrency = get_max_concurrency(self.args.max_concurrency,
+                                              total_proxies)
+        if self.controller is None:
+            self.controller = ConcurrencyController(
+                max_concurrency, self.args.adaptive_concurrency)
+            if self.controller.adaptive:
+                log.info('Adaptive concurrency: starting with %d ' +
+                         'concurrent requests, up to %d.',
+                         self.controller.window, max_concurrency)
+        else:
+            self.controller.set_maximum(max_concurrency)
+
+        if not self.controller.adaptive and max_concurrency >= 100:
+            log.warning(
+                'Starting proxy test for %d proxies with %d concurrency. ' +
+                'If this causes issues, consider lowering it.',
+                total_proxies, max_concurrency)
+
+        return self.controller
+
+    # Returns the (judge, PTC, Niantic) sessions, with at least pool_size
+    # workers each. There is no judge session if anonymity isn't tested.
+    def get_sessions(self, pool_size):
+        if self._sessions and self._pool_size >= pool_size:
+            return self._sessions
+
+        self._close_sessions()
+        log.debug('Starting request sessions with %d workers.', pool_size)
+
+        judge_session = None
+        if not self.args.no_anonymous:
+            judge_session = get_async_requests_session(
+                self.args.retries,
+                self.args.backoff_factor,
+                pool_size)
+        ptc_session = get_async_requests_session(
+            self.args.retries,
+            self.args.backoff_factor,
+            pool_size)
+        niantic_session = get_async_requests_session(
+            self.args.retries,
+            self.args.backoff_factor,
+            pool_size)
+
+        self._sessions = (judge_session, ptc_session, niantic_session)
+        self._pool_size = pool_size
+        return self._sessions
+
+    # Returns the event loop and the semaphore bounding its requests to the
+    # concurrency window. Must be called after get_controller().
+    def get_loop(self):
+        if self._loop is None:
+            self._loop = EventLoop()
+            self._slots = Semaphore(self._loop, self.controller.window)
+            self.controller.listeners.append(self._slots.set_limit)
+        return self._loop, self._slots
+
+    def _close_sessions(self):
+        if not self._sessions:
+            return
+
+        # Don't wait for requests still running, they were cancelled and
+        # their workers exit once done.
+        for session in self._sessions:
+            if session:
+                session.executor.shutdown(wait=False)
+                session.close()
+        self._sessions = None
+        self._pool_size = 0
+
+    def close(self):
+        self._close_sessions()
+        if self._loop:
+            self.controller.listeners.remove(self._slots.set_limit)
+            self._loop.close()
+            self._loop = None
+            self._slots = None
+
+
+# Check all proxies and yield (proxy, error, result, timings) for each proxy
+# as soon as its result is known, with timings holding the connect and total
+# time of each PTC/Niantic request that completed. Failed anonymity tests are
+# only included if capture_failed_anon is set. Closing the generator early
+# cancels the tests still running.
+# Tests run within the given ProxyTester, or a temporary one if not set.
+def iter_check_proxies(args, proxies, capture_failed_anon, tester=None):
+
+    own_tester = tester is None
+    if own_tester:
+        tester = ProxyTester(args)
 
-    working_proxies = []
-    banned_proxies = []
-    failed_proxies = []
+    total_proxies = len(proxies)
+    show_warnings = total_proxies <= 10
 
-    if not args.no_anonymous:
-        proxies, failed = test_proxies(args, proxies)
-        if capture_failed_anon:
-            failed_proxies = list(failed)
+    # Proxies with a recent result are answered from the cache.
+    cache = tester.cache
+    cached = {}
+    if cache:
+        cached = cache.lookup(proxies)
+        if cached:
+            proxies = [proxy for proxy in proxies if proxy not in cached]
 
-    # Get the updated number of proxies.
-    total_proxies = len(proxies)
+    if args.engine == 'eventloop':
+        results = iter_check_proxies_eventloop(args, tester, proxies)
+    else:
+        results = iter_check_proxies_futures(args, tester, proxies)
 
     # Store counter per result type.
     check_results = [0] * (check_result_max + 1)
+    anonymity_fails = 0
 
-    # If proxy testing concurrency is set to automatic, use max.
-    max_concurrency = args.max_concurrency
+    log.info('Checking %d proxies with %d retries and %d sec timeout...',
+             total_proxies, args.retries, args.timeout)
+    if cached:
+        log.info('Using recent results for %d proxies.', len(cached))
 
-    if args.max_concurrency == 0:
-        max_concurrency = total_proxies
+    if not args.verbose and not show_warnings:
+        log.info('Enable -v to see proxy testing details.')
 
-    if max_concurrency >= 100:
-        log.warning(
-            "Starting proxy test for %d proxies with %d concurrency. " +
-            "If this causes issues, consider lowering it.",
-            total_proxies, max_concurrency)
+    def iter_results():
+        for proxy, (stage, result) in cached.items():
+            yield stage, proxy, None, result, {}
+
+        for stage, proxy, error, result, timings in results:
+            if cache:
+                cache.put(proxy, stage, result)
+            yield stage, proxy, error, result, timings
+
+    try:
+        for stage, proxy, error, result, timings in iter_results():
+            if error:
+                log_check_error(error, show_warnings)
+            elif timings:
+                log.debug('Proxy %s latency - connect: %s, total: %s.',
+                          proxy, *map(format_latency, get_latency(timings)))
+
+            if stage == check_stage_anonymity:
+                anonymity_fails += 1
+                if not capture_failed_anon:
+                    continue
+            else:
+                check_results[result] += 1
+
+            yield proxy, error, result, timings
+    finally:
+        results.close()
+        if own_tester:
+            tester.close()
+
+        other_fails = (check_results[check_result_failed] +
+                       check_results[check_result_wrong] +
+                       check_results[check_result_exception] +
+                       check_results[check_result_empty])
+
+        log.info('Checked %d proxies. Working: %d, banned: %d,'
+                 + ' timeout: %d, other fails: %d, failed anonymity: %d,'
+                 + ' cached: %d.',
+                 sum(check_results) + anonymity_fails,
+                 check_results[check_result_ok],
+                 check_results[check_result_banned],
+                 check_results[check_result_timeout],
+                 other_fails, anonymity_fails, len(cached))
+
+
+# Check all proxies and return a working list with proxies.
+def check_proxies(args, proxies, capture_failed_anon, tester=None):
 
-    # Get persistent session per host.
-    ptc_session = get_async_requests_session(
-        args.retries,
-        args.backoff_factor,
-        max_concurrency)
-    niantic_session = get_async_requests_session(
-        args.retries,
-        args.backoff_factor,
-        max_concurrency)
-
-    # List to hold background workers.
-    proxy_queue = []
     working_proxies = []
-    show_warnings = total_proxies <= 10
+    banned_proxies = []
+    failed_proxies = []
 
-    log.info('Checking %d proxies with %d retries and %d sec timeout...',
-             total_proxies, args.retries, args.timeout)
+    for proxy, error, result, timings in iter_check_proxies(
+            args, proxies, capture_failed_anon, tester):
+        if result == check_result_ok:
+            working_proxies.append(proxy)
+        elif result == check_result_banned:
+            banned_proxies.append(proxy)
+        else:
+            failed_proxies.append(proxy)
+
+    return working_proxies, banned_proxies, failed_proxies
 
-    if not args.verbose and not show_warnings:
-        log.info('Enable -v to see proxy testing details.')
 
-    # Start async requests & store futures.
-    for proxy in proxies:
-        future_login, future_niantic, future_ptc = start_request_futures(
+# Runs the anonymity test and PTC/Niantic test as a pipeline per proxy: the
+# PTC/Niantic requests for a proxy are started from the callback of its
+# anonymity test, while other proxies are still being tested for anonymity.
+# Yields (stage, proxy, error, result, timings) as each proxy completes.
+def iter_check_proxies_futures(args, tester, proxies):
+
+    total_proxies = len(proxies)
+    controller = tester.get_controller(total_proxies)
+
+    # Get persistent session per host.
+    judge_session, ptc_session, niantic_session = tester.get_sessions(
+        controller.maximum)
+
+    # Completed proxies are queued by the request callbacks, with None
+    # queued when a request finishes to wake up the main thread.
+    completed = Queue()
+    started = []
+    stopped = Event()
+
+    # Requests in flight, proxies are only started while there's room in
+    # the concurrency window. Requests of decided proxies that were already
+    # running still count until they finish.
+    pending = deque(proxies)
+    in_flight = {'requests': 0}
+    in_flight_lock = Lock()
+
+    def track(futures):
+        futures = [f for f in futures if f]
+        with in_flight_lock:
+            in_flight['requests'] += len(futures)
+        started.extend(futures)
+
+        def done(future):
+            with in_flight_lock:
+                in_flight['requests'] -= 1
+            record_request_future(controller, future)
+            if pending:
+                completed.put(None)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def start_status_test(proxy):
+        futures = start_request_futures(
             ptc_session,
             niantic_session,
             proxy,
             args.timeout,
             args.extra_request)
+        track(futures)
+        when_decided(proxy, futures, lambda: completed.put((proxy, lambda: (
+            (check_stage_status,) +
+            get_proxy_test_status(proxy, *futures) +
+            (get_request_timings(futures),)))))
+
+    def anonymity_test_done(proxy, future):
+        error, result = get_anonymity_test_status(args, proxy, future)
+        if error or stopped.is_set():
+            completed.put((proxy, lambda: (
+                check_stage_anonymity, error, result, {})))
+            return
+
+        log.debug('Good anonymous proxy: %s', proxy)
+        try:
+            start_status_test(proxy)
+        except Exception as e:
+            completed.put((proxy, lambda e=e: (
+                check_stage_status, e, check_result_exception, {})))
 
-        proxy_queue.append((proxy, future_login, future_niantic, future_ptc))
+    def start_test(proxy):
+        if args.no_anonymous:
+            start_status_test(proxy)
+            return
 
-    # Wait here until all items in proxy_queue are processed, so we have a list
-    # of working proxies. We intentionally start all requests before handling
-    # them so they can asynchronously continue in the background, even as we're
-    # blocking to wait for one. The double loop is intentional.
-    for proxy, future_login, future_niantic, future_ptc in proxy_queue:
-        error, result = get_proxy_test_status(proxy,
-                                              future_login,
-                                              future_niantic,
-                                              future_ptc)
+        future = judge_session.get(
+            args.proxy_judge,
+            proxies={'http': proxy, 'https': proxy},
+            timeout=args.timeout,
+            headers=proxy_judge_headers,
+            background_callback=__proxy_check_completed)
+        track([future])
+        future.add_done_callback(
+            lambda f, proxy=proxy: anonymity_test_done(proxy, f))
 
-        check_results[result] += 1
+    try:
+        # Every proxy is queued exactly once, in the order they finish,
+        # with a function evaluating its result. The rest is driven by the
+        # request callbacks.
+        finished = 0
+        while finished < total_proxies:
+            while pending and in_flight['requests'] < controller.window:
+                start_test(pending.popleft())
+
+            item = completed.get()
+            if item is None:
+                continue
+
+            proxy, evaluate = item
+            finished += 1
+            stage, error, result, timings = evaluate()
+            yield stage, proxy, error, result, timings
+    finally:
+        stopped.set()
+        for future in started:
+            future.cancel()
+        log_concurrency(controller)
+
+
+# ---------------------------------------------------------------------------
+# Event loop engine
+# ---------------------------------------------------------------------------
+# Runs every request as a coroutine over non-blocking sockets in a single
+# thread, instead of one worker thread per in-flight request. Concurrency is
+# then only bounded by the concurrency window and the available file
+# descriptors.
+
+# Maps request exceptions to the same results as the futures engine.
+def get_exception_status(proxy, e):
+    if isinstance(e, async_requests.ConnectTimeout):
+        return ('Connection timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
+    if isinstance(e, async_requests.ReadTimeout):
+        return ('Read timeout for proxy {}.'.format(proxy),
+                check_result_timeout)
+    if isinstance(e, async_requests.ProxyConnectionError):
+        return ('Failed to connect to proxy {}.'.format(proxy),
+                check_result_failed)
+    return (e, check_result_exception)
+
+
+# Coroutine sending a single request through a proxy. Retries on connection
+# errors and server errors like the urllib3 Retry used by the futures engine.
+# Each attempt holds one of the concurrency slots, and its outcome is fed to
+# the concurrency controller.
+def send_probe(args, slots, controller, proxy, url, headers, stream=True,
+               priority=False, status_forcelist=[500, 502, 503, 504]):
+    attempt = 0
+    while True:
+        yield slots.acquire(priority)
+        try:
+            response = yield async_requests.request(
+                url, proxy, headers, args.timeout, stream)
+            controller.record(False, response.timings['total'])
+            if (attempt >= args.retries or
+                    response.status_code not in status_forcelist):
+                raise Return(response)
+        except async_requests.RequestError as e:
+            controller.record(isinstance(e, (async_requests.ConnectTimeout,
+                                             async_requests.ReadTimeout)))
+            if attempt >= args.retries:
+                raise
+        finally:
+            slots.release()
+
+        attempt += 1
+        if attempt > 1:
+            yield Sleep(args.backoff_factor * (2 ** (attempt - 1)))
+
+
+# Coroutine testing proxy anonymity against the AZenv judge.
+# Returns the result (optionally with an error).
+def test_proxy_anonymity(args, slots, controller, proxy):
+    try:
+        response = yield send_probe(args, slots, controller, proxy,
+                                    args.proxy_judge, proxy_judge_headers,
+                                    stream=False)
+    except Exception as e:
+        raise Return(get_exception_status(proxy, e))
 
+    proxy_error = get_anonymity_status(args, proxy, response.content)
+    if proxy_error:
+        raise Return((proxy_error, check_result_wrong))
+
+    raise Return((None, check_result_ok))
+
+
+# Coroutine running the PTC and Niantic requests in parallel for a proxy.
+# Returns the result (optionally with an error) and the request timings.
+# These requests take priority over pending anonymity tests, so proxies
+# make it through the pipeline instead of waiting on the whole list.
+def test_proxy_status(args, loop, slots, controller, proxy):
+    log.debug('Checking proxy: %s.', proxy)
+
+    urls = [proxy_test_login_url, proxy_test_niantic_url]
+    if args.extra_request:
+        urls.append(proxy_test_ptc_url)
+
+    tasks = [loop.spawn(send_probe(args, slots, controller, proxy, url,
+                                   proxy_test_headers, priority=True))
+             for url in urls]
+
+    try:
+        # Stop waiting as soon as a request decides the result, the finally
+        # block then cancels the others and closes their sockets.
+        pending = list(tasks)
+        while pending:
+            yield WaitTasks(pending, first=True)
+            done = [task for task in pending if task.done]
+            pending = [task for task in pending if not task.done]
+            if any(is_decisive_status(*get_task_status(proxy, task))
+                   for task in done):
+                break
+    finally:
+        # Don't leave requests behind if we're cancelled.
+        for task in tasks:
+            task.cancel()
+
+    timings = {}
+    for name, task in zip(proxy_test_probes, tasks):
+        if task.result:
+            timings[name] = task.result.timings
+
+    status_codes = []
+    for task in tasks:
+        if task.exception and not isinstance(task.exception, TaskCancelled):
+            raise Return(get_task_status(proxy, task)[1:] + (timings,))
+        status_codes.append(task.result and task.result.status_code)
+
+    if not args.extra_request:
+        status_codes.append(200)
+
+    raise Return(evaluate_status_codes(proxy, *status_codes) + (timings,))
+
+
+# Returns the status code of a finished request task, or the result of the
+# proxy check if the request failed.
+def get_task_status(proxy, task):
+    if task.exception:
+        return (None,) + get_exception_status(proxy, task.exception)
+    return (task.result.status_code, None, check_result_ok)
+
+
+# Run a coroutine for each proxy and yield (proxy, result) as each one
+# finishes. The loop runs on a thread of its own, like the request workers
+# of the futures engine, so sockets keep being served while the consumer
+# writes results or looks up countries. Coroutines still running when the
+# consumer stops are cancelled.
+def iter_coroutines(loop, proxies, coroutine):
+    results = Queue()
+    stop = Event()
+
+    def completed(proxy):
+        def callback(task):
+            # Cancelled tasks have no result.
+            if not stop.is_set():
+                results.put((proxy, task.result))
+        return callback
+
+    # The loop isn't thread-safe, tasks are only spawned and cancelled here.
+    def run():
+        tasks = []
+        try:
+            for proxy in proxies:
+                tasks.append(loop.spawn(coroutine(proxy),
+                                        callback=completed(proxy)))
+
+            while loop.pending() and not stop.is_set():
+                loop.run_once(loop_stop_interval)
+        except Exception as e:
+            log.exception('Exception in event loop: %s', repr(e))
+        finally:
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            results.put(None)
+
+    thread = Thread(target=run, name='event-loop')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            yield result
+    finally:
+        stop.set()
+        thread.join()
+
+
+# Coroutine running all tests for a proxy. The PTC/Niantic requests start as
+# soon as the proxy passes the anonymity test.
+# Returns the (stage, error, result, timings) the proxy finished on.
+def test_proxy(args, loop, slots, controller, proxy):
+    if not args.no_anonymous:
+        error, result = yield test_proxy_anonymity(args, slots, controller,
+                                                   proxy)
         if error:
-            # Decrease output amount if there are a lot of proxies.
-            if show_warnings:
-                log.warning(error)
-            else:
-                log.debug(error)
+            raise Return((check_stage_anonymity, error, result, {}))
+        log.debug('Good anonymous proxy: %s', proxy)
 
-            if result == check_result_banned:
-                banned_proxies.append(proxy)
-            else:
-                failed_proxies.append(proxy)
-        else:
-            working_proxies.append(proxy)
+    error, result, timings = yield test_proxy_status(args, loop, slots,
+                                                     controller, proxy)
+    raise Return((check_stage_status, error, result, timings))
 
-    other_fails = (check_results[check_result_failed] +
-                   check_results[check_result_wrong] +
-                   check_results[check_result_exception] +
-                   check_results[check_result_empty])
 
-    log.info('Checked %d proxies. Working: %d, banned: %d,'
-             + ' timeout: %d, other fails: %d.',
-             total_proxies, len(working_proxies),
-             check_results[check_result_banned],
-             check_results[check_result_timeout],
-             other_fails)
+def iter_check_proxies_eventloop(args, tester, proxies):
 
-    return working_proxies, banned_proxies, failed_proxies
+    controller = tester.get_controller(len(proxies))
+    loop, slots = tester.get_loop()
+
+    # Cancelling the remaining tasks closes their sockets and releases
+    # their slots, leaving the loop ready for the next batch.
+    results = iter_coroutines(
+        loop, proxies,
+        lambda proxy: test_proxy(args, loop, slots, controller, proxy))
+    try:
+        for proxy, (stage, error, result, timings) in results:
+            yield stage, proxy, error, result, timings
+    finally:
+        results.close()
+        log_concurrency(controller)
+
+
+# ---------------------------------------------------------------------------
+# Pre-screening
+# ---------------------------------------------------------------------------
+# Most scraped proxies are dead. A plain TCP connect (plus the greeting for
+# SOCKS5 proxies) is enough to weed them out, at a fraction of the cost of
+# the HTTP tests, so it can run at a much higher concurrency.
+
+# Pre-screen result constants.
+prescreen_result_ok = 0
+prescreen_result_failed = 1
+prescreen_result_timeout = 2
+
+
+# Coroutine connecting to a proxy and, for SOCKS5 proxies, exchanging the
+# greeting. Returns the result (optionally with an error).
+def prescreen_proxy(slots, proxy, timeout):
+    scheme, host, port, username, password = async_requests.split_proxy(
+        proxy)
+
+    yield slots.acquire()
+    sock = None
+    try:
+        sock = yield async_requests.connect(host, port or 1080, timeout)
+        if scheme in ('socks5', 'socks5h'):
+            yield async_requests.socks5_greeting(sock, username, password,
+                                                 timeout)
+    except WaitTimeout:
+        raise Return(('Pre-screen timeout for proxy {}.'.format(proxy),
+                      prescreen_result_timeout))
+    except Exception as e:
+        raise Return(('Pre-screen failed for proxy {}: {}'.format(proxy, e),
+                      prescreen_result_failed))
+    finally:
+        if sock is not None:
+            sock.close()
+        slots.release()
+
+    raise Return((None, prescreen_result_ok))
+
+
+# Pre-screen proxies and return the ones that accepted a connection.
+def prescreen_proxies(args, proxies):
+    total_proxies = len(proxies)
+    results = [0] * (prescreen_result_timeout + 1)
+    passed = []
+
+    log.info('Pre-screening %d proxies with %d concurrency and %d sec '
+             'timeout...', total_proxies, args.prescreen_concurrency,
+             args.prescreen_timeout)
+
+    loop = EventLoop()
+    slots = Semaphore(loop, get_max_concurrency(args.prescreen_concurrency,
+                                                total_proxies))
+    try:
+        for proxy, (error, result) in iter_coroutines(
+                loop, proxies,
+                lambda proxy: prescreen_proxy(slots, proxy,
+                                              args.prescreen_timeout)):
+            results[result] += 1
+            if error:
+                log.debug(error)
+            else:
+                passed.append(proxy)
+    finally:
+        loop.close()
+
+    log.info('Pre-screened %d proxies. Passed: %d, failed: %d, timeout: %d.',
+             total_proxies, results[prescreen_result_ok],
+             results[prescreen_result_failed],
+             results[prescreen_result_timeout])
+
+    return passed
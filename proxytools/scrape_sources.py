@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from Queue import Empty, Queue
+from threading import Event, Lock, Thread
+
+from .proxy_scraper import (iter_scrape,
+                            premproxy_free_tasks,
+                            proxyserverlist24_top_tasks,
+                            script_cache,
+                            sockslist_net_tasks,
+                            socksproxylist24_top_tasks,
+                            vipsocks24_net_tasks)
+
+log = logging.getLogger('pgproxy')
+
+# Weight of the last run in the smoothed yield of a source.
+yield_smoothing = 0.5
+
+# Sources are scraped every cycle until their yield was measured in this
+# many runs, before it's used for scheduling.
+yield_warmup_runs = 2
+
+# Low-yield sources are still scraped at least once every this many cycles.
+max_scrape_interval = 8
+
+
+# A website we scrape proxies from. get_tasks(ignore_country) returns its
+# scrape tasks, protocol is the type of proxies it lists: http or socks.
+# Keeps the stats of its last run, and how many working proxies it yields
+# per run, smoothed over runs. When the tests stop early only part of the
+# proxies it listed first are tested, the yield of a run is then estimated
+# from the share of tested proxies that worked.
+class ScrapeSource(object):
+
+    def __init__(self, name, protocol, get_tasks):
+        self.name = name
+        self.protocol = protocol
+        self.get_tasks = get_tasks
+
+        self.runs = 0
+        self.pages = 0
+        self.scraped = 0
+        self.new = 0
+        self.listed = 0
+        self.tested = 0
+        self.working = 0
+        self.scrape_time = 0.0
+        self.total_new = 0
+        self.total_working = 0
+        self.yield_score = None
+        self.scored_runs = 0
+
+        # Scheduling: scraped once every interval cycles.
+        self.interval = 1
+        self.skipped = 0
+
+    def is_due(self):
+        return self.skipped + 1 >= self.interval
+
+    def start_run(self):
+        self.runs += 1
+        self.pages = 0
+        self.scraped = 0
+        self.new = 0
+        self.listed = 0
+        self.tested = 0
+        self.working = 0
+        self.scrape_time = 0.0
+        self.skipped = 0
+
+    def end_run(self):
+        self.total_new += self.new
+        self.total_working += self.working
+
+        # None of its proxies were tested, the run says nothing about it.
+        if not self.tested:
+            return
+
+        working = self.working * float(self.listed) / self.tested
+        self.scored_runs += 1
+        if self.yield_score is None:
+            self.yield_score = working
+        else:
+            self.yield_score += yield_smoothing * (
+                working - self.yield_score)
+
+
+# The sources of each type of proxies.
+def get_default_sources():
+    return [
+        ScrapeSource('proxyserverlist24.top', 'http',
+                     lambda ignore_country: proxyserverlist24_top_tasks()),
+        ScrapeSource('premproxy.com', 'http', premproxy_free_tasks),
+        ScrapeSource('sockslist.net', 'socks', sockslist_net_tasks),
+        ScrapeSource('vipsocks24.net', 'socks',
+                     lambda ignore_country: vipsocks24_net_tasks()),
+        ScrapeSource('socksproxylist24.top', 'socks',
+                     lambda ignore_country: socksproxylist24_top_tasks())
+    ]
+
+
+# The scrape sources and what they contributed. A scrape cycle runs the due
+# sources of a mode, the proxies they scraped are then tested and reported
+# with record_tested(), the working ones with record_working() too, and
+# end_cycle() updates the yields of the sources. Sources are scheduled by
+# their yield relative to the best source: one yielding a quarter of the
+# working proxies of the best is scraped every 4 cycles, up to
+# max_scrape_interval.
+class SourceRegistry(object):
+
+    def __init__(self, sources=None):
+        self.sources = []
+        self.cycles = 0
+        # Every proxy scraped so far, to count the new ones.
+        self._seen = set()
+        # The first source that listed each proxy this cycle, and the
+        # proxies credited to it as tested and working. Proxies are listed
+        # by the scraper thread while they're tested.
+        self._origins = {}
+        self._tested = set()
+        self._working = set()
+        self._lock = Lock()
+        self._running = []
+
+        for source in sources or get_default_sources():
+            self.register(source)
+
+    def register(self, source):
+        if any(s.name == source.name for s in self.sources):
+            raise ValueError('Scrape source already registered: {}'
+                             .format(source.name))
+        self.sources.append(source)
+
+    # Scrape the due sources of a mode (http, socks or all) and yield
+    # (url, proxies) as each page is parsed.
+    def iter_scrape(self, mode, ignore_country, page_cache=None,
+                    post_index=None):
+        self.cycles += 1
+        with self._lock:
+            self._origins = {}
+            self._tested = set()
+            self._working = set()
+        self._running = []
+
+        source_tasks = []
+        for source in self.sources:
+            if mode not in ('all', source.protocol):
+                continue
+            if not source.is_due():
+                source.skipped += 1
+                log.info('Skipping low-yield source %s this cycle, scraped '
+                         'every %d cycles.', source.name, source.interval)
+                continue
+
+            source.start_run()
+            self._running.append(source)
+            try:
+                source_tasks.append(
+                    (source, source.get_tasks(ignore_country)))
+            except Exception as e:
+                log.exception('Failed to get the scrape tasks of %s: %s.',
+                              source.name, e)
+
+        for source, url, proxies, elapsed in iter_scrape(
+                source_tasks, page_cache, post_index):
+            source.pages += 1
+            source.scraped += len(proxies)
+            source.scrape_time += elapsed
+            with self._lock:
+                for proxy in proxies:
+                    if proxy not in self._origins:
+                        self._origins[proxy] = source
+                        source.listed += 1
+                    if proxy not in self._seen:
+                        self._seen.add(proxy)
+                        source.new += 1
+            yield url, proxies
+
+        script_cache.log_stats()
+
+    # Count proxies as tested for the sources that found them this cycle.
+    # Proxies dropped before testing, e.g. by country, count as tested too.
+    def record_tested(self, proxies):
+        with self._lock:
+            for proxy in proxies:
+                source = self._origins.get(proxy)
+                if source and proxy not in self._tested:
+                    self._tested.add(proxy)
+                    source.tested += 1
+
+    # Credit a working proxy to the source that found it this cycle.
+    def record_working(self, proxy):
+        with self._lock:
+            source = self._origins.get(proxy)
+            if source and proxy not in self._working:
+                self._working.add(proxy)
+                source.working += 1
+
+    # Update the yields of the sources scraped this cycle and reschedule.
+    def end_cycle(self):
+        for source in self._running:
+            source.end_run()
+            log.info('Source %s: %d pages, %d proxies scraped, %d new, '
+                     '%d tested, %d working, in %.1fs.', source.name,
+                     source.pages, source.scraped, source.new,
+                     source.tested, source.working, source.scrape_time)
+        self._running = []
+        with self._lock:
+            self._origins = {}
+            self._tested = set()
+            self._working = set()
+
+        best = max([s.yield_score for s in self.sources
+                    if s.yield_score is not None] or [0])
+        for source in self.sources:
+            if source.scored_runs < yield_warmup_runs or best <= 0:
+                source.interval = 1
+            elif source.yield_score <= best / max_scrape_interval:
+                source.interval = max_scrape_interval
+            else:
+                source.interval = int(best / source.yield_score)
+
+
+# Scrape the due sources of a mode in a background thread and yield the
+# proxies as they're found, so they can be tested while scraping goes on.
+# Each batch holds the proxies not seen before this cycle that were parsed
+# while the previous batch was handled, at most max_batch_size of them (no
+# limit if 0). Closing the generator stops the scraping.
+def iter_scraped_proxies(sources, mode, ignore_country, page_cache=None,
+                         post_index=None, max_batch_size=0):
+    found = Queue()
+    stop = Event()
+
+    def scrape():
+        pages = sources.iter_scrape(mode, ignore_country, page_cache,
+                                    post_index)
+        try:
+            for url, proxies in pages:
+                found.put(proxies)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            log.exception('Failed to scrape proxies: %s.', e)
+        finally:
+            pages.close()
+            found.put(None)
+
+    thread = Thread(target=scrape, name='scraper')
+    thread.daemon = True
+    thread.start()
+
+    seen = set()
+    pending = []
+    scraping = True
+    try:
+        while scraping or pending:
+            # Wait for new proxies, then take the others parsed meanwhile.
+            while scraping:
+                try:
+                    proxies = found.get(not pending, 1)
+                except Empty:
+                    if pending:
+                        break
+                    continue
+
+                if proxies is None:
+                    scraping = False
+                    break
+                for proxy in proxies:
+                    if proxy not in seen:
+                        seen.add(proxy)
+                        pending.append(proxy)
+
+            if pending:
+                size = max_batch_size or len(pending)
+                batch, pending = pending[:size], pending[size:]
+                yield batch
+    finally:
+        if scraping:
+            log.info('Stopping scraping.')
+        stop.set()
+        # The scraper stops after the page it's waiting on, the downloads
+        # still running then finish in the background.
+        thread.join()
@@ -3,6 +3,7 @@
 
 import json
 import logging
+import os
 import urllib
 
 log = logging.getLogger('pgproxy')
@@ -32,14 +33,15 @@ def validate_ip(ip):
 
 def get_country_from_ip(geoip_url, ip):
 
+    url = geoip_url
     try:
 
-        address = ip.replace("socks5://", "")
-        address = address.replace("http://", "")
-        address = address.replace("https://", "")
+        # Strip the protocol, credentials and port.
+        address = ip.split('://')[-1]
+        address = address.split('@')[-1]
         address = address.split(":")[0]
 
-        url = "http://www.freegeoip.net/json/{0}".format(address)
+        url = geoip_url.format(address)
         locationInfo = json.loads(urllib.urlopen(url).read())
         return locationInfo['country_name'].lower()
         # print 'City: ' + locationInfo['city']
@@ -51,6 +53,38 @@ def get_country_from_ip(geoip_url, ip):
         return None
 
 
+# Returns the data of a JSON file, or None if there is no such file or it
+# can't be read. The description names the file in warnings.
+def load_json(filename, description):
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        log.warning('Failed to load %s %s: %s', description, filename, e)
+        return None
+
+
+# Writes data to a JSON file through a temporary file, so a failed write
+# doesn't leave a truncated file behind.
+def save_json(filename, data, description):
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'w') as f:
+            json.dump(data, f)
+        try:
+            os.rename(temp_filename, filename)
+        except OSError:
+            # Windows doesn't rename over an existing file.
+            if not os.path.isfile(filename):
+                raise
+            os.remove(filename)
+            os.rename(temp_filename, filename)
+    except (IOError, OSError) as e:
+        log.warning('Failed to save %s %s: %s', description, filename, e)
+
+
 # Load proxies and return a list.
 def load_proxies(filename, mode):
     proxies = []
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Condition
+
+log = logging.getLogger('pgproxy')
+
+
+# Pending proxy updates, coalesced by URL: an update to a proxy that's
+# still queued is merged into the queued one, its fields overriding the
+# earlier values, so each proxy is written at most once per batch. Proxies
+# keep the position of their first pending update. Metadata fields (starting
+# with _) set to None don't override earlier values.
+class CoalescingQueue(object):
+
+    def __init__(self):
+        self.updates = 0
+        self.coalesced = 0
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._cond = Condition()
+
+    def put(self, data):
+        with self._cond:
+            self.updates += 1
+            pending = self._pending.get(data['url'])
+            if pending is None:
+                self._pending[data['url']] = dict(data)
+                self._cond.notify()
+                return
+
+            self.coalesced += 1
+            for key, value in data.items():
+                if value is None and key.startswith('_'):
+                    continue
+                pending[key] = value
+
+    # Number of proxies with pending updates, including those being written.
+    def qsize(self):
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    # Wait for an update, then for up to max_wait seconds for more, and take
+    # the updates of up to max_size proxies. Call batch_done() once they're
+    # written.
+    def get_batch(self, max_size, max_wait):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait(1)
+
+            deadline = time.time() + max_wait
+            while len(self._pending) < max_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+
+            batch = []
+            while self._pending and len(batch) < max_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            self._in_flight = len(batch)
+        return batch
+
+    def batch_done(self):
+        with self._cond:
+            self._in_flight = 0
+
+    def log_stats(self):
+        log.info('DB updates: %d queued, %d coalesced with pending ones.',
+                 self.updates, self.coalesced)
+        self.updates = 0
+        self.coalesced = 0
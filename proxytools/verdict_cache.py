@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+from urlparse import urlsplit
+
+from .proxy_tester import (check_result_ok, check_result_banned,
+                           check_result_timeout)
+from .shared_utils import load_json, save_json
+
+log = logging.getLogger('pgproxy')
+
+# Verdict classes, each with its own time to live.
+verdict_working = 'working'
+verdict_banned = 'banned'
+verdict_failed = 'failed'
+verdict_timeout = 'timeout'
+
+# Seconds between removals of expired results from memory.
+expire_interval = 60
+
+
+def get_verdict(result):
+    if result == check_result_ok:
+        return verdict_working
+    if result == check_result_banned:
+        return verdict_banned
+    if result == check_result_timeout:
+        return verdict_timeout
+    return verdict_failed
+
+
+# Time to live in seconds per verdict class, from the arguments in minutes.
+def get_ttls(args):
+    return {
+        verdict_working: args.cache_ttl_working * 60,
+        verdict_banned: args.cache_ttl_banned * 60,
+        verdict_failed: args.cache_ttl_failed * 60,
+        verdict_timeout: args.cache_ttl_timeout * 60}
+
+
+# The same proxy is written in many ways by the sites we scrape.
+def normalize_proxy_url(proxy):
+    parts = urlsplit(proxy.strip())
+    auth = ''
+    if parts.username:
+        auth = parts.username
+        if parts.password:
+            auth += ':' + parts.password
+        auth += '@'
+    port = ''
+    if parts.port:
+        port = ':{}'.format(parts.port)
+
+    return '{}://{}{}{}'.format(parts.scheme.lower(), auth,
+                                (parts.hostname or '').lower(), port)
+
+
+# Recent check results, keyed by normalized proxy URL, so proxies aren't
+# tested again until their result expires. Entries are (stage, result,
+# checked_at) tuples. Listeners are called with (proxy, entry) for every new
+# result.
+class VerdictCache(object):
+
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self.listeners = []
+        self._entries = {}
+        self._expired_at = time.time()
+
+    def enabled(self):
+        return any(ttl > 0 for ttl in self.ttls.values())
+
+    def is_fresh(self, entry, now):
+        stage, result, checked_at = entry
+        return now - checked_at < self.ttls.get(get_verdict(result), 0)
+
+    # Returns {proxy: (stage, result)} for the proxies with a fresh result.
+    def lookup(self, proxies):
+        now = time.time()
+        if now - self._expired_at >= expire_interval:
+            self._expire(now)
+            self._expired_at = now
+
+        keys = dict((proxy, normalize_proxy_url(proxy)) for proxy in proxies)
+        self._load([key for key in keys.values()
+                    if key not in self._entries])
+
+        cached = {}
+        for proxy, key in keys.items():
+            entry = self._entries.get(key)
+            if entry and self.is_fresh(entry, now):
+                cached[proxy] = entry[:2]
+
+        self.hits += len(cached)
+        self.misses += len(keys) - len(cached)
+        return cached
+
+    def put(self, proxy, stage, result):
+        entry = (stage, result, time.time())
+        self.store(proxy, entry)
+        for listener in self.listeners:
+            listener(proxy, entry)
+
+    def store(self, proxy, entry):
+        self._entries[normalize_proxy_url(proxy)] = entry
+
+    # Loads stored entries for the given keys, if backed by storage.
+    def _load(self, keys):
+        pass
+
+    def _expire(self, now):
+        for key, entry in self._entries.items():
+            if not self.is_fresh(entry, now):
+                del self._entries[key]
+
+    def save(self):
+        pass
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total:
+            log.info('Verdict cache: %d hits, %d misses (%d%% hit rate).',
+                     self.hits, self.misses, self.hits * 100 / total)
+        self.hits = 0
+        self.misses = 0
+
+
+# Verdict cache kept in a JSON file between runs.
+class FileVerdictCache(VerdictCache):
+
+    def __init__(self, filename, ttls):
+        super(FileVerdictCache, self).__init__(ttls)
+        self.filename = filename
+
+        entries = load_json(filename, 'proxy result cache')
+        if entries is not None:
+            self._entries = dict(
+                (key, tuple(entry)) for key, entry in entries.items())
+            log.info('Loaded %d cached proxy results from %s.',
+                     len(self._entries), filename)
+
+    # Writes the entries that haven't expired yet.
+    def save(self):
+        self._expire(time.time())
+        save_json(self.filename, self._entries, 'proxy result cache')